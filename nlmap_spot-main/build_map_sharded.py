@@ -0,0 +1,67 @@
+import argparse
+import configparser
+import multiprocessing
+import os
+import shutil
+import time
+
+from map_store import merge_stores
+
+def build_shard(args):
+	'''
+	Worker process: builds the partial map store of one shard with its own ViLD session and CLIP model
+	'''
+	config_path, shard_idx, num_shards, num_threads = args
+	#thread pools of TF and torch are sized when they are first used, so this has to happen before importing them
+	if num_threads > 0:
+		for name in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "TF_NUM_INTRAOP_THREADS"]:
+			os.environ[name] = str(num_threads)
+		os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+	from nlmap import NLMap
+
+	start_time = time.perf_counter()
+	nlmap = NLMap(config_path, shard=(shard_idx, num_shards))
+	print(f"Shard {shard_idx}/{num_shards}: {len(nlmap.image_names)} frames, {len(nlmap.store)} detections in {time.perf_counter() - start_time:.1f}s")
+	return nlmap.store_path
+
+def build_map_sharded(config_path, num_shards, num_threads=0, keep_shards=False):
+	'''
+	Builds the map store of a config with num_shards worker processes and merges their partial stores into the
+	store NLMap loads ({cache_dir}/{data}_store). Frame and detection ids of the merged store are the same as those
+	of a single process build. Shards that already exist are only updated, so an interrupted build resumes.
+
+	num_threads: threads used by TF and torch in every worker, 0 to leave them at their defaults
+	keep_shards: if true, partial stores are kept after merging
+	'''
+	config = configparser.ConfigParser()
+	config.read(config_path)
+	data_dir_path = f"{config['paths']['data_dir_root']}/{config['dir_names']['data']}"
+	store_path = f"{config['paths']['cache_dir']}/{config['dir_names']['data']}_store"
+	image_names = sorted([image_name for image_name in os.listdir(data_dir_path) if "color" in image_name])
+	num_shards = max(1, min(num_shards, len(image_names)))
+
+	start_time = time.perf_counter()
+	#spawn instead of fork: the parent must not share TF or torch state with the workers
+	with multiprocessing.get_context("spawn").Pool(num_shards) as pool:
+		shard_paths = pool.map(build_shard, [(config_path, shard_idx, num_shards, num_threads) for shard_idx in range(num_shards)], chunksize=1)
+	build_time = time.perf_counter() - start_time
+
+	store = merge_stores(shard_paths, store_path, frame_order=image_names, feat_dtype=config["cache"].get("feat_dtype", fallback="float16"))
+	if not keep_shards:
+		for shard_path in shard_paths:
+			shutil.rmtree(shard_path)
+	print(f"Built {len(store)} detections from {len(store.frames)} frames with {num_shards} processes in {build_time:.1f}s, merged in {time.perf_counter() - start_time - build_time:.1f}s into {store.path}")
+	if not config["cache"].getboolean("images"):
+		print("Note: [cache] images is false in this config, so NLMap will rebuild the map instead of loading this store")
+	return store
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Build the NLMap map store with several processes, each with its own ViLD session and CLIP model")
+	parser.add_argument("--config_path", help="Config file of the map to build", type=str, default="./configs/example.ini")
+	parser.add_argument("--num_shards", help="Worker processes, each builds a contiguous slice of the color frames", type=int, default=max(1, os.cpu_count()//4))
+	parser.add_argument("--num_threads", help="TF/torch threads per worker, defaults to cpu count / num_shards", type=int, default=None)
+	parser.add_argument("--keep_shards", help="Keep the partial stores after merging", action="store_true")
+	args = parser.parse_args()
+
+	num_threads = args.num_threads if args.num_threads is not None else max(1, os.cpu_count()//args.num_shards)
+	build_map_sharded(args.config_path, args.num_shards, num_threads=num_threads, keep_shards=args.keep_shards)
@@ -0,0 +1,166 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+#marks the end of the stream in every queue
+_DONE = object()
+
+class StageStats():
+	'''
+	Timing counters of one pipeline stage
+
+	busy: seconds spent working on items (summed over workers)
+	starved: seconds waiting for the stage before it
+	blocked: seconds waiting for room in the queue after it (back-pressure from slower stages)
+	'''
+	def __init__(self, name, workers=1):
+		self.name = name
+		self.workers = workers
+		self.items = 0
+		self.busy = 0.0
+		self.starved = 0.0
+		self.blocked = 0.0
+		self.lock = threading.Lock()
+
+	def add_busy(self, seconds):
+		with self.lock:
+			self.busy += seconds
+			self.items += 1
+
+	def row(self, wall_time):
+		utilization = self.busy / (self.workers * wall_time) if wall_time > 0 else 0.0
+		return f"{self.name:>8} {self.workers:>7} {self.items:>7} {self.busy:>9.1f} {self.starved:>9.1f} {self.blocked:>9.1f} {100*utilization:>6.0f}%"
+
+class _Failure():
+	def __init__(self, exception):
+		self.exception = exception
+
+class BuildPipeline():
+	'''
+	Runs a source iterable and a chain of stages on separate threads, connected by bounded queues, and yields the
+	results of the last stage in source order. A stage with more than one worker runs its items on a thread pool;
+	its queue then holds futures, so order is kept and the queue bound still limits the items in flight.
+	A full queue blocks the stage before it, so a slow stage holds back the ones upstream instead of piling up
+	results in memory. The thread that iterates the pipeline is timed as a final stage (consumer_name).
+
+	source: (name, iterable) producing the input items
+	stages: list of (name, fn, workers), fn maps one item to the next
+	max_pending: size of every queue between stages
+	'''
+	def __init__(self, source, stages, max_pending=8, consumer_name="index"):
+		self.source_name, self.source = source
+		self.stages = stages
+		self.max_pending = max(1, max_pending)
+		self.stats = [StageStats(self.source_name)] + [StageStats(name, workers) for name, _, workers in stages] + [StageStats(consumer_name)]
+		self.stopped = threading.Event()
+		self.threads = []
+		self.wall_time = 0.0
+
+	def _put(self, out_queue, item, stats):
+		start = time.perf_counter()
+		while not self.stopped.is_set():
+			try:
+				out_queue.put(item, timeout=0.1)
+				break
+			except queue.Full:
+				continue
+		stats.blocked += time.perf_counter() - start
+
+	def _get(self, in_queue, stats):
+		start = time.perf_counter()
+		while True:
+			try:
+				item = in_queue.get(timeout=0.1)
+				break
+			except queue.Empty:
+				if self.stopped.is_set():
+					item = _DONE
+					break
+		if isinstance(item, Future):
+			try:
+				item = item.result()
+			except Exception as e:
+				item = _Failure(e)
+		stats.starved += time.perf_counter() - start
+		return item
+
+	def _run_source(self, out_queue, stats):
+		try:
+			iterator = iter(self.source)
+			while not self.stopped.is_set():
+				start = time.perf_counter()
+				try:
+					item = next(iterator)
+				except StopIteration:
+					break
+				stats.add_busy(time.perf_counter() - start)
+				self._put(out_queue, item, stats)
+		except Exception as e:
+			self._put(out_queue, _Failure(e), stats)
+		self._put(out_queue, _DONE, stats)
+
+	def _timed(self, fn, item, stats):
+		start = time.perf_counter()
+		result = fn(item)
+		stats.add_busy(time.perf_counter() - start)
+		return result
+
+	def _run_stage(self, fn, workers, in_queue, out_queue, stats):
+		pool = None
+		if workers > 1:
+			pool = ThreadPoolExecutor(max_workers=workers)
+		while not self.stopped.is_set():
+			item = self._get(in_queue, stats)
+			if item is _DONE or isinstance(item, _Failure):
+				self._put(out_queue, item, stats)
+				break
+			if pool is not None:
+				self._put(out_queue, pool.submit(self._timed, fn, item, stats), stats)
+				continue
+			try:
+				result = self._timed(fn, item, stats)
+			except Exception as e:
+				result = _Failure(e)
+			self._put(out_queue, result, stats)
+		if pool is not None:
+			pool.shutdown()
+
+	def _start(self, name, target, *args):
+		thread = threading.Thread(target=target, args=args, name=f"build-{name}", daemon=True)
+		thread.start()
+		self.threads.append(thread)
+
+	def __iter__(self):
+		start_time = time.perf_counter()
+		queues = [queue.Queue(maxsize=self.max_pending) for _ in range(len(self.stages)+1)]
+		self._start(self.source_name, self._run_source, queues[0], self.stats[0])
+		for stage_idx, (name, fn, workers) in enumerate(self.stages):
+			self._start(name, self._run_stage, fn, workers, queues[stage_idx], queues[stage_idx+1], self.stats[stage_idx+1])
+
+		consumer_stats = self.stats[-1]
+		try:
+			while True:
+				item = self._get(queues[-1], consumer_stats)
+				if item is _DONE:
+					break
+				if isinstance(item, _Failure):
+					raise item.exception
+				consume_start = time.perf_counter()
+				yield item
+				consumer_stats.add_busy(time.perf_counter() - consume_start)
+		finally:
+			#also reached if the consumer stops early or raises, upstream threads then stop at their next queue operation
+			self.stopped.set()
+			for thread in self.threads:
+				thread.join(timeout=1.0)
+			self.wall_time = time.perf_counter() - start_time
+
+	def report(self):
+		'''
+		Table of the per-stage counters of the last run
+		'''
+		lines = [f"Build pipeline: {self.wall_time:.1f}s wall time",
+		         f"{'stage':>8} {'workers':>7} {'items':>7} {'busy s':>9} {'starved':>9} {'blocked':>9} {'util':>7}"]
+		lines += [stats.row(self.wall_time) for stats in self.stats]
+		return "\n".join(lines)
@@ -1,4 +1,11 @@
 from vild.vild_utils import *
+import torch
+import clip
+import tensorflow.compat.v1 as tf
+from matplotlib import pyplot as plt
+from matplotlib import patches
+from scipy.special import softmax
+from PIL import Image
 import pickle
 import os
 from tqdm import tqdm
@@ -120,7 +127,7 @@ for img_name in tqdm(img_names):
 	# Plot detected boxes on the input image.
 	ymin, xmin, ymax, xmax = np.split(rescaled_detection_boxes, 4, axis=-1)
 	processed_boxes = np.concatenate([xmin, ymin, xmax - xmin, ymax - ymin], axis=-1)
-	segmentations = paste_instance_masks(detection_masks, processed_boxes, image_height, image_width)
+	segmentations = crop_instance_masks(detection_masks, processed_boxes, image_height, image_width)
 
 	if len(indices_fg) == 0:
 		display_image(np.array(image), size=overall_fig_size)
@@ -12,7 +12,7 @@ from pathlib import Path
 # 添加当前目录到Python路径
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from saycan_qwen3 import Qwen3ObjectProposer
+from model_registry import get_qwen3
 
 def main():
     print("=" * 60)
@@ -35,7 +35,7 @@ def main():
     try:
         # 初始化 Qwen3 对象提议器
         print("\n1. 初始化 Qwen3 对象提议器...")
-        qwen3_proposer = Qwen3ObjectProposer()
+        qwen3_proposer = get_qwen3()
         print("   ✓ Qwen3 对象提议器初始化成功")
         
         # 测试任务列表
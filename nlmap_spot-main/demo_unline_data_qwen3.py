@@ -14,7 +14,7 @@ from pathlib import Path
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from nlmap import NLMap
-from saycan_qwen3 import Qwen3ObjectProposer
+from model_registry import get_qwen3
 
 def main():
     print("=" * 60)
@@ -49,7 +49,7 @@ def main():
         
         # 初始化 Qwen3 对象提议器
         print("\n4. 初始化 Qwen3 对象提议器...")
-        qwen3_proposer = Qwen3ObjectProposer()
+        qwen3_proposer = get_qwen3()
         print("   ✓ Qwen3 对象提议器初始化成功")
         
         # 测试任务列表
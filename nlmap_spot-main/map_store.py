@@ -0,0 +1,457 @@
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import numpy as np
+from PIL import Image
+
+STORE_VERSION = 1
+
+#columns with one row per ViLD detection, each stored as its own .npy file
+ROW_COLUMNS = ["frame_idx", "anno_idx", "boxes", "rpn_scores", "vild_feat", "clip_feat"]
+
+#optional per-detection columns, written once the detections have been localized in 3D (see NLMap.build_object_index)
+GEOMETRY_COLUMNS = ["centroid", "extent", "orientation", "located"]
+
+#optional per-detection object instance id, written once detections are clustered (see cluster_instances)
+INSTANCE_COLUMNS = ["instance"]
+OPTIONAL_COLUMNS = GEOMETRY_COLUMNS + INSTANCE_COLUMNS
+
+class MapStore():
+	'''
+	Columnar on-disk NLMap. Every per-detection column is a contiguous .npy array opened with np.memmap,
+	so opening a map is cheap and resident memory only grows with the rows that are actually read.
+
+	Layout of a store directory:
+		meta.json: version, row count, feature dtype and the build parameters (CLIP model, ViLD and crop settings)
+		frames.json: one entry per frame (name, height, width)
+		frame_offsets.npy: rows of frame f are frame_offsets[f]:frame_offsets[f+1]
+		frame_idx.npy, anno_idx.npy: which frame/ViLD detection a row comes from
+		boxes.npy: Nx4 float32 boxes (ymin, xmin, ymax, xmax) in image pixels
+		rpn_scores.npy: N float32 ViLD RPN scores
+		vild_feat.npy: NxD ViLD visual features
+		clip_feat.npy: NxD L2-normalized CLIP crop embeddings
+		masks.npz: compressed Nxmask_hxmask_w uint8 ViLD masks (probability*255), loaded on first use
+		centroid.npy, extent.npy: optional Nx3 float32 vision frame centroids and box sizes
+		orientation.npy: optional Nx3x3 float32 box orientations
+		located.npy: optional N bools, False for detections without depth (their geometry is meaningless)
+		instance.npy: optional N int32 ids of the object instance every detection belongs to
+	'''
+	def __init__(self, columns, frames, frame_offsets, masks=None, path=None, build_params=None):
+		self.columns = columns
+		self.frames = frames
+		self.frame_offsets = frame_offsets
+		self.path = path
+		self._masks = masks
+		#dict of everything the stored features depend on, None for stores converted from pickle caches
+		self.build_params = build_params
+
+	@staticmethod
+	def exists(path):
+		return os.path.isfile(f"{path}/meta.json")
+
+	@classmethod
+	def open(cls, path):
+		meta = json.load(open(f"{path}/meta.json"))
+		if meta["version"] != STORE_VERSION:
+			raise Exception(f"map store at {path} has version {meta['version']}, expected {STORE_VERSION}")
+		frames = json.load(open(f"{path}/frames.json"))
+		frame_offsets = np.load(f"{path}/frame_offsets.npy")
+		columns = {name: np.load(f"{path}/{name}.npy", mmap_mode="r") for name in ROW_COLUMNS}
+		for name in OPTIONAL_COLUMNS:
+			if os.path.isfile(f"{path}/{name}.npy"):
+				columns[name] = np.load(f"{path}/{name}.npy", mmap_mode="r")
+		return cls(columns, frames, frame_offsets, path=path, build_params=meta.get("build_params"))
+
+	def __len__(self):
+		return int(self.frame_offsets[-1])
+
+	def __getitem__(self, column):
+		return self.columns[column]
+
+	@property
+	def has_geometry(self):
+		return all(name in self.columns for name in GEOMETRY_COLUMNS)
+
+	@property
+	def has_instances(self):
+		return all(name in self.columns for name in INSTANCE_COLUMNS)
+
+	@property
+	def frame_names(self):
+		return [frame["name"] for frame in self.frames]
+
+	@property
+	def masks(self):
+		if self._masks is None:
+			self._masks = np.load(f"{self.path}/masks.npz")["masks"]
+		return self._masks
+
+	def rows_for_frame(self, frame_idx):
+		return slice(int(self.frame_offsets[frame_idx]), int(self.frame_offsets[frame_idx+1]))
+
+	def row(self, image_name, anno_idx):
+		'''
+		Returns the row of detection anno_idx of frame image_name
+		'''
+		if not hasattr(self, "_frame_lookup"):
+			self._frame_lookup = {name: frame_idx for frame_idx, name in enumerate(self.frame_names)}
+		return int(self.frame_offsets[self._frame_lookup[image_name]]) + int(anno_idx)
+
+	def image_name(self, row):
+		return self.frames[int(self.columns["frame_idx"][row])]["name"]
+
+	def crop(self, row, data_dir_path):
+		'''
+		Cuts the crop of a row out of its color image, the same way crops are made while building the map
+		'''
+		ymin, xmin, ymax, xmax = self.columns["boxes"][row]
+		y1, x1, y2, x2 = int(np.floor(ymin)), int(np.floor(xmin)), int(np.ceil(ymax)), int(np.ceil(xmax))
+		image = np.asarray(Image.open(f"{data_dir_path}/{self.image_name(row)}").convert("RGB"))
+		return np.copy(image[y1:y2, x1:x2, :])
+
+	def save(self, path):
+		'''
+		Writes the store to path. The store is written next to path first and then moved into place, so
+		readers never see a half-written map.
+		'''
+		tmp_path = f"{path}.tmp"
+		if os.path.isdir(tmp_path):
+			shutil.rmtree(tmp_path)
+		os.makedirs(tmp_path)
+
+		for name in ROW_COLUMNS + [name for name in OPTIONAL_COLUMNS if name in self.columns]:
+			np.save(f"{tmp_path}/{name}.npy", np.ascontiguousarray(self.columns[name]))
+		np.save(f"{tmp_path}/frame_offsets.npy", self.frame_offsets)
+		np.savez_compressed(f"{tmp_path}/masks.npz", masks=self.masks)
+		json.dump(self.frames, open(f"{tmp_path}/frames.json", "w"))
+		json.dump({"version": STORE_VERSION, "rows": len(self), "feat_dtype": str(self.columns["clip_feat"].dtype), "build_params": self.build_params}, open(f"{tmp_path}/meta.json", "w"))
+
+		if os.path.isdir(path):
+			shutil.rmtree(path)
+		os.rename(tmp_path, path)
+		self.path = path
+
+	def save_columns(self, columns):
+		'''
+		Adds or replaces columns with one row per detection. If the store is on disk, each column file is written
+		next to its final name and then moved into place, and the store reads it back memory mapped.
+		'''
+		for name, column in columns.items():
+			if len(column) != len(self):
+				raise Exception(f"column {name} has {len(column)} rows, the map store has {len(self)}")
+			if self.path is None:
+				self.columns[name] = column
+				continue
+			np.save(f"{self.path}/{name}.tmp.npy", np.ascontiguousarray(column))
+			os.replace(f"{self.path}/{name}.tmp.npy", f"{self.path}/{name}.npy")
+			self.columns[name] = np.load(f"{self.path}/{name}.npy", mmap_mode="r")
+
+
+def feature_rows(features, n):
+	'''
+	Returns features as an n x D array. D is taken from the input when a frame has no detections, since reshape
+	can't infer it from an empty array
+	'''
+	features = np.asarray(features)
+	return features.reshape(n, features.shape[-1] if n == 0 else -1)
+
+
+class MapStoreWriter():
+	'''
+	Accumulates per-frame ViLD/CLIP outputs while a map is built and turns them into a MapStore
+	'''
+	def __init__(self, feat_dtype="float16", build_params=None):
+		self.feat_dtype = np.dtype(feat_dtype)
+		self.build_params = build_params
+		self.frames = []
+		self.chunks = {name: [] for name in ROW_COLUMNS}
+		self.mask_chunks = []
+		#geometry of copied frames, None for frames that are computed (or copied from a store without geometry)
+		self.geometry_chunks = {name: [] for name in GEOMETRY_COLUMNS}
+		#set by close() if only some frames have geometry: (columns with the rows of the other frames zeroed, those rows)
+		self.partial_geometry = None
+
+	def add_frame(self, image_name, image_height, image_width, rpn_scores, boxes, masks, vild_feat, clip_feat, frame_info=None):
+		'''
+		Adds all detections of one frame
+
+		rpn_scores: N ViLD RPN scores
+		boxes: Nx4 rescaled ViLD boxes (ymin, xmin, ymax, xmax)
+		masks: Nxmask_hxmask_w ViLD mask probabilities
+		vild_feat: NxD ViLD visual features
+		clip_feat: NxD CLIP image features, normalized here
+		frame_info: optional dict of extra per-frame fields stored in frames.json
+		'''
+		n = len(rpn_scores)
+		frame = {"name": image_name, "height": int(image_height), "width": int(image_width)}
+		if frame_info is not None:
+			frame.update(frame_info)
+		frame_idx = len(self.frames)
+		self.frames.append(frame)
+
+		clip_feat = feature_rows(np.asarray(clip_feat, dtype=np.float32), n)
+		if n > 0:
+			clip_feat = clip_feat / np.linalg.norm(clip_feat, axis=1, keepdims=True)
+
+		self.chunks["frame_idx"].append(np.full(n, frame_idx, dtype=np.int32))
+		self.chunks["anno_idx"].append(np.arange(n, dtype=np.int32))
+		self.chunks["boxes"].append(np.asarray(boxes, dtype=np.float32).reshape(n, 4))
+		self.chunks["rpn_scores"].append(np.asarray(rpn_scores, dtype=np.float32).reshape(n))
+		self.chunks["vild_feat"].append(feature_rows(vild_feat, n).astype(self.feat_dtype))
+		self.chunks["clip_feat"].append(clip_feat.astype(self.feat_dtype))
+		self.mask_chunks.append(np.round(np.clip(masks, 0, 1)*255).astype(np.uint8))
+		for name in GEOMETRY_COLUMNS:
+			self.geometry_chunks[name].append(None)
+
+	def copy_frame(self, store, frame_idx, frame_info=None):
+		'''
+		Adds the detections of frame frame_idx of an existing store without recomputing them, with their geometry
+		if the store has it. Instance ids are not copied since instances are clustered over the whole map.
+		'''
+		rows = store.rows_for_frame(frame_idx)
+		frame = dict(store.frames[frame_idx])
+		if frame_info is not None:
+			frame.update(frame_info)
+		new_frame_idx = len(self.frames)
+		self.frames.append(frame)
+
+		for name in ROW_COLUMNS:
+			if name == "frame_idx":
+				self.chunks[name].append(np.full(rows.stop - rows.start, new_frame_idx, dtype=np.int32))
+			elif name in ["vild_feat", "clip_feat"]:
+				self.chunks[name].append(np.array(store[name][rows]).astype(self.feat_dtype))
+			else:
+				self.chunks[name].append(np.array(store[name][rows]))
+		self.mask_chunks.append(np.array(store.masks[rows]))
+		for name in GEOMETRY_COLUMNS:
+			self.geometry_chunks[name].append(np.array(store[name][rows]) if store.has_geometry else None)
+
+	def close(self, path=None):
+		'''
+		Returns the finished MapStore, written to (and memory mapped from) path if one is given
+		'''
+		counts = [len(chunk) for chunk in self.chunks["frame_idx"]]
+		frame_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+		columns = {}
+		#frames without detections may have empty arrays of another width (e.g. an empty list for their features), so
+		#they are left out of the concatenation unless all frames are empty
+		for name, chunks in self.chunks.items():
+			chunks = [chunk for chunk in chunks if len(chunk) > 0] or chunks[:1]
+			if len(chunks) == 0:
+				columns[name] = np.zeros((0,), dtype=np.float32)
+			else:
+				columns[name] = np.concatenate(chunks, axis=0)
+		mask_chunks = [chunk for chunk in self.mask_chunks if len(chunk) > 0] or self.mask_chunks[:1]
+		masks = np.concatenate(mask_chunks, axis=0) if len(mask_chunks) > 0 else np.zeros((0, 0, 0), dtype=np.uint8)
+
+		#geometry is stored if every frame has it, otherwise kept in partial_geometry so only the other rows are localized
+		has_geometry = [chunk is not None for chunk in self.geometry_chunks["located"]]
+		if any(has_geometry):
+			geometry = {}
+			for name, chunks in self.geometry_chunks.items():
+				reference = next(chunk for chunk in chunks if chunk is not None)
+				geometry[name] = np.concatenate([chunk if chunk is not None else np.zeros((count,) + reference.shape[1:], dtype=reference.dtype) for chunk, count in zip(chunks, counts)], axis=0)
+			if all(has_geometry):
+				columns.update(geometry)
+			else:
+				missing_rows = np.concatenate([np.arange(frame_offsets[frame_idx], frame_offsets[frame_idx+1]) for frame_idx, known in enumerate(has_geometry) if not known])
+				self.partial_geometry = (geometry, missing_rows.astype(np.int64))
+
+		store = MapStore(columns, self.frames, frame_offsets, masks=masks, build_params=self.build_params)
+		if path is not None:
+			store.save(path)
+			return MapStore.open(path)
+		return store
+
+
+def frame_fingerprint(image_path):
+	'''
+	Returns the mtime, size and content hash of a frame, stored per frame to detect changed files
+	'''
+	stat = os.stat(image_path)
+	sha1 = hashlib.sha1(open(image_path, "rb").read()).hexdigest()
+	return {"mtime": stat.st_mtime, "size": stat.st_size, "sha1": sha1}
+
+def diff_frames(store, data_dir_path, image_names):
+	'''
+	Compares the frames of a store with the color images currently in data_dir_path. Files whose mtime and size
+	are unchanged are not hashed again. Frames converted from pickle caches have no fingerprint yet and are
+	trusted as unchanged.
+
+	returns (unchanged, new, changed, removed) where unchanged maps image name to (frame_idx, fingerprint)
+	and the others are lists of image names
+	'''
+	stored = {frame["name"]: (frame_idx, frame) for frame_idx, frame in enumerate(store.frames)}
+	unchanged = {}
+	new = []
+	changed = []
+	for image_name in image_names:
+		if image_name not in stored:
+			new.append(image_name)
+			continue
+
+		frame_idx, frame = stored[image_name]
+		image_path = f"{data_dir_path}/{image_name}"
+		stat = os.stat(image_path)
+		if "sha1" in frame and frame["mtime"] == stat.st_mtime and frame["size"] == stat.st_size:
+			unchanged[image_name] = (frame_idx, {"mtime": frame["mtime"], "size": frame["size"], "sha1": frame["sha1"]})
+			continue
+
+		fingerprint = frame_fingerprint(image_path)
+		if "sha1" not in frame or frame["sha1"] == fingerprint["sha1"]:
+			unchanged[image_name] = (frame_idx, fingerprint)
+		else:
+			changed.append(image_name)
+
+	image_names = set(image_names)
+	removed = [name for name in stored if name not in image_names]
+	return unchanged, new, changed, removed
+
+def cluster_instances(centroids, clip_feat, located, frame_idx, radius=0.3, min_similarity=0.85, chunk_size=65536):
+	'''
+	Groups detections of the same physical object seen from several frames into object instances. Two located
+	detections are linked if they come from different frames, their centroids are within radius (meters) and their
+	CLIP embeddings have a cosine similarity of at least min_similarity. Links are merged most similar first, and a
+	link is skipped if its merge would put two detections of the same frame into one instance: those are distinct
+	objects (e.g. two identical cups side by side), so links don't chain them together. Candidate pairs come from a
+	KD-tree, so this scales to tens of thousands of detections.
+
+	centroids: Nx3 vision frame centroids
+	clip_feat: NxD L2-normalized CLIP embeddings
+	located: N bools, detections without depth are never linked and become instances of their own
+	frame_idx: N frame indices
+
+	returns N int32 instance ids, numbered 0..num_instances-1
+	'''
+	from scipy.spatial import cKDTree
+
+	located_rows = np.nonzero(np.asarray(located))[0]
+	frame_idx = np.asarray(frame_idx)
+	n = len(frame_idx)
+
+	pairs = cKDTree(np.asarray(centroids, dtype=np.float64)[located_rows]).query_pairs(radius, output_type="ndarray")
+	first, second = located_rows[pairs[:, 0]], located_rows[pairs[:, 1]]
+	different_frames = frame_idx[first] != frame_idx[second]
+	first, second = first[different_frames], second[different_frames]
+
+	#pairs are compared in chunks so only chunk_size pairs of embeddings are gathered at once
+	similarity_all = np.zeros(len(first), dtype=np.float32)
+	for start in range(0, len(first), chunk_size):
+		end = start + chunk_size
+		similarity_all[start:end] = np.einsum("nd,nd->n", np.asarray(clip_feat[first[start:end]], dtype=np.float32), np.asarray(clip_feat[second[start:end]], dtype=np.float32))
+	linked = similarity_all >= min_similarity
+
+	#union-find where every root keeps the frames of its instance. Smaller instances are merged into larger ones
+	first, second, similarity = first[linked], second[linked], similarity_all[linked]
+	parent = np.arange(n)
+	frames = {}
+	def find(row):
+		root = row
+		while parent[root] != root:
+			root = parent[root]
+		while parent[row] != root:
+			parent[row], row = root, parent[row]
+		return root
+
+	for pair in np.argsort(-similarity, kind="stable"):
+		root_a, root_b = find(first[pair]), find(second[pair])
+		if root_a == root_b:
+			continue
+		frames_a = frames.get(root_a, {frame_idx[root_a]})
+		frames_b = frames.get(root_b, {frame_idx[root_b]})
+		if not frames_a.isdisjoint(frames_b):
+			continue
+		if len(frames_a) < len(frames_b):
+			root_a, root_b, frames_a, frames_b = root_b, root_a, frames_b, frames_a
+		parent[root_b] = root_a
+		frames_a |= frames_b
+		frames[root_a] = frames_a
+		frames.pop(root_b, None)
+
+	#instances are numbered in order of their first row
+	roots = np.array([find(row) for row in range(n)], dtype=np.int64)
+	_, first_rows, instance = np.unique(roots, return_index=True, return_inverse=True)
+	numbering = np.empty(len(first_rows), dtype=np.int32)
+	numbering[np.argsort(first_rows)] = np.arange(len(first_rows), dtype=np.int32)
+	return numbering[instance.reshape(-1)]
+
+def shard_frames(image_names, shard_idx, num_shards):
+	'''
+	Returns the frames built by shard shard_idx of num_shards: a contiguous, near equal slice of image_names
+	'''
+	bounds = np.linspace(0, len(image_names), num_shards+1).round().astype(int)
+	return image_names[bounds[shard_idx]:bounds[shard_idx+1]]
+
+def shard_store_path(store_path, shard_idx, num_shards):
+	return f"{store_path}.shard{shard_idx}of{num_shards}"
+
+def merge_stores(store_paths, path=None, frame_order=None, feat_dtype=None):
+	'''
+	Merges partial map stores (e.g. the shards of a sharded build) into one MapStore. Frames are ordered by
+	frame_order (default: sorted frame names, the order NLMap builds frames in), so frame and detection ids are the
+	same as if one process had built all frames and don't depend on how frames were split. Geometry columns are
+	kept if every store has them, instance ids are dropped since instances are clustered over the merged map.
+
+	store_paths: directories of the stores to merge. A frame may only be in one of them
+	path: where to write the merged store, if given
+	feat_dtype: dtype of the merged features, defaults to that of the first store
+	'''
+	stores = [MapStore.open(store_path) for store_path in store_paths]
+	frame_sources = {}
+	for store in stores:
+		for frame_idx, image_name in enumerate(store.frame_names):
+			if image_name in frame_sources:
+				raise Exception(f"frame {image_name} is in both {frame_sources[image_name][0].path} and {store.path}")
+			frame_sources[image_name] = (store, frame_idx)
+
+	if frame_order is None:
+		frame_order = sorted(frame_sources.keys())
+	missing = [image_name for image_name in frame_order if image_name not in frame_sources]
+	if len(missing) > 0:
+		raise Exception(f"{len(missing)} frames are in none of the stores, e.g. {missing[0]}")
+
+	for store in stores[1:]:
+		if store.build_params != stores[0].build_params:
+			raise Exception(f"{store.path} was built with {store.build_params}, {stores[0].path} with {stores[0].build_params}")
+
+	if feat_dtype is None:
+		feat_dtype = stores[0]["clip_feat"].dtype if len(stores) > 0 else "float16"
+	writer = MapStoreWriter(feat_dtype=feat_dtype, build_params=stores[0].build_params if len(stores) > 0 else None)
+	for image_name in frame_order:
+		store, frame_idx = frame_sources[image_name]
+		writer.copy_frame(store, frame_idx)
+	return writer.close(path)
+
+def convert_pickle_cache(cache_path, store_path=None, feat_dtype="float16"):
+	'''
+	Converts the old {cache_path}_images_vild and {cache_path}_images_clip pickle caches into a MapStore
+
+	cache_path: cache prefix, i.e. {cache_dir}/{data dir name}
+	store_path: where to write the store, defaults to {cache_path}_store
+	'''
+	if store_path is None:
+		store_path = f"{cache_path}_store"
+	image2vectorvild_dir = pickle.load(open(f"{cache_path}_images_vild", "rb"))
+	image2vectorclip_dir = pickle.load(open(f"{cache_path}_images_clip", "rb"))
+
+	writer = MapStoreWriter(feat_dtype=feat_dtype)
+	for image_name in sorted(image2vectorvild_dir.keys()):
+		image,image_height,image_width,valid_indices,detection_roi_scores,detection_boxes,detection_masks,detection_visual_feat,rescaled_detection_boxes = image2vectorvild_dir[image_name]
+		clip_dir = image2vectorclip_dir[image_name]
+		clip_feat = [clip_dir[anno_idx].detach().cpu().float().numpy().reshape(-1) for anno_idx in range(len(detection_roi_scores))]
+		writer.add_frame(image_name, image_height, image_width, detection_roi_scores, rescaled_detection_boxes, detection_masks, detection_visual_feat, np.array(clip_feat))
+	return writer.close(store_path)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Convert NLMap pickle image caches into a memory-mappable map store")
+	parser.add_argument("cache_path", help="Cache prefix, i.e. {cache_dir}/{data dir name}", type=str)
+	parser.add_argument("--store_path", help="Output store directory, defaults to {cache_path}_store", type=str, default=None)
+	parser.add_argument("--feat_dtype", help="dtype of stored features", type=str, default="float16", choices=["float16", "float32"])
+	args = parser.parse_args()
+
+	store = convert_pickle_cache(args.cache_path, args.store_path, args.feat_dtype)
+	print(f"Wrote {len(store)} detections from {len(store.frames)} frames to {store.path}")
@@ -0,0 +1,204 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib import patches
+
+from vild.vild_utils import visualize_boxes_and_labels_on_image_array, plot_mask, crop_instance_masks
+
+class VizSettings():
+	'''
+	[viz] options needed to draw map building figures, parsed once per build instead of once per frame or crop
+	'''
+	def __init__(self, config, category_names, category_indices, figs_dir_path):
+		self.show = config["viz"].getboolean("boxes")
+		self.save_whole = config["viz"].getboolean("save_whole_boxes")
+		self.save_anno = config["viz"].getboolean("save_anno_boxes")
+		self.mask_color = config["viz"]["mask_color"]
+		self.alpha = config["viz"].getfloat("alpha")
+		self.line_thickness = config["viz"].getfloat("line_thickness")
+		self.overall_fig_size = [float(x) for x in config["viz"]["overall_fig_size"].split(",")]
+		self.workers = config["viz"].getint("workers", fallback=2)
+		self.max_pending = config["viz"].getint("max_pending", fallback=8)
+		self.max_boxes_to_draw = config["vild"].getint("max_boxes_to_draw")
+		self.min_rpn_score_thresh = config["vild"].getfloat("min_rpn_score_thresh")
+
+		self.category_names = category_names
+		self.category_indices = category_indices
+		self.figs_dir_path = figs_dir_path
+
+		# TODO: fig_size_w and h are a little hardcoded, make more general?
+		fig_size_w = 35
+		fig_size_h = min(max(5, int(len(category_names) / 2.5) ), 10)
+		self.anno_fig_size = (fig_size_w, fig_size_h)
+		self.anno_fontsize = max(min(fig_size_h / float(len(category_names)) * 45, 20), 8)
+
+	@property
+	def enabled(self):
+		return self.show or self.save_whole or self.save_anno
+
+
+def make_record(image_name, image, valid_indices, detection_roi_scores, detection_masks, rescaled_detection_boxes, scores_all, indices):
+	'''
+	Collects everything the figures of one frame are drawn from. Masks are still ViLD's small box masks, they are
+	resized into the image by the renderer.
+	'''
+	return {
+		"image_name": image_name,
+		"image": np.asarray(image),
+		"valid_indices": valid_indices,
+		"detection_roi_scores": detection_roi_scores,
+		"detection_masks": detection_masks,
+		"rescaled_detection_boxes": rescaled_detection_boxes,
+		"scores_all": scores_all,
+		"indices": indices,
+	}
+
+def new_figure(show, **kwargs):
+	'''
+	Figures that are shown go through pyplot (main thread only), figures that are only saved are standalone
+	Figure objects so worker threads don't share pyplot state
+	'''
+	if show:
+		import matplotlib.pyplot as plt
+		return plt.figure(**kwargs)
+	return Figure(**kwargs)
+
+def finish_figure(fig, show, save_path=None):
+	if save_path is not None:
+		fig.savefig(save_path, bbox_inches='tight')
+	if show:
+		import matplotlib.pyplot as plt
+		plt.show()
+		plt.close(fig)
+
+def render_record(record, settings, show=False):
+	'''
+	Draws the figures of one frame: the whole image with all detections ([viz] save_whole_boxes) and one figure per
+	detection with its crop, mask and category scores ([viz] save_anno_boxes). Figures are shown if show.
+	'''
+	image_name = record["image_name"]
+	raw_image = record["image"]
+	rescaled_detection_boxes = record["rescaled_detection_boxes"]
+	indices = record["indices"]
+	image_height, image_width = raw_image.shape[:2]
+
+	ymin, xmin, ymax, xmax = np.split(rescaled_detection_boxes, 4, axis=-1)
+	processed_boxes = np.concatenate([xmin, ymin, xmax - xmin, ymax - ymin], axis=-1)
+	segmentations = crop_instance_masks(record["detection_masks"], processed_boxes, image_height, image_width)
+
+	if show or settings.save_whole:
+		if len(indices) == 0:
+			image_with_detections = np.copy(raw_image)
+			print('ViLD does not detect anything belong to the given category')
+		else:
+			image_with_detections = visualize_boxes_and_labels_on_image_array(
+			    np.copy(raw_image),
+			    rescaled_detection_boxes[indices],
+			    record["valid_indices"][:settings.max_boxes_to_draw][indices],
+			    record["detection_roi_scores"][indices],
+			    settings.category_indices,
+			    instance_masks=segmentations[indices],
+			    use_normalized_coordinates=False,
+			    max_boxes_to_draw=settings.max_boxes_to_draw,
+			    min_score_thresh=settings.min_rpn_score_thresh,
+			    skip_scores=False,
+			    skip_labels=True)
+
+		fig = new_figure(show, figsize=settings.overall_fig_size)
+		ax = fig.add_subplot()
+		ax.imshow(image_with_detections)
+		ax.axis('off')
+		ax.set_title('Detected objects and RPN scores')
+		finish_figure(fig, show, f"{settings.figs_dir_path}/{image_name}_whole.jpg" if settings.save_whole else None)
+
+	if not (show or settings.save_anno):
+		return
+
+	category_names = settings.category_names
+	for anno_idx in indices:
+		rpn_score = record["detection_roi_scores"][anno_idx]
+		bbox = rescaled_detection_boxes[anno_idx]
+		scores = record["scores_all"][anno_idx]
+
+		y1, x1, y2, x2 = int(np.floor(bbox[0])), int(np.floor(bbox[1])), int(np.ceil(bbox[2])), int(np.ceil(bbox[3]))
+		crop = raw_image[y1:y2, x1:x2, :]
+
+		img_w_mask = plot_mask(settings.mask_color, settings.alpha, raw_image, segmentations[anno_idx])
+		crop_w_mask = img_w_mask[y1:y2, x1:x2, :]
+
+		fig = new_figure(show, figsize=settings.anno_fig_size, constrained_layout=True)
+		axs = fig.subplots(1, 4, gridspec_kw={'width_ratios': [3, 1, 1, 2]})
+
+		# Draw bounding box.
+		rect = patches.Rectangle((x1, y1), x2-x1, y2-y1, linewidth=settings.line_thickness, edgecolor='r', facecolor='none')
+		axs[0].add_patch(rect)
+
+		axs[0].set_xticks([])
+		axs[0].set_yticks([])
+		axs[0].set_title(f'bbox: {y1, x1, y2, x2} area: {(y2 - y1) * (x2 - x1)} rpn score: {rpn_score:.4f}')
+
+		axs[0].imshow(raw_image)
+
+		# Draw image in a cropped region.
+		axs[1].set_xticks([])
+		axs[1].set_yticks([])
+
+		axs[1].set_title(f'predicted: {category_names[np.argmax(scores)]}')
+
+		axs[1].imshow(crop)
+
+		# Draw segmentation inside a cropped region.
+		axs[2].set_xticks([])
+		axs[2].set_yticks([])
+		axs[2].set_title('mask')
+
+		axs[2].imshow(crop_w_mask)
+
+		# Draw category scores.
+		axs[3].barh(range(len(category_names)), scores[:len(category_names)],
+		            color=['orange' if score == max(scores) else 'blue' for score in scores[:len(category_names)]])
+		axs[3].invert_yaxis()
+		axs[3].set_axisbelow(True)
+		axs[3].set_xlim(0, 1)
+		axs[3].set_xlabel("confidence score")
+		axs[3].set_yticks(range(len(category_names)))
+		axs[3].set_yticklabels(category_names, fontdict={
+		    'fontsize': settings.anno_fontsize})
+
+		finish_figure(fig, show, f"{settings.figs_dir_path}/{image_name}_anno_{anno_idx}.jpg" if settings.save_anno else None)
+
+
+class VizPipeline():
+	'''
+	Optional visualization stage of the map build. Records are queued to a pool of worker threads that draw and
+	save the figures, so the build never waits on matplotlib rendering or savefig; submit only blocks when
+	[viz] max_pending records are still waiting. Threads are used rather than processes since the build process
+	holds TF and torch state that should not be forked, and figures are drawn without pyplot so workers share no state.
+	Showing figures ([viz] boxes) needs the main thread, so with boxes = True records are drawn inline instead.
+	'''
+	def __init__(self, settings):
+		self.settings = settings
+		self.pool = None
+		if settings.workers > 0 and not settings.show:
+			self.pool = ThreadPoolExecutor(max_workers=settings.workers)
+		self.pending = collections.deque()
+
+	def submit(self, record):
+		if self.pool is None:
+			render_record(record, self.settings, show=self.settings.show)
+			return
+
+		#results of finished records are collected so worker errors surface during the build
+		while len(self.pending) > 0 and (self.pending[0].done() or len(self.pending) >= self.settings.max_pending):
+			self.pending.popleft().result()
+		self.pending.append(self.pool.submit(render_record, record, self.settings))
+
+	def close(self):
+		'''
+		Waits for every queued record to be drawn
+		'''
+		while len(self.pending) > 0:
+			self.pending.popleft().result()
+		if self.pool is not None:
+			self.pool.shutdown()
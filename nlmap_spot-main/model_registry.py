@@ -0,0 +1,96 @@
+import os
+import resource
+import threading
+import time
+
+def resident_bytes():
+	'''
+	Current resident memory of this process (peak resident memory where /proc is not available)
+	'''
+	try:
+		with open("/proc/self/statm") as statm:
+			return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+	except (OSError, ValueError):
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def torch_parameter_bytes(model):
+	return sum(parameter.numel() * parameter.element_size() for parameter in model.parameters())
+
+class ModelRegistry():
+	'''
+	Process-wide registry of loaded models. A model is loaded the first time it is asked for and every later
+	caller gets the same instance, so e.g. re-localizing before every grasp doesn't load CLIP or ViLD again.
+	Load time and memory of every model are recorded, see report().
+	'''
+	def __init__(self):
+		self.models = {}
+		self.stats = {}
+		self.lock = threading.Lock()
+
+	def get(self, key, loader, size_fn=None):
+		'''
+		Returns the model registered under key, calling loader() to load it if it is not loaded yet
+
+		size_fn: optional function of the loaded model returning its parameter bytes
+		'''
+		with self.lock:
+			if key not in self.models:
+				start_time = time.perf_counter()
+				start_bytes = resident_bytes()
+				self.models[key] = loader()
+				self.stats[key] = {
+					"load_time": time.perf_counter() - start_time,
+					"resident_bytes": resident_bytes() - start_bytes,
+					"parameter_bytes": size_fn(self.models[key]) if size_fn is not None else None,
+				}
+				print(f"Loaded {self.describe(key)}")
+			return self.models[key]
+
+	def loaded(self, key):
+		return key in self.models
+
+	def describe(self, key):
+		stats = self.stats[key]
+		description = f"{' '.join(str(part) for part in key)} in {stats['load_time']:.1f}s, +{stats['resident_bytes']/2**20:.0f} MB resident"
+		if stats["parameter_bytes"] is not None:
+			description += f", {stats['parameter_bytes']/2**20:.0f} MB of parameters"
+		return description
+
+	def report(self):
+		'''
+		One line per loaded model with its load time and memory
+		'''
+		if len(self.models) == 0:
+			return "No models loaded"
+		return "\n".join(["Loaded models:"] + [f"  {self.describe(key)}" for key in self.models])
+
+REGISTRY = ModelRegistry()
+
+def get_clip(model_name="ViT-B/32"):
+	'''
+	Returns (model, preprocess) of CLIP model_name
+	'''
+	def load():
+		import clip
+		return clip.load(model_name)
+	return REGISTRY.get(("clip", model_name), load, size_fn=lambda loaded: torch_parameter_bytes(loaded[0]))
+
+def get_vild_session(saved_model_dir):
+	'''
+	Returns a TF session with the ViLD saved model in saved_model_dir loaded
+	'''
+	def load():
+		import tensorflow.compat.v1 as tf
+		session = tf.Session(graph=tf.Graph())
+		_ = tf.saved_model.loader.load(session, ['serve'], saved_model_dir)
+		return session
+	return REGISTRY.get(("vild", os.path.abspath(saved_model_dir)), load)
+
+def get_qwen3(model_path=None):
+	'''
+	Returns the Qwen3ObjectProposer of model_path (default path of saycan_qwen3 if None)
+	'''
+	def load():
+		from saycan_qwen3 import Qwen3ObjectProposer
+		return Qwen3ObjectProposer(model_path)
+	return REGISTRY.get(("qwen3", model_path or "default"), load, size_fn=lambda proposer: torch_parameter_bytes(proposer.model))
@@ -1,49 +1,75 @@
+import sys
+if "--profile-startup" in sys.argv:
+	#installed before any other import so module-level imports are timed too
+	from startup_profile import PROFILER
+	PROFILER.start()
+
 import configparser
 import argparse
 import os
 import pickle
 from tqdm import tqdm
 import numpy as np
-from collections import defaultdict
-from queue import PriorityQueue
 from PIL import Image
-import clip
-import torch
-
-from nlmap_utils import get_best_clip_vild_dirs
-from spot_utils.utils import pixel_to_vision_frame, pixel_to_vision_frame_depth_provided, arm_object_grasp, open_gripper
-from spot_utils.generate_pointcloud import make_pointcloud
-from vild.vild_utils import visualize_boxes_and_labels_on_image_array, plot_mask
-import matplotlib.pyplot as plt
-from matplotlib import patches
-
-import cv2
-
-import open3d as o3d
-
-from bosdyn.client.image import ImageClient
-
-import bosdyn.api.gripper_command_pb2
-import bosdyn.client
-import bosdyn.client.lease
-import bosdyn.client.util
-
-from bosdyn.api import geometry_pb2
-from bosdyn.api import basic_command_pb2
 
-from bosdyn.client.frame_helpers import VISION_FRAME_NAME, GRAV_ALIGNED_BODY_FRAME_NAME, get_a_tform_b
-from bosdyn.client.robot_command import (RobotCommandBuilder, RobotCommandClient,
-                                        block_until_arm_arrives, blocking_stand)
-from bosdyn.client.robot_state import RobotStateClient
-from bosdyn.client import math_helpers
-from bosdyn.client.manipulation_api_client import ManipulationApiClient
-
-from spot_utils.move_spot_to import move_to
+from map_store import MapStore, MapStoreWriter, convert_pickle_cache, diff_frames, frame_fingerprint, cluster_instances, shard_frames, shard_store_path
+from spot_utils.camera import CameraModel, localize_boxes, localize_masks
+from spot_utils.depth_io import DepthCache
+from build_pipeline import BuildPipeline
+from text_cache import TextEmbeddingCache
+from model_registry import get_clip, get_vild_session
+from startup_profile import PhaseTimer
+
+### Heavy subsystems are imported by the features that need them, so loading a cached map doesn't pay for them:
+### ViLD/CLIP (tensorflow, torch, clip) when building or embedding new text, open3d when making or showing
+### pointclouds, matplotlib when drawing, scipy when indexing objects and the bosdyn SDK when a robot is used.
+
+def top_k_rows(scores, k):
+	'''
+	Returns the indices of the k highest scores, best first
+	'''
+	k = min(k, len(scores))
+	if k == 0:
+		return np.zeros(0, dtype=np.int64)
+	top_rows = np.argpartition(-scores, k-1)[:k]
+	return top_rows[np.argsort(-scores[top_rows])]
+
+def frame_number(image_name):
+	'''
+	Returns n for a color_n.jpg frame name
+	'''
+	return int(image_name.split("_")[1].split(".")[0])
+
+class CategoryQueries(dict):
+	'''
+	Top k results of the configured categories for one query source. A category is ranked with query() the first
+	time it is read, so startup doesn't cut (and decode the images of) crops nobody looks at.
+	'''
+	def __init__(self, query, category_names, source):
+		super().__init__()
+		self.query = query
+		self.category_names = list(category_names)
+		self.source = source
+
+	def __missing__(self, category_name):
+		if category_name not in self.category_names:
+			raise KeyError(category_name)
+		self[category_name] = self.query(category_name, source=self.source)
+		return self[category_name]
+
+	def __contains__(self, category_name):
+		return category_name in self.category_names
 
 class NLMap():
-	def __init__(self,config_path="./configs/example.ini"):
+	def __init__(self,config_path="./configs/example.ini",shard=None):
+		'''
+		config_path: path of the .ini config
+		shard: optional (shard_idx, num_shards). Only builds the partial map store of that shard of the color frames
+			and skips the robot, pointcloud and everything queries need, see build_map_sharded.py
+		'''
 		###########################################################################################################
 		######### Initialization
+		self.startup_phases = PhaseTimer()
 
 		if not os.path.isfile(config_path):
 			raise Exception(f"config_path {config_path} has no config file")
@@ -52,15 +78,20 @@ class NLMap():
 		self.config.sections()
 		self.config.read(config_path)
 
-		### device setting
-		device = "cuda" if torch.cuda.is_available() else "cpu"
-
 		### CLIP models set to none by default
 		self.clip_model = None
 		self.clip_preprocess = None
 
 		### Robot initializaton
-		if self.config["robot"].getboolean("use_robot"):
+		if self.config["robot"].getboolean("use_robot") and shard is None:
+			import bosdyn.client
+			import bosdyn.client.lease
+			import bosdyn.client.util
+			from bosdyn.client.image import ImageClient
+			from bosdyn.client.robot_command import RobotCommandClient
+			from bosdyn.client.robot_state import RobotStateClient
+			from bosdyn.client.manipulation_api_client import ManipulationApiClient
+
 			self.sdk = bosdyn.client.create_standard_sdk('NLMapSpot')
 			self.robot = self.sdk.create_robot(self.config["robot"]["hostname"])
 			bosdyn.client.util.authenticate(self.robot)
@@ -80,6 +111,7 @@ class NLMap():
 
 			#We only use the hand color
 			self.sources = ['hand_depth_in_hand_color_frame', 'hand_color_image']
+		self.startup_phases.mark("config and robot")
 
 		### Values set based on config parameters
 		self.data_dir_path = f"{self.config['paths']['data_dir_root']}/{self.config['dir_names']['data']}"
@@ -95,14 +127,25 @@ class NLMap():
 			except:
 				raise Exception(f"use_pose is true but no pose data found at {pose_path}")
 
+		### Depth frames are read through one shared LRU cache
+		self.depth_cache = DepthCache(self.data_dir_path, max_bytes=self.config["cache"].getint("depth_cache_mb", fallback=256)*2**20)
+
+		### Camera model used to localize detections, from intrinsics saved by get_intrinsics.py --save
+		self.camera = CameraModel.load_or_default(f"{self.data_dir_path}/{self.config['file_names'].get('intrinsics', fallback='intrinsics.json')}")
+
 		### Pointcloud initialization
-		if self.config["pointcloud"].getboolean("use_pointcloud"):
+		if self.config["pointcloud"].getboolean("use_pointcloud") and shard is None:
+			import open3d as o3d
+			from spot_utils.generate_pointcloud import make_pointcloud
+
 			pointcloud_path = f"{self.data_dir_path}/{self.config['file_names']['pointcloud']}"
 			if os.path.isfile(pointcloud_path):
 				self.pcd = o3d.io.read_point_cloud(pointcloud_path)
 			else:
 				#raise Exception(f"use_pointcloud is true but {pointcloud_path} does not exist. Implement GENERATE POINTCLOUD")
-				self.pcd = make_pointcloud(data_path=f"{self.data_dir_path}/",pose_data_fname=self.config["file_names"]["pose"], pointcloud_fname=self.config["file_names"]["pointcloud"])
+				self.pcd = make_pointcloud(data_path=f"{self.data_dir_path}/",pose_data_fname=self.config["file_names"]["pose"], pointcloud_fname=self.config["file_names"]["pointcloud"], voxel_size=self.config["pointcloud"].getfloat("voxel_size", fallback=0), visualize=False, camera=self.camera)
+
+		self.startup_phases.mark("pose, camera and pointcloud")
 
 		### Text initialization
 		self.category_names = [x.strip() for x in self.config["text"]["category_name_string"].split(';')]
@@ -114,244 +157,488 @@ class NLMap():
 		### Cache path
 		self.cache_path = f"{self.config['paths']['cache_dir']}/{self.config['dir_names']['data']}"
 	
-		### Compute text embeddings with CLIP 
-		self.cache_text_exists = os.path.isfile(f"{self.cache_path}_text")
+		### Compute text embeddings with CLIP, phrases already in the text embedding cache are not encoded again
+		self.text_cache = None
+		if self.config["cache"].getboolean("text"):
+			self.text_cache = TextEmbeddingCache(f"{self.config['paths']['cache_dir']}/{self.config['cache'].get('text_db', fallback='text_embeddings.sqlite')}", self.config["clip"]["model"])
+		self.text_features = self.embed_categories(self.categories)
 
-		#if text cache should be used and it exists, load it
-		if self.config["cache"].getboolean("text") and self.cache_text_exists:
-			self.text_features = pickle.load(open(f"{self.cache_path}_text","rb"))
-		else: #build new text embeddings
-			from vild.vild_utils import build_text_embedding
+		#the configured categories are also exported for tools that only read the cache: {cache}_text keeps its array of
+		#embeddings in category order (classify_*.py, get_best_clip_vild_dirs), {cache}_text_by_name maps category name
+		#to embedding (offline_nlmap_qwen3_demo.py)
+		if self.config["cache"].getboolean("text") and shard is None:
+			pickle.dump(self.text_features,open(f"{self.cache_path}_text","wb"))
+			pickle.dump(dict(zip(self.category_names, self.text_features)),open(f"{self.cache_path}_text_by_name","wb"))
 
-			#load CLIP model
-			self.clip_model, self.clip_preprocess = clip.load(self.config["clip"]["model"])
-
-			self.text_features = build_text_embedding(self.categories,self.clip_model,self.clip_preprocess,prompt_engineering=self.config["text"].getboolean("prompt_engineering"))
-
-			if self.config["cache"].getboolean("text"): #save the text cache
-				pickle.dump(self.text_features,open(f"{self.cache_path}_text","wb"))
+		self.startup_phases.mark("text embeddings")
 
 		### Image initialization
 		self.image_names = os.listdir(self.data_dir_path)
-		self.image_names = [image_name for image_name in self.image_names if "color" in image_name]
+		self.image_names = sorted([image_name for image_name in self.image_names if "color" in image_name])
+
+		### A shard builds (or resumes) its partial store and stops there
+		self.store_path = f"{self.cache_path}_store"
+		if shard is not None:
+			self.image_names = shard_frames(self.image_names, *shard)
+			self.store_path = shard_store_path(self.store_path, *shard)
+			if MapStore.exists(self.store_path) and self.store_matches_config(MapStore.open(self.store_path)):
+				self.store = self.update_map(MapStore.open(self.store_path))
+			else:
+				self.store = self.build_map(self.image_names)
+			if self.store.path is None:
+				self.store.save(self.store_path)
+			return
 
 		###########################################################################################################
 		######### Image embeddings
 
 		### Load cached image embeddings if they exist and are to be used, or make them otherwise
-		self.cache_image_exists = os.path.isfile(f"{self.config['paths']['cache_dir']}/{self.config['dir_names']['data']}_images_vild")
-
-		if self.config["cache"].getboolean("images") and self.cache_image_exists: #if image cache should be used and it exists, load it in
-			self.image2vectorvild_dir = pickle.load(open(f"{self.cache_path}_images_vild","rb"))
-			self.image2vectorclip_dir = pickle.load(open(f"{self.cache_path}_images_clip","rb"))
-
-			self.topk_vild_dir= pickle.load(open(f"{self.cache_path}_topk_vild","rb"))
-			self.topk_clip_dir = pickle.load(open(f"{self.cache_path}_topk_clip","rb"))
+		if self.config["cache"].getboolean("images") and not MapStore.exists(self.store_path) and os.path.isfile(f"{self.cache_path}_images_vild"):
+			print(f"Converting pickle image cache {self.cache_path}_images_vild into map store {self.store_path}")
+			convert_pickle_cache(self.cache_path, self.store_path, feat_dtype=self.config["cache"].get("feat_dtype", fallback="float16"))
+		self.cache_image_exists = MapStore.exists(self.store_path) and self.store_matches_config(MapStore.open(self.store_path))
+
+		if self.config["cache"].getboolean("images") and self.cache_image_exists: #if image cache should be used and it exists (and was built with these settings), load it in
+			self.store = MapStore.open(self.store_path)
+			if self.config["cache"].getboolean("incremental", fallback=True):
+				self.store = self.update_map(self.store)
 		else: #make image embeddings (either because you're not using cache, or because you don't have cache)
-			self.priority_queue_clip_dir = defaultdict(PriorityQueue) #keys will be category names. The priority will be negative score (since lowest gets dequeue) and items be image, anno_idx, and crop
-			self.priority_queue_vild_dir = defaultdict(PriorityQueue) #keys will be category names. The priority will be negative score (since lowest gets dequeue) and items be image, anno_idx, and crop
-
-			# Load ViLD model
-			import tensorflow.compat.v1 as tf
-			from vild.vild_utils import extract_roi_vild, paste_instance_masks
-
-			self.session = tf.Session(graph=tf.Graph())
-			_ = tf.saved_model.loader.load(self.session, ['serve'], self.config["paths"]["vild_dir"])
-
-			#load CLIP model
-			self.clip_model, self.clip_preprocess = clip.load(self.config["clip"]["model"])
-
-			params = self.config["vild"].getint("max_boxes_to_draw"),  self.config["vild"].getfloat("nms_threshold"),  self.config["vild"].getfloat("min_rpn_score_thresh"),  self.config["vild"].getfloat("min_box_area")
-
-			print("Computing image embeddings")
-			self.image2vectorvild_dir = {}
-			self.image2vectorclip_dir = {}
-			for image_name in tqdm(self.image_names):
-				image_path = f"{self.data_dir_path}/{image_name}"
-
-				image,image_height,image_width,valid_indices,detection_roi_scores,detection_boxes,detection_masks,detection_visual_feat,rescaled_detection_boxes  = extract_roi_vild(image_path,self.session,params)
-				self.image2vectorvild_dir[image_name] = [image,image_height,image_width,valid_indices,detection_roi_scores,detection_boxes,detection_masks,detection_visual_feat,rescaled_detection_boxes]
-			
-				### We only compute CLIP embeddings for vild crops that have highest score
-				### Compute detection scores, and rank results
-
-				raw_scores = detection_visual_feat.dot(self.text_features.T)
-
-				if self.config["vild"].getboolean("use_softmax"):
-					scores_all = softmax(temperature * raw_scores, axis=-1)
-				else:
-					scores_all = raw_scores
-
-				indices = np.argsort(-np.max(scores_all, axis=1))  # Results are ranked by scores
-
-				ymin, xmin, ymax, xmax = np.split(rescaled_detection_boxes, 4, axis=-1)
-				processed_boxes = np.concatenate([xmin, ymin, xmax - xmin, ymax - ymin], axis=-1)
-				segmentations = paste_instance_masks(detection_masks, processed_boxes, image_height, image_width)
-
-				overall_fig_size = [float(x) for x in self.config["viz"]["overall_fig_size"].split(",")]
-
-				if self.config["viz"].getboolean("boxes") or self.config["viz"].getboolean("save_whole_boxes"):
-					if len(indices) == 0:
-						if self.config["viz"].getboolean("boxes"):
-							display_image(np.array(image), size=overall_fig_size)
-						print('ViLD does not detect anything belong to the given category')
-
-					else:
-						image_with_detections = visualize_boxes_and_labels_on_image_array(
-						    np.array(image),
-						    rescaled_detection_boxes[indices],
-						    valid_indices[:self.config["vild"].getint("max_boxes_to_draw")][indices],
-						    detection_roi_scores[indices],    
-						    self.category_indices,
-						    instance_masks=segmentations[indices],
-						    use_normalized_coordinates=False,
-						    max_boxes_to_draw=self.config["vild"].getint("max_boxes_to_draw"),
-						    min_score_thresh=self.config["vild"].getfloat("min_rpn_score_thresh"),
-						    skip_scores=False,
-						    skip_labels=True)
-
-
-					plt.figure(figsize=overall_fig_size)
-					plt.imshow(image_with_detections)
-					plt.axis('off')
-					plt.title('Detected objects and RPN scores')
-					if self.config["viz"].getboolean("save_whole_boxes"):
-						plt.savefig(f"{self.figs_dir_path}/{image_name}_whole.jpg", bbox_inches='tight')
-					if self.config["viz"].getboolean("boxes"):
-						plt.show()
-					plt.close()
-
-				raw_image = np.array(image)
-				n_boxes = rescaled_detection_boxes.shape[0]
-
-				### image2vectorclip_dir[image_name] is a directory with annotations (crops) as keys
-				self.image2vectorclip_dir[image_name] = {}
-
-				### Go through the top crops
-				for anno_idx in indices[0:int(n_boxes)]:
-					rpn_score = detection_roi_scores[anno_idx]
-					bbox = rescaled_detection_boxes[anno_idx]
-					scores = scores_all[anno_idx]
-
-					y1, x1, y2, x2 = int(np.floor(bbox[0])), int(np.floor(bbox[1])), int(np.ceil(bbox[2])), int(np.ceil(bbox[3]))
-					crop = np.copy(raw_image[y1:y2, x1:x2, :])
-
-					### Add crop to priority queue for ranking scores for VILD
-					for idx, category_name in enumerate(self.category_names):
-						new_item = (-scores[idx], (image_name,anno_idx,crop,ymin[anno_idx],xmin[anno_idx],ymax[anno_idx],xmax[anno_idx]))
-						#print(category_name, image_name, anno_idx)
-						if new_item in self.priority_queue_vild_dir[category_name].queue:
-							raise Exception(f"{image_name} {anno_idx} already in queue for {category_name}")
-						self.priority_queue_vild_dir[category_name].put(new_item) #TODO: make this an object to more interpretable
-
-					### Run CLIP vision model on crop
-					crop_pil = Image.fromarray(crop)
-
-					#if (use cache and cache does not exist) or (cache image does not exist), process the data
-					if ((self.config["cache"].getboolean("images") and not self.cache_image_exists) or (not self.cache_image_exists)):
-						crop_fname = f"{self.cache_path}_{self.config['dir_names']['data']}_crop.jpeg"
-						crop_pil.save(crop_fname)
-						crop_back = Image.open(crop_fname)
-						crop_processed = self.clip_preprocess(crop_back).unsqueeze(0).to(device)
-						clip_image_features = self.clip_model.encode_image(crop_processed)
-
-						self.image2vectorclip_dir[image_name][anno_idx] = clip_image_features
-
-					clip_image_features = self.image2vectorclip_dir[image_name][anno_idx]
-
-					#Normalize clip_image_features before taking dot product with normalized text features
-					clip_image_features = clip_image_features / clip_image_features.norm(dim=1, keepdim=True)
-					clip_image_features = clip_image_features.cpu().detach().numpy()
-					clip_scores = clip_image_features.dot(self.text_features.T)
-
-					### Add crop to priority queue for ranking scores for CLIP
-					for idx, category_name in enumerate(self.category_names):
-						self.priority_queue_clip_dir[category_name].put((-clip_scores[0][idx], (image_name,anno_idx,crop,ymin[anno_idx],xmin[anno_idx],ymax[anno_idx],xmax[anno_idx]))) #TODO: make this an object to more interpretable
-
-					# TODO: fig_size_w and h are a little hardcoded, make more general?
-					fig_size_w = 35
-					fig_size_h = min(max(5, int(len(self.category_names) / 2.5) ), 10)
-
-					if self.config["viz"].getboolean("boxes") or self.config["viz"].getboolean("save_anno_boxes"):
-						img_w_mask = plot_mask(self.config["viz"]["mask_color"], self.config["viz"].getfloat("alpha"), raw_image, segmentations[anno_idx])
-						crop_w_mask = img_w_mask[y1:y2, x1:x2, :]
-
-						fig, axs = plt.subplots(1, 4, figsize=(fig_size_w, fig_size_h), gridspec_kw={'width_ratios': [3, 1, 1, 2]}, constrained_layout=True)
-
-						# Draw bounding box.
-						rect = patches.Rectangle((x1, y1), x2-x1, y2-y1, linewidth=self.config["viz"].getfloat("line_thickness"), edgecolor='r', facecolor='none')
-						axs[0].add_patch(rect)
-
-						axs[0].set_xticks([])
-						axs[0].set_yticks([])
-						axs[0].set_title(f'bbox: {y1, x1, y2, x2} area: {(y2 - y1) * (x2 - x1)} rpn score: {rpn_score:.4f}')
-
-						axs[0].imshow(raw_image)
-
-						# Draw image in a cropped region.
-						axs[1].set_xticks([])
-						axs[1].set_yticks([])
-
-						axs[1].set_title(f'predicted: {self.category_names[np.argmax(scores)]}')
-
-						axs[1].imshow(crop)
-
-						# Draw segmentation inside a cropped region.
-						axs[2].set_xticks([])
-						axs[2].set_yticks([])
-						axs[2].set_title('mask')
-
-						axs[2].imshow(crop_w_mask)
-
-						# Draw category scores.
-						fontsize = max(min(fig_size_h / float(len(self.category_names)) * 45, 20), 8)
-						for cat_idx in range(len(self.category_names)):
-						  axs[3].barh(cat_idx, scores[cat_idx], 
-						              color='orange' if scores[cat_idx] == max(scores) else 'blue')
-						axs[3].invert_yaxis()
-						axs[3].set_axisbelow(True)
-						axs[3].set_xlim(0, 1)
-						plt.xlabel("confidence score")
-						axs[3].set_yticks(range(len(self.category_names)))
-						axs[3].set_yticklabels(self.category_names, fontdict={
-						    'fontsize': fontsize})
-
-						if self.config["viz"].getboolean("save_anno_boxes"):
-							plt.savefig(f"{self.figs_dir_path}/{image_name}_anno_{anno_idx}.jpg", bbox_inches='tight')
-						if self.config["viz"].getboolean("boxes"):
-							plt.show()
-						plt.close()
-
-
-			if self.config["cache"].getboolean("images"):
-				pickle.dump(self.image2vectorvild_dir,open(f"{self.cache_path}_images_vild","wb"))
-				pickle.dump(self.image2vectorclip_dir,open(f"{self.cache_path}_images_clip","wb"))
-
-				### For priority queue, just get the top k results since PriorityQueue is not picklable
-				self.topk_vild_dir = {}
-				self.topk_clip_dir = {}
-				for category_name in self.category_names:
-					topk_vild_list = []
-					topk_clip_list = []
-					for k in range(self.config["fusion"].getint("top_k")):
-						top_k_item_vild = self.priority_queue_vild_dir[category_name].get()
-						top_k_item_clip = self.priority_queue_clip_dir[category_name].get()
-
-						topk_vild_list.append(top_k_item_vild)
-						topk_clip_list.append(top_k_item_clip)
-
-					self.topk_vild_dir[category_name] = topk_vild_list
-					self.topk_clip_dir[category_name] = topk_clip_list
+			self.store = self.build_map(self.image_names)
+		self.startup_phases.mark("map store")
 
-
-
-				pickle.dump(self.topk_vild_dir,open(f"{self.cache_path}_topk_vild","wb"))
-				pickle.dump(self.topk_clip_dir,open(f"{self.cache_path}_topk_clip","wb"))
+		### 3D object index over every detection, so position queries don't need depth frames
+		self.object_tree = None
+		self.instances = None
+		if self.config["pose"].getboolean("use_pose"):
+			self.build_object_index()
+		self.startup_phases.mark("object index")
+
+		### Rankings of the configured categories, computed on first access. Any other text can be ranked with query()
+		self.topk_vild_dir = CategoryQueries(self.query, self.category_names, "vild")
+		self.topk_clip_dir = CategoryQueries(self.query, self.category_names, "clip")
+
+	def load_build_models(self):
+		'''
+		Gets ViLD and CLIP for computing image embeddings from the model registry, which loads them on first use
+		'''
+		if getattr(self, "session", None) is None:
+			self.session = get_vild_session(self.config["paths"]["vild_dir"])
+
+		if self.clip_model == None:
+			self.clip_model, self.clip_preprocess = get_clip(self.config["clip"]["model"])
+
+	def build_params(self):
+		'''
+		Everything the stored ViLD/CLIP features depend on, recorded in the map store by build_map
+		'''
+		return {
+			"clip_model": self.config["clip"]["model"],
+			"vild_model": os.path.basename(os.path.normpath(self.config["paths"]["vild_dir"])),
+			"max_boxes_to_draw": self.config["vild"].getint("max_boxes_to_draw"),
+			"nms_threshold": self.config["vild"].getfloat("nms_threshold"),
+			"min_rpn_score_thresh": self.config["vild"].getfloat("min_rpn_score_thresh"),
+			"min_box_area": self.config["vild"].getfloat("min_box_area"),
+			"jpeg_roundtrip": self.config["clip"].getboolean("jpeg_roundtrip", fallback=False),
+		}
+
+	def store_matches_config(self, store):
+		'''
+		False if store was built with another CLIP model or other ViLD/crop settings than the config, so its rows
+		can't be reused or mixed with new ones. Stores converted from pickle caches don't know theirs and are trusted.
+		'''
+		if store.build_params is None or store.build_params == self.build_params():
+			return True
+		changed = [name for name in self.build_params() if store.build_params.get(name) != self.build_params()[name]]
+		print(f"Map store {store.path} was built with other settings ({', '.join(changed)}), rebuilding it")
+		return False
+
+	def update_map(self, store):
+		'''
+		Brings a cached map up to date with the color images in the data directory. Only new or changed frames
+		go through ViLD and CLIP, detections of unchanged frames are copied over and removed frames are dropped.
+		'''
+		unchanged, new, changed, removed = diff_frames(store, self.data_dir_path, self.image_names)
+		if len(new) == 0 and len(changed) == 0 and len(removed) == 0:
+			return store
+		print(f"Updating map: {len(new)} new, {len(changed)} changed, {len(removed)} removed frames")
+		return self.build_map(self.image_names, reuse_store=store, reusable_frames=unchanged)
+
+	def build_map(self, image_names, reuse_store=None, reusable_frames=None):
+		'''
+		Runs ViLD and CLIP over image_names and returns the resulting MapStore (saved to the cache if [cache]images)
+
+		reuse_store: optional existing MapStore to copy frames from
+		reusable_frames: image name -> (frame_idx in reuse_store, fingerprint) for frames that are copied instead of recomputed
+		'''
+		from vild.vild_utils import ViLDRunner
+		from nlmap_utils import encode_crops_clip, preprocess_crop
+		from map_viz import VizSettings, VizPipeline, make_record
+
+		if reusable_frames is None:
+			reusable_frames = {}
+		params = self.config["vild"].getint("max_boxes_to_draw"),  self.config["vild"].getfloat("nms_threshold"),  self.config["vild"].getfloat("min_rpn_score_thresh"),  self.config["vild"].getfloat("min_box_area")
+
+		viz_settings = VizSettings(self.config, self.category_names, self.category_indices, self.figs_dir_path)
+		viz_pipeline = VizPipeline(viz_settings) if viz_settings.enabled else None
+
+		jpeg_roundtrip = self.config["clip"].getboolean("jpeg_roundtrip", fallback=False)
+		clip_batch_size = self.config["clip"].getint("batch_size", fallback=32)
+
+		def decode_frame(vild_result):
+			'''
+			Decode stage: reads the image (unless ViLD's graph already returned it), ranks the detections, cuts out
+			and preprocesses the crops for CLIP
+			'''
+			image_path, (image,image_height,image_width,valid_indices,detection_roi_scores,detection_boxes,detection_masks,detection_visual_feat,rescaled_detection_boxes) = vild_result
+			if image is None:
+				image = np.asarray(Image.open(image_path).convert("RGB"))
+
+			### We only compute CLIP embeddings for vild crops that have highest score
+			### Compute detection scores, and rank results
+			raw_scores = detection_visual_feat.dot(self.text_features.T)
+
+			if self.config["vild"].getboolean("use_softmax"):
+				scores_all = softmax(temperature * raw_scores, axis=-1)
+			else:
+				scores_all = raw_scores
+
+			indices = np.argsort(-np.max(scores_all, axis=1))  # Results are ranked by scores
+
+			n_boxes = rescaled_detection_boxes.shape[0]
+
+			### Cut out the top crops
+			crops = {}
+			for anno_idx in indices[0:int(n_boxes)]:
+				bbox = rescaled_detection_boxes[anno_idx]
+				y1, x1, y2, x2 = int(np.floor(bbox[0])), int(np.floor(bbox[1])), int(np.ceil(bbox[2])), int(np.ceil(bbox[3]))
+				crops[anno_idx] = np.copy(image[y1:y2, x1:x2, :])
+
+			return {
+				"image_name": os.path.basename(image_path),
+				"fingerprint": frame_fingerprint(image_path),
+				"image": image,
+				"image_height": image_height,
+				"image_width": image_width,
+				"valid_indices": valid_indices,
+				"detection_roi_scores": detection_roi_scores,
+				"detection_masks": detection_masks,
+				"detection_visual_feat": detection_visual_feat,
+				"rescaled_detection_boxes": rescaled_detection_boxes,
+				"scores_all": scores_all,
+				"indices": indices,
+				"crop_indices": list(crops.keys()),
+				"crops_processed": [preprocess_crop(crop, self.clip_preprocess, jpeg_roundtrip=jpeg_roundtrip) for crop in crops.values()],
+			}
+
+		def embed_frame(frame):
+			'''
+			CLIP stage: runs the CLIP vision model on all crops of the frame in batches
+			'''
+			clip_image_features_all = encode_crops_clip(self.clip_model, frame.pop("crops_processed"), batch_size=clip_batch_size)
+			frame["clip_image_features"] = np.zeros((frame["rescaled_detection_boxes"].shape[0], clip_image_features_all.shape[1]), dtype=np.float32)
+			frame["clip_image_features"][frame["crop_indices"]] = clip_image_features_all.float().cpu().numpy()
+			return frame
+
+		### Frames that are not copied go through the staged pipeline: ViLD -> decode/crop workers -> CLIP -> indexing
+		### here, with bounded queues in between so decoding, TF and torch work overlap
+		pipeline = None
+		compute_paths = [f"{self.data_dir_path}/{image_name}" for image_name in image_names if image_name not in reusable_frames]
+		if len(compute_paths) > 0:
+			self.load_build_models()
+			vild_runner = ViLDRunner(self.session, params, batch_size=self.config["vild"].getint("batch_size", fallback=4), read_images=False)
+			pipeline = BuildPipeline(("vild", vild_runner.run(compute_paths)),
+			                         [("decode", decode_frame, self.config["build"].getint("decode_workers", fallback=4)),
+			                          ("clip", embed_frame, 1)],
+			                         max_pending=self.config["build"].getint("queue_size", fallback=8))
+			computed_frames = iter(pipeline)
+
+		print("Computing image embeddings")
+		store_writer = MapStoreWriter(feat_dtype=self.config["cache"].get("feat_dtype", fallback="float16"), build_params=self.build_params())
+		for image_name in tqdm(image_names):
+			if image_name in reusable_frames:
+				frame_idx, fingerprint = reusable_frames[image_name]
+				store_writer.copy_frame(reuse_store, frame_idx, frame_info=fingerprint)
+				continue
+
+			frame = next(computed_frames)
+
+			### Figures are drawn by the visualization stage, off the build loop
+			if viz_pipeline is not None:
+				viz_pipeline.submit(make_record(image_name, frame["image"], frame["valid_indices"], frame["detection_roi_scores"], frame["detection_masks"], frame["rescaled_detection_boxes"], frame["scores_all"], frame["indices"]))
+
+			store_writer.add_frame(image_name, frame["image_height"], frame["image_width"], frame["detection_roi_scores"], frame["rescaled_detection_boxes"], frame["detection_masks"], frame["detection_visual_feat"], frame["clip_image_features"], frame_info=frame["fingerprint"])
+
+		if viz_pipeline is not None:
+			viz_pipeline.close()
+		if pipeline is not None:
+			#runs the pipeline to its end so its threads exit and the stage timers are final
+			next(computed_frames, None)
+			vild_runner.close()
+			print(vild_runner.report())
+			print(pipeline.report())
+
+		store = store_writer.close(self.store_path if self.config["cache"].getboolean("images") else None)
+		#geometry copied from the previous map, so build_object_index only localizes the new frames
+		self.partial_geometry = store_writer.partial_geometry
+		return store
+
+	def embed_categories(self, categories):
+		'''
+		Returns the normalized CLIP text embeddings of categories ({'name': ...} dicts). CLIP is only loaded if
+		some of them are not in the text embedding cache
+		'''
+		from vild.vild_utils import build_text_embedding, text_templates, processed_name, article
+
+		prompt_engineering = self.config["text"].getboolean("prompt_engineering")
+		if self.clip_model == None:
+			templates = text_templates(prompt_engineering)
+			cached = [None]
+			if self.text_cache is not None:
+				cached = self.text_cache.get([self.text_cache.key(processed_name(category['name'], rm_dot=True), article(category['name']), templates, True) for category in categories])
+			if any(embedding is None for embedding in cached):
+				self.clip_model, self.clip_preprocess = get_clip(self.config["clip"]["model"])
+		return build_text_embedding(categories,self.clip_model,self.clip_preprocess,prompt_engineering=prompt_engineering,cache=self.text_cache)
+
+	def embed_text(self, text):
+		'''
+		Returns the normalized CLIP text embedding of text. Configured categories come from the text features
+		computed at startup, anything else from the text embedding cache or CLIP (loaded on first use)
+		'''
+		if text in self.category_names:
+			return self.text_features[self.category_names.index(text)]
+
+		return self.embed_categories([{'name': text, 'id': 1}])[0]
+
+	def score_rows(self, text, source="clip", instances=False):
+		'''
+		Returns the score of text against every detection in the map, see query for source.
+		If instances, returns the score of every object instance instead (see build_instances)
+		'''
+		text_embedding = self.embed_text(text).astype(np.float32)
+		features = self.instances if instances else self.store
+
+		if source == "clip":
+			return features["clip_feat"].dot(text_embedding)
+		elif source == "vild":
+			return features["vild_feat"].dot(text_embedding)
+		elif source == "fused":
+			return (features["clip_feat"].dot(text_embedding) + features["vild_feat"].dot(text_embedding)) / 2.0
+		raise Exception(f"query source must be one of clip, vild, fused, not {source}")
+
+	def query(self, text, k=None, source="clip"):
+		'''
+		Ranks every detection in the map against a free-text query
+
+		text: query, e.g. a category name
+		k: number of results, defaults to [fusion]top_k
+		source: 'clip' (CLIP crop embeddings), 'vild' (ViLD visual features) or 'fused' (mean of both scores)
+
+		returns a list of up to k items (-score, (image_name, anno_idx, crop, ymin, xmin, ymax, xmax)), best first.
+		If object instances are built, every item is a different instance, shown by its representative detection
+		'''
+		if k is None:
+			k = self.config["fusion"].getint("top_k")
+		if self.instances is not None:
+			scores = self.score_rows(text, source, instances=True)
+			top_instances = top_k_rows(scores, k)
+			top_rows, top_scores = self.instances["representative"][top_instances], scores[top_instances]
+		else:
+			scores = self.score_rows(text, source)
+			top_rows = top_k_rows(scores, k)
+			top_scores = scores[top_rows]
+
+		results = []
+		for row, score in zip(top_rows, top_scores):
+			ymin, xmin, ymax, xmax = np.split(np.array(self.store["boxes"][row]), 4)
+			results.append((-float(score), (self.store.image_name(row), int(self.store["anno_idx"][row]), self.store.crop(row, self.data_dir_path), ymin, xmin, ymax, xmax)))
+		return results
+
+	def localize(self, items):
+		'''
+		Localizes query results in vision frame, see localize_rows
+
+		items: list of (-score, (image_name, anno_idx, crop, ymin, xmin, ymax, xmax)) as returned by query
+		returns (centers, extents, rotations, valid), one row per item
+		'''
+		rows = [self.store.row(item[1][0], item[1][1]) for item in items]
+		return self.localize_rows(rows)
+
+	def localize_map(self, use_index=True):
+		'''
+		Localizes every detection in the map, returns (centers, extents, rotations, valid) with one row per store row
+		'''
+		return self.localize_rows(np.arange(len(self.store)), use_index=use_index)
+
+	def build_object_index(self, rebuild=False):
+		'''
+		Localizes every detection in the map once and stores its centroid, extent and orientation as map columns
+		next to the embeddings (on disk if the map is cached). A KD-tree over the located centroids serves where_is
+		and near without reading depth frames. Maps that already have these columns only get the KD-tree built, and
+		after an incremental update only the detections of new or changed frames are localized.
+		'''
+		from scipy.spatial import cKDTree
+
+		if rebuild or not self.store.has_geometry:
+			partial_geometry = getattr(self, "partial_geometry", None)
+			if rebuild or partial_geometry is None:
+				geometry = {"centroid": np.zeros((len(self.store), 3), dtype=np.float32), "extent": np.zeros((len(self.store), 3), dtype=np.float32),
+				            "orientation": np.zeros((len(self.store), 3, 3), dtype=np.float32), "located": np.zeros(len(self.store), dtype=bool)}
+				rows = np.arange(len(self.store))
+			else:
+				geometry, rows = partial_geometry
+			print(f"Localizing {len(rows)} of {len(self.store)} detections in 3D")
+			geometry["centroid"][rows], geometry["extent"][rows], geometry["orientation"][rows], geometry["located"][rows] = self.localize_rows(rows, use_index=False)
+			self.store.save_columns(geometry)
+			self.partial_geometry = None
+
+		self.located_rows = np.nonzero(np.asarray(self.store["located"]))[0]
+		self.object_tree = cKDTree(np.asarray(self.store["centroid"][self.located_rows], dtype=np.float64).reshape(-1, 3))
+
+		if self.config.getboolean("instances", "enabled", fallback=True):
+			self.build_instances(rebuild=rebuild or not self.store.has_instances)
+
+	def build_instances(self, rebuild=False):
+		'''
+		Merges detections of the same object seen in several frames into object instances (see
+		map_store.cluster_instances) and stores the instance of every detection as a map column. Every instance keeps
+		the mean of its members' ViLD/CLIP features, so its score is the mean score of its detections, the mean of
+		their centroids, and the member closest to the mean CLIP feature as its representative detection.
+		query, where_is and near then return distinct instances.
+		'''
+		from scipy.sparse import csr_matrix
+
+		if rebuild or not self.store.has_instances:
+			instance = cluster_instances(self.store["centroid"], self.store["clip_feat"], self.store["located"], self.store["frame_idx"], radius=self.config.getfloat("instances", "radius", fallback=0.3), min_similarity=self.config.getfloat("instances", "min_similarity", fallback=0.85))
+			self.store.save_columns({"instance": instance})
+
+		instance = np.asarray(self.store["instance"])
+		n = len(instance)
+		num_instances = int(instance.max()) + 1 if n > 0 else 0
+		counts = np.bincount(instance, minlength=num_instances).astype(np.float32)
+		membership = csr_matrix((np.ones(n, dtype=np.float32), (instance, np.arange(n))), shape=(num_instances, n))
+
+		self.instances = {"count": counts.astype(np.int64)}
+		for name in ["clip_feat", "vild_feat", "centroid"]:
+			self.instances[name] = membership.dot(np.asarray(self.store[name], dtype=np.float32)) / counts[:, None]
+
+		#representative detection: highest similarity to the instance mean, ties broken by the lowest row
+		similarity = np.einsum("nd,nd->n", np.asarray(self.store["clip_feat"], dtype=np.float32), self.instances["clip_feat"][instance])
+		order = np.lexsort((-similarity, instance))
+		first = np.cumsum(counts.astype(np.int64)) - counts.astype(np.int64)
+		self.instances["representative"] = order[first]
+		self.instances["located"] = np.asarray(self.store["located"])[self.instances["representative"]]
+		print(f"Merged {n} detections into {num_instances} object instances")
+
+	def describe_row(self, row, score=None):
+		'''
+		Returns a dict describing the detection in store row row, with its 3D geometry if the object index is built
+		'''
+		description = {"row": int(row), "image_name": self.store.image_name(row), "anno_idx": int(self.store["anno_idx"][row]), "box": np.array(self.store["boxes"][row])}
+		if score is not None:
+			description["score"] = float(score)
+		if self.store.has_geometry:
+			description["position"] = np.array(self.store["centroid"][row], dtype=np.float64)
+			description["extent"] = np.array(self.store["extent"][row], dtype=np.float64)
+			description["orientation"] = np.array(self.store["orientation"][row], dtype=np.float64)
+		return description
+
+	def where_is(self, text, k=None, source="clip"):
+		'''
+		Returns the k best located detections for text, best first, as describe_row dicts with a vision frame position.
+		With object instances, these are the k best instances: their representative detection with the instance
+		mean position, the instance id and its number of detections
+		'''
+		assert self.object_tree is not None, "where_is needs the object index, set use_pose = True"
+		if k is None:
+			k = self.config["fusion"].getint("top_k")
+		if self.instances is None:
+			scores = self.score_rows(text, source)[self.located_rows]
+			return [self.describe_row(self.located_rows[idx], scores[idx]) for idx in top_k_rows(scores, k)]
+
+		located_instances = np.nonzero(self.instances["located"])[0]
+		scores = self.score_rows(text, source, instances=True)[located_instances]
+		results = []
+		for idx in top_k_rows(scores, k):
+			instance = located_instances[idx]
+			description = self.describe_row(self.instances["representative"][instance], scores[idx])
+			description["position"] = self.instances["centroid"][instance].astype(np.float64)
+			description["instance"] = int(instance)
+			description["detections"] = int(self.instances["count"][instance])
+			results.append(description)
+		return results
+
+	def near(self, point, radius=1.0, k=None):
+		'''
+		Returns the located detections within radius (meters) of a vision frame point, closest first, as describe_row
+		dicts with their distance and the best matching configured category (label, label_score)
+
+		k: if given, at most the k closest detections are returned
+		'''
+		assert self.object_tree is not None, "near needs the object index, set use_pose = True"
+		point = np.asarray(point, dtype=np.float64).reshape(3)
+		idxs = np.array(self.object_tree.query_ball_point(point, radius), dtype=np.int64)
+		if len(idxs) == 0:
+			return []
+		distances = np.linalg.norm(self.object_tree.data[idxs] - point, axis=1)
+		order = np.argsort(distances)
+		if self.instances is not None:
+			#only the closest detection of every instance
+			_, first = np.unique(np.asarray(self.store["instance"])[self.located_rows[idxs[order]]], return_index=True)
+			order = order[np.sort(first)]
+		if k is not None:
+			order = order[:k]
+
+		rows = self.located_rows[idxs[order]]
+		label_scores = np.asarray(self.store["clip_feat"][rows], dtype=np.float32).dot(np.asarray(self.text_features, dtype=np.float32).T)
+
+		results = []
+		for row, distance, scores in zip(rows, distances[order], label_scores):
+			description = self.describe_row(row)
+			description["distance"] = float(distance)
+			description["label"] = self.category_names[int(np.argmax(scores))]
+			description["label_score"] = float(np.max(scores))
+			results.append(description)
+		return results
+
+	def localize_rows(self, rows, use_index=True, chunk_size=4096):
+		'''
+		Localizes store rows in vision frame. With [localization] mode = mask the depth under the ViLD mask of a
+		detection is used (spot_utils.camera.localize_masks), with mode = center only the box center pixel
+		(spot_utils.camera.localize_boxes). Once the object index is built, its stored geometry is returned instead.
+
+		chunk_size: rows localized at once. localize_masks holds several arrays of mask_h*mask_w points per row, so
+		localizing a whole map at once would need gigabytes
+
+		returns (centers, extents, rotations, valid): Nx3 centers, Nx3 extents, Nx3x3 box orientations and N bools
+		'''
+		rows = np.asarray(rows, dtype=np.int64)
+		if use_index and self.store.has_geometry:
+			return (np.asarray(self.store["centroid"][rows], dtype=np.float64), np.asarray(self.store["extent"][rows], dtype=np.float64),
+				np.asarray(self.store["orientation"][rows], dtype=np.float64), np.asarray(self.store["located"][rows]))
+
+		frame_numbers = np.array([frame_number(name) for name in self.store.frame_names], dtype=np.int64)
+		use_masks = self.config.get("localization", "mode", fallback="mask") == "mask"
+		inlier_range = self.config.getfloat("localization", "depth_inlier_range", fallback=0.25)
+
+		centers, extents, rotations, valid = np.zeros((len(rows), 3)), np.zeros((len(rows), 3)), np.tile(np.eye(3), (len(rows), 1, 1)), np.zeros(len(rows), dtype=bool)
+		for start in range(0, len(rows), chunk_size):
+			chunk = slice(start, start + chunk_size)
+			frame_ids = frame_numbers[np.asarray(self.store["frame_idx"][rows[chunk]])]
+			boxes = np.asarray(self.store["boxes"][rows[chunk]])
+			if use_masks:
+				centers[chunk], extents[chunk], rotations[chunk], valid[chunk] = localize_masks(boxes, self.store.masks[rows[chunk]], frame_ids, self.depth_cache.get, self.pose_dir, self.camera, inlier_range=inlier_range)
+			else:
+				centers[chunk], extents[chunk], valid[chunk] = localize_boxes(boxes, frame_ids, self.depth_cache.get, self.pose_dir, self.camera)
+		return centers, extents, rotations, valid
 
 	def viz_pointcloud(self):
+		import open3d as o3d
 		o3d.visualization.draw_geometries([self.pcd])
 
 	def viz_top_k(self,viz_2d=True,viz_pointcloud=True):
+		import matplotlib.pyplot as plt
+		import open3d as o3d
+
 		for category_name in self.category_names:
 			print(f"category: {category_name}")
 			top_axes = []
@@ -360,10 +647,11 @@ class NLMap():
 				fig, axs = plt.subplots(2, self.config["fusion"].getint("top_k"))
 				plt.suptitle(f"Query: {category_name}")
 
-			for k in range(self.config["fusion"].getint("top_k")):
-				top_k_item_vild = self.topk_vild_dir[category_name][k]
-				top_k_item_clip = self.topk_clip_dir[category_name][k]
+			#### Point cloud stuff
+			#### Just show CLIP for now!
+			centers, extents, rotations, valid = self.localize(self.topk_clip_dir[category_name])
 
+			for k, (top_k_item_vild, top_k_item_clip) in enumerate(zip(self.topk_vild_dir[category_name], self.topk_clip_dir[category_name])):
 				if viz_2d:
 
 					axs[0, k].set_title(f"ViLD score {top_k_item_vild[0]*-1:.3f}")
@@ -372,36 +660,14 @@ class NLMap():
 					axs[1, k].set_title(f"CLIP score {top_k_item_clip[0]*-1:.3f}")
 					axs[1, k].imshow(top_k_item_clip[1][2])
 
-				#### Point cloud stuff
-				#### Just show CLIP for now!
-				file_num = int(top_k_item_clip[1][0].split("_")[1].split(".")[0])
-				depth_img = pickle.load(open(f"{self.data_dir_path}/depth_{str(file_num)}","rb"))
-				rotation_matrix = self.pose_dir[file_num]['rotation_matrix']
-				position = self.pose_dir[file_num]['position']
-
-				ymin, xmin, ymax, xmax = top_k_item_clip[1][3:]
-
-				center_y = int((ymin + ymax)/2.0)
-				center_x = int((xmin + xmax)/2.0)
-
-				transformed_point,bad_point = pixel_to_vision_frame(center_y,center_x,depth_img,rotation_matrix,position)
-				side_pointx,_ = pixel_to_vision_frame_depth_provided(center_y,xmax,depth_img[center_y,center_x],rotation_matrix,position)
-				side_pointy,_ = pixel_to_vision_frame_depth_provided(ymax,center_x,depth_img[center_y,center_x],rotation_matrix,position)
-
-				#TODO: what should bb_size be for z? Right now, just making it same as x. Also needs to be axis aligned
-				bb_sizex = np.linalg.norm(transformed_point-side_pointx)[0]*2
-				bb_sizey = np.linalg.norm(transformed_point-side_pointy)[0]*2
-				
-
-
-				if bad_point:
+				if not valid[k]:
 					print(f"0 depth at the point for item {k} next bounding box")
 				else:
 					print(f"item {k} good inside {top_k_item_clip[1][0]}")
-					print(transformed_point)
-					bb = o3d.geometry.OrientedBoundingBox(center=np.array(transformed_point),R=np.array([[1,0,0],[0,1,0],[0,0,1]]), extent=np.array([bb_sizex,bb_sizex,bb_sizey]))
+					print(centers[k])
+					bb = o3d.geometry.OrientedBoundingBox(center=centers[k],R=rotations[k], extent=extents[k])
 					bb.color = [1,0,0]
-					axis_center = o3d.geometry.TriangleMesh.create_coordinate_frame(size=0.5,origin=transformed_point)
+					axis_center = o3d.geometry.TriangleMesh.create_coordinate_frame(size=0.5,origin=centers[k])
 					top_axes.append(bb)
 					top_axes.append(axis_center)
 
@@ -412,36 +678,22 @@ class NLMap():
 
 	def go_to_and_pick_top_k(self, category_name):
 		assert self.config["robot"].getboolean("use_robot")
+		import bosdyn.client.lease
+		import cv2
+		import matplotlib.pyplot as plt
+		from nlmap_utils import get_best_clip_vild_dirs
+		from spot_utils.utils import arm_object_grasp, open_gripper
+		from spot_utils.move_spot_to import move_to
+
 		with bosdyn.client.lease.LeaseKeepAlive(self.lease_client, must_acquire=True, return_at_exit=True):
 			best_pose = None
-			for k in range(self.config["fusion"].getint("top_k")):
-				top_k_item_vild = self.topk_vild_dir[category_name][k]
-				top_k_item_clip = self.topk_clip_dir[category_name][k]
-
-				#### Point cloud stuff
-				#### Just show CLIP for now!
-				file_num = int(top_k_item_clip[1][0].split("_")[1].split(".")[0])
-				depth_img = pickle.load(open(f"{self.data_dir_path}/depth_{str(file_num)}","rb"))
-				rotation_matrix = self.pose_dir[file_num]['rotation_matrix']
-				position = self.pose_dir[file_num]['position']
-
-				ymin, xmin, ymax, xmax = top_k_item_clip[1][3:]
-
-				center_y = int((ymin + ymax)/2.0)
-				center_x = int((xmin + xmax)/2.0)
-
-				transformed_point,bad_point = pixel_to_vision_frame(center_y,center_x,depth_img,rotation_matrix,position)
-				side_pointx,_ = pixel_to_vision_frame_depth_provided(center_y,xmax,depth_img[center_y,center_x],rotation_matrix,position)
-				side_pointy,_ = pixel_to_vision_frame_depth_provided(ymax,center_x,depth_img[center_y,center_x],rotation_matrix,position)
-
-				#TODO: what should bb_size be for z? Right now, just making it same as x. Also needs to be axis aligned
-				bb_sizex = np.linalg.norm(transformed_point-side_pointx)[0]*2
-				bb_sizey = np.linalg.norm(transformed_point-side_pointy)[0]*2
-				
-
-				if not bad_point:
+			#categories outside of the config are ranked on the fly
+			topk_clip_list = self.topk_clip_dir[category_name] if category_name in self.topk_clip_dir else self.query(category_name, source="clip")
+			centers, extents, rotations, valid = self.localize(topk_clip_list)
+			for k, top_k_item_clip in enumerate(topk_clip_list):
+				if valid[k]:
 					if type(best_pose) == type(None):
-						best_pose = transformed_point
+						best_pose = centers[k]
 
 						input(f"Go to {category_name} at location {best_pose} (hit enter)")
 
@@ -456,9 +708,9 @@ class NLMap():
 
 						cv2.imwrite("./tmp/color_curview_.jpg", cv_visual)
 
-						if self.clip_model == None: #Need to load in CLIP model to run on local image
-							self.clip_model, self.clip_preprocess = clip.load(self.config["clip"]["model"])
-						priority_queue_vild_dir_cur, priority_queue_clip_dir_cur = get_best_clip_vild_dirs(self.clip_model,self.clip_preprocess,["color_curview_.jpg"],"./tmp",cache_images=False,cache_text=False,cache_path=self.cache_path,img_dir_name="",category_names=[category_name],headless=True)
+						#models come from the registry, so only the first grasp pays for loading them
+						self.load_build_models()
+						priority_queue_vild_dir_cur, priority_queue_clip_dir_cur = get_best_clip_vild_dirs(self.clip_model,self.clip_preprocess,["color_curview_.jpg"],"./tmp",cache_images=False,cache_text=False,cache_path=self.cache_path,img_dir_name="",category_names=[category_name],headless=True,session=self.session)
 
 						#TODO: For now, just get top region and pick
 						top_k_item_vild = priority_queue_vild_dir_cur[category_name].get()
@@ -490,9 +742,14 @@ if __name__ == "__main__":
 	### Parse arguments from command line
 	parser = argparse.ArgumentParser()
 	parser.add_argument("-c","--config_path", help="Path to config file", type=str, default="./configs/example.ini")
+	parser.add_argument("--profile-startup", help="Print import and init time by module/phase and exit", action="store_true")
 	args = parser.parse_args()
 
 	nlmap = NLMap(args.config_path)
+	if args.profile_startup:
+		from startup_profile import startup_report
+		print(startup_report(nlmap.startup_phases))
+		sys.exit(0)
 
 	### Example things to do 
 	#nlmap.viz_pointcloud()
@@ -2,14 +2,68 @@ from collections import defaultdict
 from tqdm import tqdm
 import os
 import pickle
+import io
 import numpy as np
 
 from vild.vild_utils import *
+import torch
+from model_registry import get_clip, get_vild_session
 import math
-from queue import PriorityQueue
-import open3d as o3d
+import heapq
+import itertools
+
+class TopKAccumulator():
+	'''
+	Keeps the k best items pushed into it. Drop-in for the PriorityQueue usage in this repo: items are
+	(-score, (image_name, anno_idx, ...)) and get() returns the best remaining item first.
+
+	A put costs O(log k) and the heap is bounded by k. (image_name, anno_idx) must be unique among all items ever
+	put, including evicted ones, so only their keys are remembered beyond the k kept items.
+	'''
+	def __init__(self,k):
+		self.k = k
+		self.heap = [] #min-heap on score, so the worst kept item is at heap[0]
+		self.seen = set() #keys of every item ever put
+		self.counter = itertools.count() #tie breaker so equal scores never compare the items
+
+	def put(self,item):
+		score = -item[0]
+		key = (item[1][0],item[1][1])
+		if key in self.seen:
+			raise Exception(f"{key[0]} {key[1]} was already put")
+		self.seen.add(key)
+		if len(self.heap) < self.k:
+			heapq.heappush(self.heap,(score,next(self.counter),key,item))
+		elif score > self.heap[0][0]:
+			heapq.heapreplace(self.heap,(score,next(self.counter),key,item))
+
+	def get(self):
+		'''
+		Removes and returns the best remaining item. Raises an Exception if there is none (check empty() first)
+		'''
+		if len(self.heap) == 0:
+			raise Exception("get() on an empty TopKAccumulator")
+		best = max(range(len(self.heap)),key=lambda i: (self.heap[i][0],-self.heap[i][1]))
+		_,_,_,item = self.heap[best]
+		self.heap[best] = self.heap[-1]
+		self.heap.pop()
+		heapq.heapify(self.heap)
+		return item
+
+	def items(self):
+		return [entry[3] for entry in sorted(self.heap,key=lambda entry: (-entry[0],entry[1]))]
+
+	def qsize(self):
+		return len(self.heap)
+
+	def empty(self):
+		return len(self.heap) == 0
+
+def get_best_clip_vild_dirs(model,preprocess,img_names,img_dir_path,use_softmax=False,cache_images=True,cache_text=True,cache_path="./cache/",img_dir_name=None,category_names=None,headless=False,jpeg_roundtrip=False,top_k=5,session=None,saved_model_dir="./vild/image_path_v2"):
+	from matplotlib import pyplot as plt
+	from matplotlib import patches
+	from scipy.special import softmax
 
-def get_best_clip_vild_dirs(model,preprocess,img_names,img_dir_path,use_softmax=False,cache_images=True,cache_text=True,cache_path="./cache/",img_dir_name=None,category_names=None,headless=False):
 	#################################################################
 	#Lots of hyperparameters, make more general TODO
 	overall_fig_size = (18, 24)
@@ -26,13 +80,11 @@ def get_best_clip_vild_dirs(model,preprocess,img_names,img_dir_path,use_softmax=
 	fig_size_w = 35
 	line_thickness = 2
 
-	saved_model_dir = "./vild/image_path_v2"
-
 	#################################################################
-	# load model for clip image embeddings on crops
-	device = "cuda" if torch.cuda.is_available() else "cpu"
-	print(f"Models: {clip.available_models()}")
-	model, preprocess = clip.load("ViT-B/32", device=device)
+	# model for clip image embeddings on crops, the shared ViT-B/32 if none is given
+	if model is None:
+		model, preprocess = get_clip("ViT-B/32")
+	device = next(model.parameters()).device
 
 	#################################################################
 	# text stuff
@@ -46,7 +98,8 @@ def get_best_clip_vild_dirs(model,preprocess,img_names,img_dir_path,use_softmax=
 			text_features = pickle.load(open(cache_path+img_dir_name+"_text","rb"))
 	else:
 			text_features = build_text_embedding(categories,model,preprocess)
-			pickle.dump(text_features,open(cache_path+img_dir_name+"_text","wb"))
+			if cache_text:
+				pickle.dump(text_features,open(cache_path+img_dir_name+"_text","wb"))
 
 	#################################################################
 	# check if cache exists
@@ -59,16 +112,14 @@ def get_best_clip_vild_dirs(model,preprocess,img_names,img_dir_path,use_softmax=
 		else:
 			img2vectorvild_dir = {}
 			img2vectorclip_dir = {}
-		session = None
-	if not cache_img_exists or not cache_images:
-		# Load ViLD model
-		session = tf.Session(graph=tf.Graph())
-		_ = tf.saved_model.loader.load(session, ['serve'], saved_model_dir)
+	if (not cache_img_exists or not cache_images) and session is None:
+		# ViLD model, loaded once per process
+		session = get_vild_session(saved_model_dir)
 
 	#################################################################
 
-	priority_queue_clip_dir = defaultdict(lambda: PriorityQueue()) #keys will be category names. The priority will be negative score (since lowest gets dequeue) and items be image, anno_idx, and crop
-	priority_queue_vild_dir = defaultdict(lambda: PriorityQueue()) #keys will be category names. The priority will be negative score (since lowest gets dequeue) and items be image, anno_idx, and crop
+	priority_queue_clip_dir = defaultdict(lambda: TopKAccumulator(top_k)) #keys will be category names. The priority will be negative score (since lowest gets dequeue) and items be image, anno_idx, and crop
+	priority_queue_vild_dir = defaultdict(lambda: TopKAccumulator(top_k)) #keys will be category names. The priority will be negative score (since lowest gets dequeue) and items be image, anno_idx, and crop
 	for img_name in tqdm(img_names):
 		image_path = img_dir_path + "/" + img_name
 		#print(image_path)
@@ -102,7 +153,7 @@ def get_best_clip_vild_dirs(model,preprocess,img_names,img_dir_path,use_softmax=
 		# Plot detected boxes on the input image.
 		ymin, xmin, ymax, xmax = np.split(rescaled_detection_boxes, 4, axis=-1)
 		processed_boxes = np.concatenate([xmin, ymin, xmax - xmin, ymax - ymin], axis=-1)
-		segmentations = paste_instance_masks(detection_masks, processed_boxes, image_height, image_width)
+		segmentations = crop_instance_masks(detection_masks, processed_boxes, image_height, image_width)
 
 		if len(indices_fg) == 0 and not headless:
 			display_image(np.array(image), size=overall_fig_size)
@@ -153,17 +204,11 @@ def get_best_clip_vild_dirs(model,preprocess,img_names,img_dir_path,use_softmax=
 			for idx, category_name in enumerate(category_names):
 				new_item = (-scores[idx], (img_name,anno_idx,crop,ymin[anno_idx],xmin[anno_idx],ymax[anno_idx],xmax[anno_idx]))
 				#print(category_name, img_name, anno_idx)
-				if new_item in priority_queue_vild_dir[category_name].queue:
-					raise Exception(f"{img_name} {anno_idx} already in queue for {category_name}")
 				priority_queue_vild_dir[category_name].put(new_item) #TODO: make this an object to more interpretable
 
 
-			#crop_processed = np.moveaxis(crop, -1, 0)
-			crop_pil = Image.fromarray(crop)
 			if cache_images and not cache_img_exists:
-				crop_pil.save("./cache/"+img_dir_name+"_crop.jpeg")
-				crop_back = Image.open("./cache/"+img_dir_name+"_crop.jpeg")
-				crop_processed = preprocess(crop_back).unsqueeze(0).to(device)
+				crop_processed = preprocess_crop(crop,preprocess,jpeg_roundtrip=jpeg_roundtrip).unsqueeze(0).to(device)
 				clip_image_features = model.encode_image(crop_processed)
 
 				img2vectorclip_dir[img_name][anno_idx] = clip_image_features
@@ -171,9 +216,7 @@ def get_best_clip_vild_dirs(model,preprocess,img_names,img_dir_path,use_softmax=
 			elif cache_images:
 				clip_image_features = img2vectorclip_dir[img_name][anno_idx]
 			else:
-				crop_pil.save("./cache/"+img_dir_name+"_crop.jpeg")
-				crop_back = Image.open("./cache/"+img_dir_name+"_crop.jpeg")
-				crop_processed = preprocess(crop_back).unsqueeze(0).to(device)
+				crop_processed = preprocess_crop(crop,preprocess,jpeg_roundtrip=jpeg_roundtrip).unsqueeze(0).to(device)
 				clip_image_features = model.encode_image(crop_processed)
 
 			#Normalize clip_image_features before taking dot product with normalized text features
@@ -242,4 +285,43 @@ def get_best_clip_vild_dirs(model,preprocess,img_names,img_dir_path,use_softmax=
 		pickle.dump(img2vectorvild_dir,open(cache_path+img_dir_name+"_images_vild","wb"))
 		pickle.dump(img2vectorclip_dir,open(cache_path+img_dir_name+"_images_clip","wb"))
 
-	return(priority_queue_vild_dir, priority_queue_clip_dir)
\ No newline at end of file
+	return(priority_queue_vild_dir, priority_queue_clip_dir)
+
+def preprocess_crop(crop,preprocess,jpeg_roundtrip=False):
+	'''
+	Preprocesses an HxWx3 uint8 crop for CLIP without touching the disk
+
+	crop: numpy crop of the RGB image
+	preprocess: CLIP preprocess transform
+	jpeg_roundtrip: if True, JPEG encode and decode the crop in memory first. This reproduces the
+		embeddings of the old path that saved every crop to a _crop.jpeg file bit for bit
+
+	returns a 3xHxW tensor
+	'''
+	crop_pil = Image.fromarray(crop)
+	if jpeg_roundtrip:
+		buffer = io.BytesIO()
+		crop_pil.save(buffer,format="JPEG")
+		buffer.seek(0)
+		crop_pil = Image.open(buffer)
+	return preprocess(crop_pil)
+
+def encode_crops_clip(model,crops_processed,batch_size=32):
+	'''
+	Runs the CLIP visual encoder over preprocessed crops in fixed-size batches
+
+	model: CLIP model
+	crops_processed: list of preprocessed crops, each a 3xHxW tensor
+	batch_size: number of crops encoded per forward pass
+
+	returns an NxD tensor of (unnormalized) CLIP image features, row i belongs to crops_processed[i]
+	'''
+	device = next(model.parameters()).device
+	features = []
+	with torch.no_grad():
+		for start in range(0,len(crops_processed),batch_size):
+			batch = torch.stack(crops_processed[start:start+batch_size]).to(device)
+			features.append(model.encode_image(batch))
+	if len(features) == 0:
+		return torch.zeros((0,model.visual.output_dim),device=device)
+	return torch.cat(features,dim=0)
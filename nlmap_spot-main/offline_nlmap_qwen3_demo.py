@@ -17,7 +17,8 @@ from typing import List, Dict, Tuple
 # 添加当前目录到Python路径
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from saycan_qwen3 import Qwen3ObjectProposer
+from model_registry import get_qwen3
+from map_store import MapStore
 
 class OfflineNLMapDataExtractor:
     """从离线数据集中提取物品清单和位置信息"""
@@ -41,6 +42,8 @@ class OfflineNLMapDataExtractor:
         
         data_dir_root = self.config.get('paths', 'data_dir_root')
         self.data_dir = os.path.join(data_dir_root, data_name)
+        # NLMap缓存前缀，地图存储在{cache_path}_store，按类别名的文本特征在{cache_path}_text_by_name
+        self.cache_path = f"{self.config.get('paths', 'cache_dir')}/{data_name}"
         if not os.path.exists(self.data_dir):
             raise FileNotFoundError(f"数据目录不存在: {self.data_dir}")
         
@@ -73,8 +76,61 @@ class OfflineNLMapDataExtractor:
         print(f"✓ 发现 {len(color_files)} 个彩色图像文件")
         return color_files
     
+    def extract_object_inventory_from_map(self) -> Dict[str, Dict]:
+        """从NLMap地图存储中提取物品清单和真实3D位置（需要先运行nlmap.py建立3D物体索引）"""
+        store_path = f"{self.cache_path}_store"
+        text_path = f"{self.cache_path}_text_by_name"
+        if not MapStore.exists(store_path) or not os.path.isfile(text_path):
+            print(f"⚠ 未找到NLMap地图存储或文本特征缓存: {store_path}")
+            return {}
+        store = MapStore.open(store_path)
+        if not store.has_geometry:
+            print("⚠ 地图存储中没有3D物体索引，请先在use_pose = True时运行nlmap.py")
+            return {}
+
+        # nlmap.py按类别名导出文本特征，缺少的类别说明缓存是用其他配置生成的
+        with open(text_path, 'rb') as f:
+            text_features_by_name = pickle.load(f)
+        missing = [category for category in self.categories if not isinstance(text_features_by_name, dict) or category not in text_features_by_name]
+        if missing:
+            print(f"⚠ 文本特征缓存中缺少类别 {missing}，请用当前配置重新运行nlmap.py")
+            return {}
+        text_features = np.stack([np.asarray(text_features_by_name[category], dtype=np.float32) for category in self.categories])
+
+        # 每个类别取CLIP得分最高的已定位检测
+        located_rows = np.nonzero(np.asarray(store['located']))[0]
+        if len(located_rows) == 0:
+            return {}
+        scores = np.asarray(store['clip_feat'][located_rows], dtype=np.float32).dot(text_features.T)
+
+        object_inventory = {}
+        for i, category in enumerate(self.categories):
+            best = int(np.argmax(scores[:, i]))
+            row = int(located_rows[best])
+            image_file = store.image_name(row)
+            ymin, xmin, ymax, xmax = [float(x) for x in store['boxes'][row]]
+            object_inventory[category] = {
+                'position': [float(x) for x in store['centroid'][row]],
+                'image_file': image_file,
+                'image_id': image_file.replace('color_', '').replace('.jpg', ''),
+                'confidence': float(scores[best, i]),
+                'bounding_box': {
+                    'x': int(xmin),
+                    'y': int(ymin),
+                    'width': int(xmax - xmin),
+                    'height': int(ymax - ymin)
+                }
+            }
+
+        print(f"✓ 从NLMap地图提取物品清单: {len(object_inventory)} 个物品")
+        return object_inventory
+
     def extract_object_inventory(self) -> Dict[str, Dict]:
-        """提取物品清单和模拟位置信息"""
+        """提取物品清单和位置信息，优先使用NLMap地图中的真实位置，没有地图时使用模拟位置"""
+        object_inventory = self.extract_object_inventory_from_map()
+        if object_inventory:
+            return object_inventory
+
         pose_data = self.load_pose_data()
         image_files = self.scan_image_files()
         
@@ -148,7 +204,7 @@ class InteractiveQwen3Interface:
     """交互式Qwen3物品提议界面"""
     
     def __init__(self, inventory_file: str):
-        self.qwen3_proposer = Qwen3ObjectProposer()
+        self.qwen3_proposer = get_qwen3()
         
         # 加载物品清单
         with open(inventory_file, 'r', encoding='utf-8') as f:
@@ -1,8 +1,16 @@
 from vild.vild_utils import *
+import torch
+import clip
+import tensorflow.compat.v1 as tf
+from matplotlib import pyplot as plt
+from matplotlib import patches
+from scipy.special import softmax
+from PIL import Image
 import pickle
 import os
 import open3d as o3d
 from spot_utils.utils import pixel_to_vision_frame
+from spot_utils.depth_io import load_depth
 
 #################################################################
 # Hyperparameters and general initialization
@@ -126,7 +134,7 @@ for img_name in img_names:
 	# Plot detected boxes on the input image.
 	ymin, xmin, ymax, xmax = np.split(rescaled_detection_boxes, 4, axis=-1)
 	processed_boxes = np.concatenate([xmin, ymin, xmax - xmin, ymax - ymin], axis=-1)
-	segmentations = paste_instance_masks(detection_masks, processed_boxes, image_height, image_width)
+	segmentations = crop_instance_masks(detection_masks, processed_boxes, image_height, image_width)
 
 	if len(indices_fg) == 0:
 		display_image(np.array(image), size=overall_fig_size)
@@ -249,7 +257,7 @@ for img_name in img_names:
 
 		#### Point cloud visualization
 		file_num = int(img_name.split("_")[-1].split(".")[0])
-		depth_img = pickle.load(open(img_dir_root_path+img_dir_name+"/depth_"+str(file_num),"rb"))
+		depth_img = load_depth(img_dir_root_path+img_dir_name,file_num)
 		rotation_matrix = pose_dir[file_num]['rotation_matrix']
 		position = pose_dir[file_num]['position']
 		transformed_point,bad_point = pixel_to_vision_frame(center_y,center_x,depth_img,rotation_matrix,position)
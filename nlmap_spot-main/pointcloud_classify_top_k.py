@@ -1,4 +1,11 @@
 from vild.vild_utils import *
+import torch
+import clip
+import tensorflow.compat.v1 as tf
+from matplotlib import pyplot as plt
+from matplotlib import patches
+from scipy.special import softmax
+from PIL import Image
 import pickle
 import os
 from collections import defaultdict
@@ -7,6 +14,7 @@ from queue import PriorityQueue
 from tqdm import tqdm
 import open3d as o3d
 from spot_utils.utils import pixel_to_vision_frame, pixel_to_vision_frame_depth_provided
+from spot_utils.depth_io import load_depth
 
 
 #################################################################
@@ -140,7 +148,7 @@ for img_name in tqdm(img_names):
 	# Plot detected boxes on the input image.
 	ymin, xmin, ymax, xmax = np.split(rescaled_detection_boxes, 4, axis=-1)
 	processed_boxes = np.concatenate([xmin, ymin, xmax - xmin, ymax - ymin], axis=-1)
-	segmentations = paste_instance_masks(detection_masks, processed_boxes, image_height, image_width)
+	segmentations = crop_instance_masks(detection_masks, processed_boxes, image_height, image_width)
 
 	if len(indices_fg) == 0 and not headless:
 		display_image(np.array(image), size=overall_fig_size)
@@ -298,7 +306,7 @@ for category_name in category_names:
 		#### Point cloud stuff
 		#### Just show CLIP for now!
 		file_num = int(top_k_item_clip[1][0].split("_")[1].split(".")[0])
-		depth_img = pickle.load(open(img_dir_root_path+img_dir_name+"/depth_"+str(file_num),"rb"))
+		depth_img = load_depth(img_dir_root_path+img_dir_name,file_num)
 		rotation_matrix = pose_dir[file_num]['rotation_matrix']
 		position = pose_dir[file_num]['position']
 
@@ -5,8 +5,12 @@ SayCan with Qwen3-4B Integration
 使用本地部署的Qwen3-4B替代闭源LLM进行对象提议
 """
 
+import hashlib
 import os
+import pickle
 import re
+import threading
+import time
 import warnings
 
 # 设置环境变量以避免事件循环冲突
@@ -15,15 +19,104 @@ warnings.filterwarnings('ignore')
 
 try:
     import torch
-    from transformers import AutoModelForCausalLM, AutoTokenizer
+    import transformers
+    from transformers import AutoModelForCausalLM, AutoTokenizer, DynamicCache
 except ImportError as e:
     print(f"导入错误: {e}")
     raise e
 
+from model_registry import get_qwen3
+
+# 对象提议的上下文学习示例，所有查询共享这一前缀，只有最后的任务行不同
+IN_CONTEXT_LEARNING = """The task 'hold the snickers' may involve the following objects: snickers.
+The task 'wipe the table' may involve the following objects: table, napkin, sponge, towel, cloth.
+The task 'put a water bottle and an oatmeal next to the microwave' may involve the following objects: water bottle, oatmeal, microwave.
+The task 'place the mug in the cardboard box' may involve the following objects: mug, cardboard box.
+The task 'go to the fridge' may involve the following objects: fridge.
+The task 'put a grapefruit from the table into the bowl' may involve the following objects: grapefruit, table, bowl.
+The task 'can you open the glass jar' may involve the following objects: glass jar.
+The task 'heat up the taco and bring it to me' may involve the following objects: taco, human, microwave oven, fridge.
+The task 'hold the fancy plate with flower pattern' may involve the following objects: fancy plate with flower pattern.
+The task 'put the fruits in the fridge' may involve the following objects: fridge, apple, orange, banana, peach, grape, blueberry.
+The task 'get a sponge from the counter and put it in the sink' may involve the following objects: sponge, counter, sink.
+The task 'empty the water bottle' may involve the following objects: water bottle, sink.
+The task 'i am hungry, give me something to eat' may involve the following objects: human, candy, snickers, chips, apple, banana, orange.
+The task 'go to the trash can for bottles' may involve the following objects: trash can for bottles.
+The task 'put the apple in the basket and close the door' may involve the following objects: apple, basket, door.
+The task 'help me make a cup of coffee' may involve the following objects: cup, coffee, mug, coffee machine.
+The task 'check what time is it now' may involve the following objects: clock, watch.
+The task 'let go of the banana' may involve the following objects: banana, trash can.
+The task 'put the grapes in the bowl and then move the cheese to the table' may involve the following objects: grape, bowl, cheese, table.
+The task 'find a coffee machine' may involve the following objects: coffee machine.
+The task 'clean the kitchen' may involve the following objects: kitchen, sink, sponge, towel, soap, counter, stove, dishwasher.
+The task 'prepare breakfast' may involve the following objects: bread, toaster, butter, jam, plate, knife, milk, cereal, bowl.
+The task 'water the plants' may involve the following objects: plants, watering can, water, pot, soil.
+The task 'turn on the lights' may involve the following objects: light switch, lamp, bulb.
+The task 'set the table for dinner' may involve the following objects: table, plate, fork, knife, spoon, napkin, glass, chair.
+The task 'do the laundry' may involve the following objects: washing machine, clothes, detergent, basket, dryer.
+The task 'vacuum the living room' may involve the following objects: vacuum cleaner, living room, carpet, sofa, floor, wall, ceiling.
+The task 'organize the bookshelf' may involve the following objects: bookshelf, books, shelf, organizer, picture.
+The task 'feed the pet' may involve the following objects: pet, food bowl, pet food, water bowl, water.
+The task 'charge my phone' may involve the following objects: phone, charger, outlet, cable.
+The task 'take out the garbage' may involve the following objects: garbage bag, trash can, garbage bin, bottle, paper.
+The task 'wash the dishes' may involve the following objects: dishes, sink, soap, sponge, towel, plate, cup, mug, bowl, water.
+The task 'make the bed' may involve the following objects: bed, pillow, blanket, sheet, mattress.
+The task 'open the window' may involve the following objects: window, curtain, blinds.
+The task 'lock the door' may involve the following objects: door, key, lock.
+The task 'turn off the TV' may involve the following objects: TV, remote control, power button, monitor.
+The task 'put on my shoes' may involve the following objects: shoes, socks, shoelace, bag.
+The task 'brush my teeth' may involve the following objects: toothbrush, toothpaste, sink, mirror, cup, water.
+The task 'cook pasta' may involve the following objects: pasta, pot, water, stove, salt, sauce, plate, table.
+The task 'read a book' may involve the following objects: book, chair, lamp, glasses, bookmark, table.
+The task 'listen to music' may involve the following objects: speaker, phone, headphones, music player.
+The task 'study at desk' may involve the following objects: desk, chair, book, laptop, pen, paper, lamp, keyboard, mouse.
+The task 'decorate the room' may involve the following objects: picture, plant, lamp, wall, floor, ceiling, window.
+The task 'check the time' may involve the following objects: clock, phone, watch, wall.
+The task 'seal a package' may involve the following objects: tape, box, paper, scissors.
+The task 'take notes' may involve the following objects: pen, paper, notebook, laptop, keyboard, mouse, table.
+The task 'water the plants' may involve the following objects: plant, water, bottle.
+The task 'adjust room lighting' may involve the following objects: lamp, light switch, ceiling, wall.
+The task 'organize workspace' may involve the following objects: desk, chair, laptop, keyboard, mouse, monitor, pen, paper, book.
+
+The task '帮我准备咖啡' may involve the following objects: coffee machine, cup, mug, coffee beans, water, sugar, milk.
+The task '清理厨房桌子' may involve the following objects: table, sponge, towel, cloth, soap, cleaning spray, bottle.
+The task '准备简单早餐' may involve the following objects: bread, toaster, butter, jam, plate, knife, milk, cereal, bowl, egg, pan, table, cup, mug.
+The task '洗碗收拾餐具' may involve the following objects: dishes, sink, soap, sponge, towel, plate, cup, mug, bowl, fork, knife, spoon, water.
+The task '制作水果沙拉' may involve the following objects: apple, banana, orange, grape, bowl, knife, cutting board, spoon, table.
+The task '整理客厅桌子' may involve the following objects: coffee table, magazine, book, remote control, tissue box, decorative item, lamp, plant, picture.
+The task '打开电视看新闻' may involve the following objects: tv, remote control, sofa, chair, monitor.
+The task '调节客厅灯光' may involve the following objects: lamp, light switch, remote control, dimmer, ceiling.
+The task '收拾沙发上的物品' may involve the following objects: sofa, cushion, blanket, book, magazine, remote control, phone, laptop.
+The task '给植物浇水' may involve the following objects: plant, watering can, water, pot, soil, bottle.
+The task '整理办公桌' may involve the following objects: desk, paper, pen, pencil, notebook, folder, stapler, calculator, laptop, keyboard, mouse, monitor, phone.
+The task '打印重要文件' may involve the following objects: printer, paper, computer, document, folder, laptop, keyboard, mouse.
+The task '准备会议材料' may involve the following objects: paper, pen, notebook, folder, whiteboard, marker, projector, laptop, keyboard, mouse, table, chair.
+The task '清空垃圾桶' may involve the following objects: trash can, garbage bag, waste, bottle, paper.
+The task '整理文件夹' may involve the following objects: folder, paper, document, filing cabinet, desk, pen.
+The task '整理床铺' may involve the following objects: bed, pillow, blanket, sheet, mattress, floor.
+The task '收拾衣物' may involve the following objects: clothes, wardrobe, hangers, laundry basket, shoes, bag.
+The task '设置闹钟' may involve the following objects: alarm clock, phone, nightstand, table.
+The task '关闭窗帘' may involve the following objects: curtain, window, blinds, wall.
+The task '准备睡前用品' may involve the following objects: pillow, blanket, water glass, book, phone, charger, tissue, table, lamp.
+The task '封装包裹' may involve the following objects: tape, box, paper, scissors, table.
+The task '记录笔记' may involve the following objects: pen, paper, notebook, laptop, keyboard, mouse, table, chair.
+The task '查看时间' may involve the following objects: clock, phone, watch, wall.
+The task '调整房间布局' may involve the following objects: chair, table, sofa, lamp, plant, picture, wall, floor, ceiling.
+The task '整理书籍' may involve the following objects: book, bookshelf, table, desk, bag, paper.
+The task '充电设备' may involve the following objects: phone, laptop, charger, cable, outlet, table.
+The task '装饰墙面' may involve the following objects: picture, wall, tape, plant, clock.
+The task '清洁地板' may involve the following objects: floor, mop, water, cleaning spray, bottle.
+"""
+
+# 前缀KV缓存的保存目录，为空时不保存到磁盘（4B模型在CPU上每千个前缀token约占300MB）
+PREFIX_CACHE_DIR = os.environ.get("QWEN3_PREFIX_CACHE_DIR")
+
 class Qwen3ObjectProposer:
-    def __init__(self, model_path=None):
+    def __init__(self, model_path=None, prefix_cache_dir=PREFIX_CACHE_DIR):
         """
         初始化Qwen3对象提议器
+
+        prefix_cache_dir: 前缀KV缓存的保存目录，为None时每次启动重新预填充前缀
         """
         if model_path is None:
             model_path = "c:/Users/91954/Desktop/个人/课程/robot_nav/final_project/Qwen3-main/Qwen3-models"
@@ -77,6 +170,61 @@ class Qwen3ObjectProposer:
             except Exception as cpu_e:
                 print(f"❌ CPU模式下模型加载也失败: {str(cpu_e)}")
                 raise cpu_e
+
+        # 上下文学习前缀只预填充一次，之后每次查询只需预填充任务行
+        # 所有查询共用同一份前缀缓存，generate会临时往里追加token，因此使用缓存的查询由prefix_lock串行执行；
+        # 并发查询时它们会排队，不能同时生成（不以前缀开头的提示不加锁）
+        self.prefix_lock = threading.Lock()
+        self.prefix_cache_dir = prefix_cache_dir
+        self.prefix_ids = None
+        self.prefix_cache = None
+        self.prepare_prefix_cache(IN_CONTEXT_LEARNING)
+
+    def prefix_cache_path(self, prefix):
+        """
+        前缀KV缓存文件路径，由模型路径、前缀文本、数据类型、设备和transformers版本决定
+        """
+        key = "\n".join([os.path.abspath(self.model_path), str(self.model.dtype), str(self.model.device), transformers.__version__, prefix])
+        return os.path.join(self.prefix_cache_dir, f"qwen3_prefix_{hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]}.pt")
+
+    def prepare_prefix_cache(self, prefix):
+        """
+        预填充prefix并保留其past_key_values；设置了prefix_cache_dir时从磁盘加载或保存到磁盘
+        """
+        prefix_ids = self.tokenizer(prefix, return_tensors="pt")["input_ids"].to(self.model.device)
+        path = self.prefix_cache_path(prefix) if self.prefix_cache_dir else None
+
+        if path is not None and os.path.exists(path):
+            start_time = time.perf_counter()
+            try:
+                saved = torch.load(path, map_location=self.model.device, weights_only=True)
+                if saved["prefix_ids"] == prefix_ids[0].tolist():
+                    self.prefix_cache = DynamicCache.from_legacy_cache(saved["past_key_values"])
+                    self.prefix_ids = saved["prefix_ids"]
+                    print(f"✓ 从磁盘加载前缀KV缓存 ({len(self.prefix_ids)} tokens, {time.perf_counter() - start_time:.1f}s): {path}")
+                    return
+                print(f"⚠ 前缀KV缓存与当前分词结果不一致，重新预填充: {path}")
+            except (OSError, RuntimeError, EOFError, KeyError, TypeError, pickle.UnpicklingError) as e:
+                # 文件损坏或格式不兼容时重新预填充并覆盖它
+                print(f"⚠ 前缀KV缓存读取失败，重新预填充: {path}: {e!r}")
+
+        start_time = time.perf_counter()
+        with torch.no_grad():
+            outputs = self.model(input_ids=prefix_ids, past_key_values=DynamicCache(), use_cache=True)
+        self.prefix_cache = outputs.past_key_values
+        self.prefix_ids = prefix_ids[0].tolist()
+        print(f"✓ 前缀预填充完成 ({len(self.prefix_ids)} tokens, {time.perf_counter() - start_time:.1f}s)")
+
+        if path is not None:
+            try:
+                os.makedirs(self.prefix_cache_dir, exist_ok=True)
+                # 先写临时文件再重命名，避免中断时留下不完整的缓存
+                torch.save({"prefix_ids": self.prefix_ids, "past_key_values": self.prefix_cache.to_legacy_cache()}, path + ".tmp")
+                os.replace(path + ".tmp", path)
+                print(f"✓ 前缀KV缓存已保存: {path}")
+            except (OSError, RuntimeError) as e:
+                # 保存失败不影响本次运行，内存中的前缀缓存照常使用
+                print(f"⚠ 前缀KV缓存保存失败，下次启动将重新预填充: {path}: {e!r}")
     
     def generate_response_from_llm(self, prompt):
         """
@@ -87,16 +235,37 @@ class Qwen3ObjectProposer:
         if self.device == "cuda":
             inputs = {k: v.cuda() for k, v in inputs.items()}
         
+        # 提示以已缓存的前缀开头时（按token比较），只预填充前缀之后的部分
+        input_ids = inputs["input_ids"][0].tolist()
+        use_prefix = (self.prefix_cache is not None and len(input_ids) > len(self.prefix_ids)
+                      and input_ids[:len(self.prefix_ids)] == self.prefix_ids)
+        
         # 生成回复
         with torch.no_grad():
-            outputs = self.model.generate(
-                **inputs,
-                max_new_tokens=150,
-                temperature=0.3,
-                do_sample=True,
-                pad_token_id=self.tokenizer.eos_token_id,
-                eos_token_id=self.tokenizer.eos_token_id
-            )
+            if not use_prefix:
+                outputs = self.model.generate(
+                    **inputs,
+                    max_new_tokens=150,
+                    temperature=0.3,
+                    do_sample=True,
+                    pad_token_id=self.tokenizer.eos_token_id,
+                    eos_token_id=self.tokenizer.eos_token_id
+                )
+            else:
+                # generate会把新token追加到缓存中，结束后截回前缀长度，前缀部分不受影响
+                with self.prefix_lock:
+                    try:
+                        outputs = self.model.generate(
+                            **inputs,
+                            past_key_values=self.prefix_cache,
+                            max_new_tokens=150,
+                            temperature=0.3,
+                            do_sample=True,
+                            pad_token_id=self.tokenizer.eos_token_id,
+                            eos_token_id=self.tokenizer.eos_token_id
+                        )
+                    finally:
+                        self.prefix_cache.crop(len(self.prefix_ids))
         
         # 解码输出
         response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
@@ -152,90 +321,9 @@ class Qwen3ObjectProposer:
     
     def query_llm_for_objects(self, task):
         """
-        查询LLM获取任务相关对象
+        查询LLM获取任务相关对象（上下文学习前缀的KV缓存见prepare_prefix_cache）
         """
-        # 构建上下文学习提示
-        in_context_learning = """The task 'hold the snickers' may involve the following objects: snickers.
-The task 'wipe the table' may involve the following objects: table, napkin, sponge, towel, cloth.
-The task 'put a water bottle and an oatmeal next to the microwave' may involve the following objects: water bottle, oatmeal, microwave.
-The task 'place the mug in the cardboard box' may involve the following objects: mug, cardboard box.
-The task 'go to the fridge' may involve the following objects: fridge.
-The task 'put a grapefruit from the table into the bowl' may involve the following objects: grapefruit, table, bowl.
-The task 'can you open the glass jar' may involve the following objects: glass jar.
-The task 'heat up the taco and bring it to me' may involve the following objects: taco, human, microwave oven, fridge.
-The task 'hold the fancy plate with flower pattern' may involve the following objects: fancy plate with flower pattern.
-The task 'put the fruits in the fridge' may involve the following objects: fridge, apple, orange, banana, peach, grape, blueberry.
-The task 'get a sponge from the counter and put it in the sink' may involve the following objects: sponge, counter, sink.
-The task 'empty the water bottle' may involve the following objects: water bottle, sink.
-The task 'i am hungry, give me something to eat' may involve the following objects: human, candy, snickers, chips, apple, banana, orange.
-The task 'go to the trash can for bottles' may involve the following objects: trash can for bottles.
-The task 'put the apple in the basket and close the door' may involve the following objects: apple, basket, door.
-The task 'help me make a cup of coffee' may involve the following objects: cup, coffee, mug, coffee machine.
-The task 'check what time is it now' may involve the following objects: clock, watch.
-The task 'let go of the banana' may involve the following objects: banana, trash can.
-The task 'put the grapes in the bowl and then move the cheese to the table' may involve the following objects: grape, bowl, cheese, table.
-The task 'find a coffee machine' may involve the following objects: coffee machine.
-The task 'clean the kitchen' may involve the following objects: kitchen, sink, sponge, towel, soap, counter, stove, dishwasher.
-The task 'prepare breakfast' may involve the following objects: bread, toaster, butter, jam, plate, knife, milk, cereal, bowl.
-The task 'water the plants' may involve the following objects: plants, watering can, water, pot, soil.
-The task 'turn on the lights' may involve the following objects: light switch, lamp, bulb.
-The task 'set the table for dinner' may involve the following objects: table, plate, fork, knife, spoon, napkin, glass, chair.
-The task 'do the laundry' may involve the following objects: washing machine, clothes, detergent, basket, dryer.
-The task 'vacuum the living room' may involve the following objects: vacuum cleaner, living room, carpet, sofa, floor, wall, ceiling.
-The task 'organize the bookshelf' may involve the following objects: bookshelf, books, shelf, organizer, picture.
-The task 'feed the pet' may involve the following objects: pet, food bowl, pet food, water bowl, water.
-The task 'charge my phone' may involve the following objects: phone, charger, outlet, cable.
-The task 'take out the garbage' may involve the following objects: garbage bag, trash can, garbage bin, bottle, paper.
-The task 'wash the dishes' may involve the following objects: dishes, sink, soap, sponge, towel, plate, cup, mug, bowl, water.
-The task 'make the bed' may involve the following objects: bed, pillow, blanket, sheet, mattress.
-The task 'open the window' may involve the following objects: window, curtain, blinds.
-The task 'lock the door' may involve the following objects: door, key, lock.
-The task 'turn off the TV' may involve the following objects: TV, remote control, power button, monitor.
-The task 'put on my shoes' may involve the following objects: shoes, socks, shoelace, bag.
-The task 'brush my teeth' may involve the following objects: toothbrush, toothpaste, sink, mirror, cup, water.
-The task 'cook pasta' may involve the following objects: pasta, pot, water, stove, salt, sauce, plate, table.
-The task 'read a book' may involve the following objects: book, chair, lamp, glasses, bookmark, table.
-The task 'listen to music' may involve the following objects: speaker, phone, headphones, music player.
-The task 'study at desk' may involve the following objects: desk, chair, book, laptop, pen, paper, lamp, keyboard, mouse.
-The task 'decorate the room' may involve the following objects: picture, plant, lamp, wall, floor, ceiling, window.
-The task 'check the time' may involve the following objects: clock, phone, watch, wall.
-The task 'seal a package' may involve the following objects: tape, box, paper, scissors.
-The task 'take notes' may involve the following objects: pen, paper, notebook, laptop, keyboard, mouse, table.
-The task 'water the plants' may involve the following objects: plant, water, bottle.
-The task 'adjust room lighting' may involve the following objects: lamp, light switch, ceiling, wall.
-The task 'organize workspace' may involve the following objects: desk, chair, laptop, keyboard, mouse, monitor, pen, paper, book.
-
-The task '帮我准备咖啡' may involve the following objects: coffee machine, cup, mug, coffee beans, water, sugar, milk.
-The task '清理厨房桌子' may involve the following objects: table, sponge, towel, cloth, soap, cleaning spray, bottle.
-The task '准备简单早餐' may involve the following objects: bread, toaster, butter, jam, plate, knife, milk, cereal, bowl, egg, pan, table, cup, mug.
-The task '洗碗收拾餐具' may involve the following objects: dishes, sink, soap, sponge, towel, plate, cup, mug, bowl, fork, knife, spoon, water.
-The task '制作水果沙拉' may involve the following objects: apple, banana, orange, grape, bowl, knife, cutting board, spoon, table.
-The task '整理客厅桌子' may involve the following objects: coffee table, magazine, book, remote control, tissue box, decorative item, lamp, plant, picture.
-The task '打开电视看新闻' may involve the following objects: tv, remote control, sofa, chair, monitor.
-The task '调节客厅灯光' may involve the following objects: lamp, light switch, remote control, dimmer, ceiling.
-The task '收拾沙发上的物品' may involve the following objects: sofa, cushion, blanket, book, magazine, remote control, phone, laptop.
-The task '给植物浇水' may involve the following objects: plant, watering can, water, pot, soil, bottle.
-The task '整理办公桌' may involve the following objects: desk, paper, pen, pencil, notebook, folder, stapler, calculator, laptop, keyboard, mouse, monitor, phone.
-The task '打印重要文件' may involve the following objects: printer, paper, computer, document, folder, laptop, keyboard, mouse.
-The task '准备会议材料' may involve the following objects: paper, pen, notebook, folder, whiteboard, marker, projector, laptop, keyboard, mouse, table, chair.
-The task '清空垃圾桶' may involve the following objects: trash can, garbage bag, waste, bottle, paper.
-The task '整理文件夹' may involve the following objects: folder, paper, document, filing cabinet, desk, pen.
-The task '整理床铺' may involve the following objects: bed, pillow, blanket, sheet, mattress, floor.
-The task '收拾衣物' may involve the following objects: clothes, wardrobe, hangers, laundry basket, shoes, bag.
-The task '设置闹钟' may involve the following objects: alarm clock, phone, nightstand, table.
-The task '关闭窗帘' may involve the following objects: curtain, window, blinds, wall.
-The task '准备睡前用品' may involve the following objects: pillow, blanket, water glass, book, phone, charger, tissue, table, lamp.
-The task '封装包裹' may involve the following objects: tape, box, paper, scissors, table.
-The task '记录笔记' may involve the following objects: pen, paper, notebook, laptop, keyboard, mouse, table, chair.
-The task '查看时间' may involve the following objects: clock, phone, watch, wall.
-The task '调整房间布局' may involve the following objects: chair, table, sofa, lamp, plant, picture, wall, floor, ceiling.
-The task '整理书籍' may involve the following objects: book, bookshelf, table, desk, bag, paper.
-The task '充电设备' may involve the following objects: phone, laptop, charger, cable, outlet, table.
-The task '装饰墙面' may involve the following objects: picture, wall, tape, plant, clock.
-The task '清洁地板' may involve the following objects: floor, mop, water, cleaning spray, bottle.
-"""
-        
-        prompt = f"{in_context_learning}The task '{task}' may involve the following objects:"
+        prompt = f"{IN_CONTEXT_LEARNING}The task '{task}' may involve the following objects:"
         
         print(f"\n查询任务: {task}")
         print("正在生成对象提议...")
@@ -302,30 +390,21 @@ Now provide the structured plan for the given task:
 # 兼容性函数，保持与原始API一致
 def generate_response_from_llm(prompt):
     """
-    兼容性函数 - 使用全局Qwen3实例
+    兼容性函数 - 使用模型注册表中共享的Qwen3实例
     """
-    global qwen3_proposer
-    if 'qwen3_proposer' not in globals():
-        qwen3_proposer = Qwen3ObjectProposer()
-    return qwen3_proposer.generate_response_from_llm(prompt)
+    return get_qwen3().generate_response_from_llm(prompt)
 
 def parse_response(response):
     """
-    兼容性函数 - 使用全局Qwen3实例
+    兼容性函数 - 使用模型注册表中共享的Qwen3实例
     """
-    global qwen3_proposer
-    if 'qwen3_proposer' not in globals():
-        qwen3_proposer = Qwen3ObjectProposer()
-    return qwen3_proposer.parse_response(response)
+    return get_qwen3().parse_response(response)
 
 def query_llm_for_objects(task):
     """
-    兼容性函数 - 使用全局Qwen3实例
+    兼容性函数 - 使用模型注册表中共享的Qwen3实例
     """
-    global qwen3_proposer
-    if 'qwen3_proposer' not in globals():
-        qwen3_proposer = Qwen3ObjectProposer()
-    return qwen3_proposer.query_llm_for_objects(task)
+    return get_qwen3().query_llm_for_objects(task)
 
 if __name__ == "__main__":
     # 测试示例
@@ -0,0 +1,213 @@
+import json
+import os
+import numpy as np
+
+#hand_tform_camera comes from line below, just a hardcoded version of it
+#rot2 = mesh_frame.get_rotation_matrix_from_xyz((0, np.pi/2, -np.pi/2))
+HAND_TFORM_CAMERA = np.array([[ 3.74939946e-33,6.12323400e-17,1.00000000e+00],
+[-1.00000000e+00,6.12323400e-17,0.00000000e+00],
+[-6.12323400e-17,-1.00000000e+00,6.12323400e-17]])
+
+#Intrinsics for RGB hand camera on spot
+CX = 320
+CY = 240
+FX = 552.0291012161067
+FY = 552.0291012161067
+
+class CameraModel():
+	'''
+	Pinhole model of the hand color camera plus its fixed transform into the hand frame.
+	Defaults to the hardcoded spot hand camera intrinsics above.
+	'''
+	def __init__(self, fx=FX, fy=FY, cx=CX, cy=CY, hand_tform_camera=HAND_TFORM_CAMERA):
+		self.fx = fx
+		self.fy = fy
+		self.cx = cx
+		self.cy = cy
+		self.hand_tform_camera = np.asarray(hand_tform_camera)
+
+	@classmethod
+	def load(cls, path, source="hand_color_image"):
+		'''
+		Loads the intrinsics of source from a json file written by get_intrinsics.py --save
+		'''
+		intrinsics = json.load(open(path))[source]
+		return cls(fx=intrinsics["fx"], fy=intrinsics["fy"], cx=intrinsics["cx"], cy=intrinsics["cy"])
+
+	@classmethod
+	def load_or_default(cls, path, source="hand_color_image"):
+		if os.path.isfile(path):
+			return cls.load(path, source)
+		print(f"No camera intrinsics at {path}, using default spot hand camera intrinsics")
+		return cls()
+
+	def vision_tform_camera(self, rotation_matrices):
+		'''
+		rotation_matrices: ...x3x3 rotations of the hand in vision frame
+		'''
+		return np.matmul(rotation_matrices, self.hand_tform_camera)
+
+DEFAULT_CAMERA = CameraModel()
+
+#pixel grids are the same for every frame of a given size, so they are only built once
+_pixel_grids = {}
+
+def pixel_grid(H,W):
+	'''
+	Returns (i,j), two HxW arrays holding the row and column of every pixel
+	'''
+	if (H,W) not in _pixel_grids:
+		_pixel_grids[(H,W)] = np.indices((H,W),dtype=np.float64)
+	return _pixel_grids[(H,W)]
+
+def depth_to_vision_frame(depth_img,rotation_matrix,position,color_img=None,camera=DEFAULT_CAMERA):
+	'''
+	Vectorized pixel_to_vision_frame over a whole depth image. Pixels with 0 depth have no real point and are dropped.
+
+	depth_img: HxW depth image (meters)
+	rotaton_matrix: 3x3 rotation matrix of hand in vision frame
+	position: 3x1 position vector of hand in vision frame
+	color_img: optional HxWx3 uint8 image aligned with depth_img
+	camera: CameraModel of the camera that took the image
+
+	returns (points, colors): Nx3 points in vision frame and Nx3 colors in [0,1] (None if no color_img)
+	'''
+	H,W = depth_img.shape
+	i,j = pixel_grid(H,W)
+	valid = depth_img > 0
+
+	z_RGB = depth_img[valid]
+	x_RGB = (j[valid] - camera.cx) * z_RGB / camera.fx
+	y_RGB = (i[valid] - camera.cy) * z_RGB / camera.fy
+
+	#first apply rot2 to move camera into hand frame, then apply rotation + transform of hand frame in vision frame
+	vision_tform_camera = camera.vision_tform_camera(rotation_matrix)
+	points = np.stack([x_RGB,y_RGB,z_RGB],axis=1).dot(vision_tform_camera.T) + np.reshape(position,(1,3))
+
+	colors = None
+	if color_img is not None:
+		colors = color_img[valid] / 255.0
+	return(points,colors)
+
+def localize_boxes(boxes,frame_ids,get_depth,pose_dir,camera=DEFAULT_CAMERA):
+	'''
+	Localizes 2D detections in vision frame, all at once. Each depth frame is fetched once no matter how many
+	detections come from it.
+
+	boxes: Nx4 boxes (ymin, xmin, ymax, xmax) in image pixels
+	frame_ids: N frame numbers, i.e. n of color_n.jpg
+	get_depth: function from frame number to HxW depth image (meters), e.g. DepthCache.get
+	pose_dir: frame number -> {'rotation_matrix', 'position'} of the hand in vision frame
+	camera: CameraModel of the camera that took the frames
+
+	returns (centers, extents, valid):
+		centers: Nx3 vision frame position of the box center pixel
+		extents: Nx3 axis aligned box size, (width, width, height) of the box at the center depth
+		valid: N bools, False where the depth at the box center is 0 (no real point)
+	'''
+	boxes = np.asarray(boxes,dtype=np.float64).reshape(-1,4)
+	frame_ids = np.asarray(frame_ids).reshape(-1)
+	n = boxes.shape[0]
+	ymin,xmin,ymax,xmax = boxes.T
+
+	center_y = ((ymin + ymax)/2.0).astype(np.int64)
+	center_x = ((xmin + xmax)/2.0).astype(np.int64)
+
+	z = np.zeros(n)
+	rotation_matrices = np.zeros((n,3,3))
+	positions = np.zeros((n,3))
+	for frame_id in np.unique(frame_ids):
+		rows = np.nonzero(frame_ids == frame_id)[0]
+		depth_img = get_depth(int(frame_id))
+		H,W = depth_img.shape
+		z[rows] = depth_img[np.clip(center_y[rows],0,H-1),np.clip(center_x[rows],0,W-1)]
+		rotation_matrices[rows] = pose_dir[int(frame_id)]['rotation_matrix']
+		positions[rows] = np.reshape(pose_dir[int(frame_id)]['position'],(3,))
+
+	points_camera = np.stack([(center_x - camera.cx) * z / camera.fx, (center_y - camera.cy) * z / camera.fy, z],axis=1)
+	centers = np.einsum("nij,nj->ni",camera.vision_tform_camera(rotation_matrices),points_camera) + positions
+
+	#rotations keep lengths, so the distance from the center to the box sides can be measured in camera frame
+	size_x = np.abs(xmax - center_x) * z / camera.fx * 2
+	size_y = np.abs(ymax - center_y) * z / camera.fy * 2
+	extents = np.stack([size_x,size_x,size_y],axis=1)
+
+	valid = z > 0
+	return(centers,extents,valid)
+
+def localize_masks(boxes,masks,frame_ids,get_depth,pose_dir,camera=DEFAULT_CAMERA,mask_thresh=0.5,inlier_range=0.25):
+	'''
+	Localizes 2D detections in vision frame from the depth under their ViLD instance masks. The masks are sampled
+	at their own resolution over the box (the same cells paste_instance_masks resizes onto the image), so a
+	detection costs mask_h*mask_w depth lookups and no full size mask is built.
+
+	Zero depth is ignored. The median depth of the masked pixels is robust to background pixels at the mask border,
+	and only points within inlier_range (meters) of it are used for the centroid and extent. If the mask has no
+	pixel above mask_thresh, every sample in the box is used instead.
+
+	boxes: Nx4 boxes (ymin, xmin, ymax, xmax) in image pixels
+	masks: Nxmask_hxmask_w ViLD mask probabilities (float in [0,1] or uint8 in [0,255])
+	frame_ids, get_depth, pose_dir, camera: see localize_boxes
+
+	returns (centers, extents, rotations, valid):
+		centers: Nx3 vision frame centroid of the inlier points
+		extents: Nx3 size of the inlier points along their principal axes
+		rotations: Nx3x3 principal axes (columns) in vision frame, i.e. R of an oriented bounding box
+		valid: N bools, False where no masked pixel has depth
+	'''
+	boxes = np.asarray(boxes,dtype=np.float64).reshape(-1,4)
+	frame_ids = np.asarray(frame_ids).reshape(-1)
+	masks = np.asarray(masks)
+	masks = masks / 255.0 if masks.dtype == np.uint8 else masks
+	n,mask_h,mask_w = masks.shape
+	ymin,xmin,ymax,xmax = boxes.T
+
+	#pixel at the center of every mask cell
+	sample_y = ymin[:,None] + (np.arange(mask_h)[None,:] + 0.5) * ((ymax - ymin)/mask_h)[:,None]
+	sample_x = xmin[:,None] + (np.arange(mask_w)[None,:] + 0.5) * ((xmax - xmin)/mask_w)[:,None]
+	sample_y = np.broadcast_to(sample_y.astype(np.int64)[:,:,None],(n,mask_h,mask_w)).reshape(n,-1)
+	sample_x = np.broadcast_to(sample_x.astype(np.int64)[:,None,:],(n,mask_h,mask_w)).reshape(n,-1)
+
+	in_mask = masks.reshape(n,-1) > mask_thresh
+	in_mask[~in_mask.any(axis=1)] = True
+
+	z = np.zeros(sample_y.shape)
+	rotation_matrices = np.zeros((n,3,3))
+	positions = np.zeros((n,3))
+	for frame_id in np.unique(frame_ids):
+		rows = np.nonzero(frame_ids == frame_id)[0]
+		depth_img = get_depth(int(frame_id))
+		H,W = depth_img.shape
+		z[rows] = depth_img[np.clip(sample_y[rows],0,H-1),np.clip(sample_x[rows],0,W-1)]
+		rotation_matrices[rows] = pose_dir[int(frame_id)]['rotation_matrix']
+		positions[rows] = np.reshape(pose_dir[int(frame_id)]['position'],(3,))
+
+	#median over the valid samples of every row: sort them to the front and take the middle one(s)
+	has_depth = in_mask & (z > 0)
+	num_depth = has_depth.sum(axis=1)
+	z_sorted = np.sort(np.where(has_depth,z,np.inf),axis=1)
+	lower = np.take_along_axis(z_sorted,np.maximum(num_depth-1,0)[:,None]//2,axis=1)[:,0]
+	upper = np.take_along_axis(z_sorted,np.maximum(num_depth,1)[:,None]//2,axis=1)[:,0]
+	median_z = np.where(num_depth > 0,(lower + np.where(np.isinf(upper),lower,upper))/2.0,0.0)
+
+	inliers = has_depth & (np.abs(z - median_z[:,None]) <= inlier_range)
+	num_inliers = inliers.sum(axis=1)
+	valid = num_inliers > 0
+
+	points_camera = np.stack([(sample_x - camera.cx) * z / camera.fx, (sample_y - camera.cy) * z / camera.fy, z],axis=2)
+	points = np.einsum("nij,nsj->nsi",camera.vision_tform_camera(rotation_matrices),points_camera) + positions[:,None,:]
+
+	weights = inliers / np.maximum(num_inliers,1)[:,None]
+	centers = np.einsum("ns,nsi->ni",weights,points)
+
+	#principal axes of the inlier points give the box orientation, their spread along each axis the extent
+	offsets = (points - centers[:,None,:]) * inliers[:,:,None]
+	covariances = np.einsum("nsi,nsj->nij",offsets,offsets) / np.maximum(num_inliers,1)[:,None,None]
+	_,rotations = np.linalg.eigh(covariances)
+	rotations[np.linalg.det(rotations) < 0,:,0] *= -1
+	projected = np.einsum("nsi,nij->nsj",offsets,rotations)
+	extents = np.where(inliers[:,:,None],projected,-np.inf).max(axis=1) - np.where(inliers[:,:,None],projected,np.inf).min(axis=1)
+	extents[~valid] = 0
+	centers[~valid] = positions[~valid]
+
+	return(centers,extents,rotations,valid)
@@ -0,0 +1,94 @@
+import argparse
+import os
+import pickle
+from collections import OrderedDict
+import numpy as np
+
+#depth frames are stored as uint16 millimeters, the format the spot depth camera returns them in
+DEPTH_SCALE = 1000.0
+
+def depth_path(data_path, file_num):
+	'''
+	Returns the path of depth frame file_num, preferring depth_{file_num}.npy over the old depth_{file_num} pickle
+	'''
+	npy_path = os.path.join(data_path, f"depth_{file_num}.npy")
+	if os.path.isfile(npy_path):
+		return npy_path
+	return os.path.join(data_path, f"depth_{file_num}")
+
+def load_depth(data_path, file_num):
+	'''
+	Loads depth frame file_num as an HxW float32 image in meters. .npy frames are memory mapped.
+	'''
+	path = depth_path(data_path, file_num)
+	if path.endswith(".npy"):
+		depth_mm = np.load(path, mmap_mode="r")
+		return depth_mm.astype(np.float32) / DEPTH_SCALE
+	return np.asarray(pickle.load(open(path, "rb")), dtype=np.float32)
+
+def save_depth(data_path, file_num, depth_meters):
+	'''
+	Saves an HxW depth image in meters as depth_{file_num}.npy (uint16 millimeters)
+	'''
+	depth_mm = np.clip(np.round(np.asarray(depth_meters) * DEPTH_SCALE), 0, np.iinfo(np.uint16).max).astype(np.uint16)
+	np.save(os.path.join(data_path, f"depth_{file_num}.npy"), depth_mm)
+
+def convert_depth_dir(data_path, remove_pickles=False):
+	'''
+	Converts every depth_{n} pickle in data_path to depth_{n}.npy. Returns the number of converted frames.
+	'''
+	converted = 0
+	for file_name in sorted(os.listdir(data_path)):
+		if not file_name.startswith("depth_") or not file_name[len("depth_"):].isdigit():
+			continue
+		file_num = int(file_name[len("depth_"):])
+		save_depth(data_path, file_num, pickle.load(open(os.path.join(data_path, file_name), "rb")))
+		if remove_pickles:
+			os.remove(os.path.join(data_path, file_name))
+		converted += 1
+	return converted
+
+
+class DepthCache():
+	'''
+	LRU cache of depth frames (meters), bounded by the total bytes of the frames it holds.
+	One instance is shared by all localization calls, so a frame hit by several detections is only read once.
+	'''
+	def __init__(self, data_path, max_bytes=256*2**20):
+		self.data_path = data_path
+		self.max_bytes = max_bytes
+		self.frames = OrderedDict()
+		self.nbytes = 0
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, file_num):
+		if file_num in self.frames:
+			self.frames.move_to_end(file_num)
+			self.hits += 1
+			return self.frames[file_num]
+
+		self.misses += 1
+		depth_img = load_depth(self.data_path, file_num)
+		depth_img.flags.writeable = False
+		self.frames[file_num] = depth_img
+		self.nbytes += depth_img.nbytes
+
+		#always keep the frame that was just read, even if it alone is over the budget
+		while self.nbytes > self.max_bytes and len(self.frames) > 1:
+			_, evicted = self.frames.popitem(last=False)
+			self.nbytes -= evicted.nbytes
+		return depth_img
+
+	def clear(self):
+		self.frames.clear()
+		self.nbytes = 0
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Convert pickled depth frames (meters) into uint16 millimeter .npy files")
+	parser.add_argument("data_path", help="Directory with depth_* pickles", type=str)
+	parser.add_argument("--remove_pickles", help="Delete each pickle after it is converted", action="store_true")
+	args = parser.parse_args()
+
+	print(f"Converted {convert_depth_dir(args.data_path, args.remove_pickles)} depth frames in {args.data_path}")
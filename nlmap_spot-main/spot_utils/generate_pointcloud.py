@@ -1,65 +1,208 @@
+import argparse
+import json
 import pickle
 import matplotlib.pyplot as plt
 import math
 import numpy as np
 import os
+import time
 import cv2
 import open3d as o3d
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
-from spot_utils.utils import pixel_to_vision_frame
+from spot_utils.camera import CameraModel, DEFAULT_CAMERA, depth_to_vision_frame
+from spot_utils.depth_io import load_depth
 
-def make_pointcloud(data_path="../data/spot-depth-color-pose-data3/", pose_data_fname="pose_data.pkl", pointcloud_fname="pointcloud.pcd"):
-	fill_in = False #if fill_in is True, then gaps in depth image are filled in with black (at maximal distance..?)
+class VoxelFusion():
+	'''
+	Sparse voxel hash map that frames are streamed into. Every occupied voxel keeps the sum of the points and colors
+	that fell into it plus a count, so memory grows with the observed scene volume instead of with the number of frames.
+	Voxels are keyed by their packed integer coordinates. A frame is reduced to one entry per voxel and queued; queued
+	frames are merged into the sorted voxel arrays once they hold as many voxels as the map (or merge_size), so
+	every voxel is copied a logarithmic number of times instead of once per frame.
+	'''
+	#voxel coordinates are packed into 21 bits per axis
+	KEY_BITS = 21
+	KEY_OFFSET = 2**20
+
+	def __init__(self,voxel_size,merge_size=2**20):
+		self.voxel_size = voxel_size
+		self.merge_size = merge_size
+		self.keys = np.zeros(0,dtype=np.int64)
+		self.sums = np.zeros((0,6))
+		self.counts = np.zeros(0,dtype=np.int64)
+		self.pending = [] #(keys, sums, counts) of frames not merged yet
+		self.pending_voxels = 0
+		self.points_in = 0
+
+	def voxel_keys(self,points):
+		voxels = np.floor(points / self.voxel_size).astype(np.int64) + self.KEY_OFFSET
+		return (voxels[:,0] << (2*self.KEY_BITS)) | (voxels[:,1] << self.KEY_BITS) | voxels[:,2]
+
+	@staticmethod
+	def reduce(keys,sums,counts):
+		'''
+		Sums the rows of sums and counts that share a key, returns (sorted unique keys, sums, counts)
+		'''
+		unique_keys,inverse = np.unique(keys,return_inverse=True)
+		inverse = inverse.reshape(-1)
+		unique_sums = np.stack([np.bincount(inverse,weights=sums[:,c],minlength=len(unique_keys)) for c in range(sums.shape[1])],axis=1)
+		unique_counts = np.bincount(inverse,weights=counts,minlength=len(unique_keys)).astype(np.int64)
+		return(unique_keys,unique_sums,unique_counts)
+
+	def integrate(self,points,colors):
+		'''
+		Adds Nx3 points (vision frame) and their Nx3 colors to the map
+		'''
+		self.points_in += points.shape[0]
+		if points.shape[0] == 0:
+			return
+
+		frame = self.reduce(self.voxel_keys(points),np.concatenate([points,colors],axis=1),np.ones(points.shape[0],dtype=np.int64))
+		self.pending.append(frame)
+		self.pending_voxels += len(frame[0])
+		if self.pending_voxels >= max(self.merge_size,len(self.keys)):
+			self.merge()
+
+	def merge(self):
+		'''
+		Merges the queued frames into the voxel arrays
+		'''
+		if len(self.pending) == 0:
+			return
+		self.keys,self.sums,self.counts = self.reduce(np.concatenate([self.keys]+[keys for keys,_,_ in self.pending]),
+		                                              np.concatenate([self.sums]+[sums for _,sums,_ in self.pending],axis=0),
+		                                              np.concatenate([self.counts]+[counts for _,_,counts in self.pending]))
+		self.pending = []
+		self.pending_voxels = 0
+
+	def extract(self):
+		'''
+		returns (points, colors), the mean point and color of every occupied voxel
+		'''
+		self.merge()
+		means = self.sums / self.counts[:,None]
+		return(means[:,:3],means[:,3:])
+
+def make_pointcloud(data_path="../data/spot-depth-color-pose-data3/", pose_data_fname="pose_data.pkl", pointcloud_fname="pointcloud.pcd", num_workers=None, voxel_size=0, visualize=True, camera=DEFAULT_CAMERA):
+	'''
+	Fuses all color/depth/pose frames in data_path into one colored point cloud
+
+	num_workers: threads used to back-project frames
+	voxel_size: if > 0, frames are streamed into a voxel hash map of this resolution (meters) and one point per
+		occupied voxel is kept. Otherwise every valid depth pixel of every frame becomes a point.
+	visualize: if true, show the cloud and camera poses in an open3d window. Needs a display.
+	camera: CameraModel of the camera that took the frames, the same one detections are localized with
+
+	Build stats (points in/out, time per frame, throughput) are saved next to the cloud as {pointcloud name}_stats.json
+	'''
 	save_pc = True #if true, save point cloud to same location as dir_path+dir_name
+	start_time = time.perf_counter()
 
 	pose_dir = pickle.load(open(f"{data_path}{pose_data_fname}","rb"))
 
 	#######################################
 	# Visualize point cloud
-	file_names = os.listdir(data_path)
-	num_files = int((len(file_names)-1)/ 3.0)
-	total_pcds = []
-	total_colors = []
-	total_axes = []
-	for file_num in tqdm(range(num_files)):
+	#count color frames rather than all files so outputs written into data_path (cloud, stats) don't shift the count
+	num_files = len([file_name for file_name in os.listdir(data_path) if file_name.startswith("color_") and file_name.endswith(".jpg")])
+	frame_times = [0.0]*num_files
+
+	def backproject_frame(file_num):
+		frame_start = time.perf_counter()
 		rotation_matrix = pose_dir[file_num]['rotation_matrix']
 		position = pose_dir[file_num]['position']
 
 		color_img = cv2.imread(f"{data_path}color_{str(file_num)}.jpg")
 		color_img = color_img[:,:,::-1]  # RGB-> BGR
-		depth_img = pickle.load(open(f"{data_path}depth_{str(file_num)}","rb"))#cv2.imread(dir_path+dir_name+"depth_"+str(file_num)+".jpg")
-
-		H,W = depth_img.shape
-		for i in range(H):
-			for j in range(W):
-				#first apply rot2 to move camera into hand frame, then apply rotation + transform of hand frame in vision frame
-				transformed_xyz,_ = pixel_to_vision_frame(i,j,depth_img,rotation_matrix,position)
+		depth_img = load_depth(data_path,file_num)
 
-				total_pcds.append(transformed_xyz)
+		points_colors = depth_to_vision_frame(depth_img,rotation_matrix,position,color_img=color_img,camera=camera)
+		frame_times[file_num] = time.perf_counter() - frame_start
+		return points_colors
 
-				# Add the color of the pixel if it exists:
-				if 0 <= j < W and 0 <= i < H:
-					total_colors.append(color_img[i,j] / 255)
-				elif fill_in:
-					total_colors.append([0., 0., 0.])
+	#frames are independent, numpy and cv2 release the GIL so threads run them in parallel
+	if num_workers is None:
+		num_workers = min(32, (os.cpu_count() or 1) + 4) #ThreadPoolExecutor's default
+	with ThreadPoolExecutor(max_workers=num_workers) as pool:
+		if voxel_size > 0:
+			#stream a few frames at a time into the voxel map so only those frames are held in memory
+			fusion = VoxelFusion(voxel_size)
+			chunk_size = 2*num_workers
+			with tqdm(total=num_files) as progress:
+				for chunk_start in range(0,num_files,chunk_size):
+					for points,colors in pool.map(backproject_frame, range(chunk_start,min(chunk_start+chunk_size,num_files))):
+						fusion.integrate(points,colors)
+						progress.update(1)
+			total_pcds,total_colors = fusion.extract()
+			points_in = fusion.points_in
+		else:
+			frame_points = list(tqdm(pool.map(backproject_frame, range(num_files)), total=num_files))
 
-		mesh_frame = o3d.geometry.TriangleMesh.create_coordinate_frame(size=0.6,origin=[0,0,0])
-		mesh_frame = mesh_frame.rotate(rotation_matrix, center=(0, 0, 0)).translate(position)
-		#mesh_frame.paint_uniform_color([float(file_num)/num_files, 0.1, 1-(float(file_num)/num_files)])
+			num_points = sum(points.shape[0] for points,_ in frame_points)
+			total_pcds = np.empty((num_points,3))
+			total_colors = np.empty((num_points,3))
+			offset = 0
+			for points,colors in frame_points:
+				total_pcds[offset:offset+points.shape[0]] = points
+				total_colors[offset:offset+points.shape[0]] = colors
+				offset += points.shape[0]
+			del frame_points
+			points_in = num_points
 
-		total_axes.append(mesh_frame)
-		
 	pcd_o3d = o3d.geometry.PointCloud()  # create a point cloud object
 	pcd_o3d.points = o3d.utility.Vector3dVector(total_pcds)
 	pcd_o3d.colors = o3d.utility.Vector3dVector(total_colors)
 
 	#bb = o3d.geometry.OrientedBoundingBox(center=np.array([0,0,0]),R=rot2_mat,extent=np.array([1,1,1]))
 
-	# Visualize:
-	origin_frame = o3d.geometry.TriangleMesh.create_coordinate_frame(size=1,origin=[0,0,0])
-	o3d.visualization.draw_geometries([pcd_o3d]+total_axes+[origin_frame])
-
 	if save_pc:
 		o3d.io.write_point_cloud(f"{data_path}{pointcloud_fname}", pcd_o3d)
 
+	total_time = time.perf_counter() - start_time
+	stats = {
+		"frames": num_files,
+		"voxel_size": voxel_size,
+		"points_in": int(points_in),
+		"points_out": int(total_pcds.shape[0]),
+		"time_per_frame_mean": float(np.mean(frame_times)) if num_files > 0 else 0.0,
+		"time_per_frame_max": float(np.max(frame_times)) if num_files > 0 else 0.0,
+		"total_time": total_time,
+		"frames_per_second": num_files / total_time,
+		"points_per_second": points_in / total_time,
+	}
+	json.dump(stats, open(f"{data_path}{os.path.splitext(pointcloud_fname)[0]}_stats.json","w"), indent=2)
+
+	if visualize:
+		total_axes = []
+		for file_num in range(num_files):
+			rotation_matrix = pose_dir[file_num]['rotation_matrix']
+			position = pose_dir[file_num]['position']
+
+			mesh_frame = o3d.geometry.TriangleMesh.create_coordinate_frame(size=0.6,origin=[0,0,0])
+			mesh_frame = mesh_frame.rotate(rotation_matrix, center=(0, 0, 0)).translate(position)
+			#mesh_frame.paint_uniform_color([float(file_num)/num_files, 0.1, 1-(float(file_num)/num_files)])
+
+			total_axes.append(mesh_frame)
+
+		# Visualize:
+		origin_frame = o3d.geometry.TriangleMesh.create_coordinate_frame(size=1,origin=[0,0,0])
+		o3d.visualization.draw_geometries([pcd_o3d]+total_axes+[origin_frame])
+
 	return(pcd_o3d)
+
+if __name__ == "__main__":
+	#run from the nlmap_spot-main directory: python -m spot_utils.generate_pointcloud DATA_PATH --headless
+	parser = argparse.ArgumentParser(description="Fuse collected color/depth/pose frames into a colored pointcloud")
+	parser.add_argument("data_path", help="Directory with color_*.jpg, depth_* and pose data", type=str)
+	parser.add_argument("--pose_data_fname", help="Pose data file name inside data_path", type=str, default="pose_data.pkl")
+	parser.add_argument("--pointcloud_fname", help="Output pointcloud file name inside data_path", type=str, default="pointcloud.pcd")
+	parser.add_argument("--voxel_size", help="Voxel size in meters for streaming fusion, 0 keeps every point", type=float, default=0.02)
+	parser.add_argument("--num_workers", help="Threads used to back-project frames", type=int, default=None)
+	parser.add_argument("--headless", help="Don't open the open3d viewer", action="store_true")
+	parser.add_argument("--intrinsics", help="Camera intrinsics json inside data_path (written by get_intrinsics.py --save), default spot hand camera intrinsics if missing", type=str, default="intrinsics.json")
+	args = parser.parse_args()
+
+	data_path = os.path.join(args.data_path, "")
+	camera = CameraModel.load_or_default(f"{data_path}{args.intrinsics}")
+	make_pointcloud(data_path=data_path, pose_data_fname=args.pose_data_fname, pointcloud_fname=args.pointcloud_fname, num_workers=args.num_workers, voxel_size=args.voxel_size, visualize=not args.headless, camera=camera)
+	print(json.dumps(json.load(open(f"{data_path}{os.path.splitext(args.pointcloud_fname)[0]}_stats.json")), indent=2))
@@ -146,7 +146,8 @@ def main(argv):
         out = cv2.addWeighted(visual_rgb, 0.5, depth_color, 0.5, 0)
 
         cv2.imwrite(img_dir+"color_"+str(counter)+".jpg", cv_visual)
-        pickle.dump(cv_depth_meters, open(img_dir+"depth_"+str(counter),"wb"))
+        #depth is saved as raw uint16 millimeters, see depth_io.py
+        np.save(img_dir+"depth_"+str(counter)+".npy", cv_depth)
         cv2.imwrite(img_dir+"combined_"+str(counter)+".jpg", out)
         counter += 1
 
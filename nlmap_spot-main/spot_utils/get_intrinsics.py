@@ -7,6 +7,7 @@
 """Simple image capture tutorial."""
 
 import argparse
+import json
 import sys
 
 from bosdyn.api import image_pb2
@@ -50,6 +51,8 @@ def main(argv):
     parser.add_argument(
         '--pixel-format', choices=pixel_format_type_strings(),
         help='Requested pixel format of image. If supplied, will be used for all sources.')
+    parser.add_argument('--save', help='Save the intrinsics of the image sources to this json file, '
+                        'e.g. DATA_DIR/intrinsics.json (read by NLMap through spot_utils.camera.CameraModel)')
 
     options = parser.parse_args(argv)
 
@@ -67,6 +70,7 @@ def main(argv):
         parser.error('Must provide actionable argument (list or image-sources).')
 
     image_sources = image_client.list_image_sources()
+    saved_intrinsics = {}
     print("Image sources:")
     for source in image_sources:
         if source.name in options.image_sources:
@@ -75,6 +79,19 @@ def main(argv):
             print(f"focal length: {intrinsics.focal_length}")
             print(f"principal_point: {intrinsics.principal_point}")
             print(f"skew: {intrinsics.skew}")
+            saved_intrinsics[source.name] = {
+                'fx': intrinsics.focal_length.x,
+                'fy': intrinsics.focal_length.y,
+                'cx': intrinsics.principal_point.x,
+                'cy': intrinsics.principal_point.y,
+                'skew': [intrinsics.skew.x, intrinsics.skew.y],
+                'rows': source.rows,
+                'cols': source.cols,
+            }
+
+    if options.save:
+        json.dump(saved_intrinsics, open(options.save, 'w'), indent=2)
+        print(f"Saved intrinsics to {options.save}")
 
     '''
     # Optionally capture one or more images.
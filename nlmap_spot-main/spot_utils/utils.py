@@ -1,5 +1,7 @@
 import numpy as np
 
+from spot_utils.camera import HAND_TFORM_CAMERA, CX, CY, FX, FY
+
 import bosdyn.client
 import bosdyn.client.estop
 import bosdyn.client.lease
@@ -157,19 +159,7 @@ def pixel_to_vision_frame_depth_provided(i,j,depth,rotation_matrix,position):
 	position: 3x1 position vector of hand in vision frame
 	'''
 
-	#hand_tform_camera comes from line below, just a hardcoded version of it
-	#rot2 = mesh_frame.get_rotation_matrix_from_xyz((0, np.pi/2, -np.pi/2))
-	hand_tform_camera = np.array([[ 3.74939946e-33,6.12323400e-17,1.00000000e+00],
-	[-1.00000000e+00,6.12323400e-17,0.00000000e+00],
-	[-6.12323400e-17,-1.00000000e+00,6.12323400e-17]])
-
-	#Intrinsics for RGB hand camera on spot
-	CX = 320
-	CY = 240
-	FX= 552.0291012161067
-	FY = 552.0291012161067
-
-
+	#hardcoded spot hand camera intrinsics and hand_tform_camera, see spot_utils.camera
 	z_RGB = depth
 	x_RGB = (j - CX) * z_RGB / FX
 	y_RGB = (i - CY) * z_RGB / FY
@@ -177,7 +167,7 @@ def pixel_to_vision_frame_depth_provided(i,j,depth,rotation_matrix,position):
 	bad_z = z_RGB == 0 #if z_RGB is 0, the depth was 0, which means we didn't get a real point. x,y,z will just be where robot hand was
 
 	#first apply rot2 to move camera into hand frame, then apply rotation + transform of hand frame in vision frame
-	transformed_xyz = np.matmul(rotation_matrix,np.matmul(hand_tform_camera,np.array([x_RGB,y_RGB,z_RGB]))) + position
+	transformed_xyz = np.matmul(rotation_matrix,np.matmul(HAND_TFORM_CAMERA,np.array([x_RGB,y_RGB,z_RGB]))) + position
 
 	return(transformed_xyz,bad_z)
 
@@ -192,19 +182,7 @@ def pixel_to_vision_frame(i,j,depth_img,rotation_matrix,position):
 	position: 3x1 position vector of hand in vision frame
 	'''
 
-	#hand_tform_camera comes from line below, just a hardcoded version of it
-	#rot2 = mesh_frame.get_rotation_matrix_from_xyz((0, np.pi/2, -np.pi/2))
-	hand_tform_camera = np.array([[ 3.74939946e-33,6.12323400e-17,1.00000000e+00],
-	[-1.00000000e+00,6.12323400e-17,0.00000000e+00],
-	[-6.12323400e-17,-1.00000000e+00,6.12323400e-17]])
-
-	#Intrinsics for RGB hand camera on spot
-	CX = 320
-	CY = 240
-	FX= 552.0291012161067
-	FY = 552.0291012161067
-
-
+	#hardcoded spot hand camera intrinsics and hand_tform_camera, see spot_utils.camera
 	z_RGB = depth_img[i,j]
 	x_RGB = (j - CX) * z_RGB / FX
 	y_RGB = (i - CY) * z_RGB / FY
@@ -212,6 +190,6 @@ def pixel_to_vision_frame(i,j,depth_img,rotation_matrix,position):
 	bad_z = z_RGB == 0 #if z_RGB is 0, the depth was 0, which means we didn't get a real point. x,y,z will just be where robot hand was
 
 	#first apply rot2 to move camera into hand frame, then apply rotation + transform of hand frame in vision frame
-	transformed_xyz = np.matmul(rotation_matrix,np.matmul(hand_tform_camera,np.array([x_RGB,y_RGB,z_RGB]))) + position
+	transformed_xyz = np.matmul(rotation_matrix,np.matmul(HAND_TFORM_CAMERA,np.array([x_RGB,y_RGB,z_RGB]))) + position
 
 	return(transformed_xyz,bad_z)
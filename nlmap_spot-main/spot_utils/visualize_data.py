@@ -5,6 +5,7 @@ import numpy as np
 import os
 import cv2
 import open3d as o3d
+from spot_utils.depth_io import load_depth
 
 viz_poses = True
 
@@ -67,7 +68,7 @@ for file_num in range(num_files):
 
 	color_img = cv2.imread(dir_path+dir_name+"color_"+str(file_num)+".jpg")
 	color_img = color_img[:,:,::-1]  # RGB-> BGR
-	depth_img = pickle.load(open(dir_path+dir_name+"depth_"+str(file_num),"rb"))#cv2.imread(dir_path+dir_name+"depth_"+str(file_num)+".jpg")
+	depth_img = load_depth(dir_path+dir_name,file_num)#cv2.imread(dir_path+dir_name+"depth_"+str(file_num)+".jpg")
 
 	print(depth_img.shape)
 
@@ -0,0 +1,74 @@
+import builtins
+import sys
+import threading
+import time
+
+class ImportProfiler():
+	'''
+	Times imports by wrapping builtins.__import__. Only imports that load new modules are recorded, under the name
+	that was imported. Imports made while another recorded import runs are counted in that one, so the report lists
+	what the profiled code itself imported (directly or from a function that defers an import) and what it cost.
+	'''
+	def __init__(self):
+		self.times = {}
+		self.local = threading.local()
+		self.original_import = None
+		self.start_time = None
+
+	def start(self):
+		if self.original_import is not None:
+			return
+		self.start_time = time.perf_counter()
+		self.original_import = builtins.__import__
+		builtins.__import__ = self._import
+
+	def stop(self):
+		if self.original_import is not None:
+			builtins.__import__ = self.original_import
+			self.original_import = None
+
+	def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+		depth = getattr(self.local, "depth", 0)
+		num_modules = len(sys.modules)
+		start = time.perf_counter()
+		self.local.depth = depth + 1
+		try:
+			return self.original_import(name, globals, locals, fromlist, level)
+		finally:
+			self.local.depth = depth
+			if depth == 0 and len(sys.modules) > num_modules:
+				if level > 0 and globals is not None:
+					name = f"{globals.get('__package__') or ''}.{name}"
+				self.times[name] = self.times.get(name, 0.0) + time.perf_counter() - start
+
+class PhaseTimer():
+	'''
+	Wall time of consecutive phases: mark(name) closes the phase that started at the previous mark (or creation)
+	'''
+	def __init__(self):
+		self.phases = []
+		self.last = time.perf_counter()
+
+	def mark(self, name):
+		now = time.perf_counter()
+		self.phases.append((name, now - self.last))
+		self.last = now
+
+PROFILER = ImportProfiler()
+
+def startup_report(phase_timer=None, top=20):
+	'''
+	Breakdown of startup time: the slowest imports recorded by PROFILER and the phases of phase_timer
+	'''
+	lines = []
+	total = time.perf_counter() - PROFILER.start_time if PROFILER.start_time is not None else None
+	if total is not None:
+		lines.append(f"Startup: {total:.2f}s total")
+	lines.append(f"Imports ({sum(PROFILER.times.values()):.2f}s):")
+	for name, seconds in sorted(PROFILER.times.items(), key=lambda item: -item[1])[:top]:
+		lines.append(f"  {seconds:8.3f}s  {name}")
+	if phase_timer is not None:
+		lines.append(f"Init ({sum(seconds for _, seconds in phase_timer.phases):.2f}s):")
+		for name, seconds in phase_timer.phases:
+			lines.append(f"  {seconds:8.3f}s  {name}")
+	return "\n".join(lines)
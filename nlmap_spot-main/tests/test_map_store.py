@@ -0,0 +1,92 @@
+import os
+import numpy as np
+from map_store import MapStore, MapStoreWriter, cluster_instances, diff_frames, frame_fingerprint
+
+def make_frame(rng, n, feat_dim=8):
+	return {"rpn_scores": rng.random(n), "boxes": rng.random((n, 4))*100, "masks": rng.random((n, 4, 4)),
+	        "vild_feat": rng.random((n, feat_dim)), "clip_feat": rng.random((n, feat_dim))}
+
+def test_round_trip(tmp_path):
+	rng = np.random.default_rng(0)
+	frames = [make_frame(rng, 3), make_frame(rng, 0), make_frame(rng, 2)]
+	frames[1]["vild_feat"] = []
+	frames[1]["clip_feat"] = []
+	writer = MapStoreWriter(feat_dtype="float32", build_params={"clip_model": "ViT-B/32"})
+	for i, frame in enumerate(frames):
+		writer.add_frame(f"color_{i}.jpg", 480, 640, **frame)
+	store = writer.close(str(tmp_path / "map"))
+
+	reopened = MapStore.open(str(tmp_path / "map"))
+	assert len(reopened) == 5
+	assert reopened.frame_names == ["color_0.jpg", "color_1.jpg", "color_2.jpg"]
+	assert reopened.build_params == {"clip_model": "ViT-B/32"}
+	assert reopened.rows_for_frame(1) == slice(3, 3)
+	assert reopened.row("color_2.jpg", 1) == 4
+	assert list(reopened["frame_idx"]) == [0, 0, 0, 2, 2]
+	assert list(reopened["anno_idx"]) == [0, 1, 2, 0, 1]
+	np.testing.assert_allclose(reopened["boxes"][3:], frames[2]["boxes"], rtol=1e-6)
+	np.testing.assert_allclose(np.linalg.norm(reopened["clip_feat"], axis=1), 1, rtol=1e-6)
+	assert reopened.masks.shape == (5, 4, 4)
+	assert not reopened.has_geometry
+
+	#copied frames keep their rows, and geometry written with save_columns
+	store.save_columns({"centroid": np.zeros((5, 3), np.float32), "extent": np.ones((5, 3), np.float32),
+	                    "orientation": np.tile(np.eye(3, dtype=np.float32), (5, 1, 1)), "located": np.ones(5, bool)})
+	writer = MapStoreWriter(feat_dtype="float32")
+	writer.copy_frame(store, 2)
+	writer.copy_frame(store, 1)
+	copied = writer.close()
+	assert copied.frame_names == ["color_2.jpg", "color_1.jpg"]
+	assert copied.has_geometry
+	np.testing.assert_array_equal(copied["vild_feat"], store["vild_feat"][3:])
+
+def test_diff_frames(tmp_path):
+	for name, content in [("a.jpg", b"a"), ("b.jpg", b"b"), ("c.jpg", b"c")]:
+		(tmp_path / name).write_bytes(content)
+	writer = MapStoreWriter()
+	for name in ["a.jpg", "b.jpg", "c.jpg"]:
+		writer.add_frame(name, 1, 1, [], np.zeros((0, 4)), np.zeros((0, 4, 4)), np.zeros((0, 8)), np.zeros((0, 8)), frame_info=frame_fingerprint(str(tmp_path / name)))
+	store = writer.close()
+
+	(tmp_path / "b.jpg").write_bytes(b"changed")
+	os.remove(tmp_path / "c.jpg")
+	(tmp_path / "d.jpg").write_bytes(b"d")
+	unchanged, new, changed, removed = diff_frames(store, str(tmp_path), ["a.jpg", "b.jpg", "d.jpg"])
+	assert list(unchanged) == ["a.jpg"]
+	assert unchanged["a.jpg"][0] == 0
+	assert new == ["d.jpg"]
+	assert changed == ["b.jpg"]
+	assert removed == ["c.jpg"]
+
+	#a touched file with the same content is unchanged
+	os.utime(tmp_path / "a.jpg", (0, 0))
+	unchanged, _, changed, _ = diff_frames(store, str(tmp_path), ["a.jpg"])
+	assert list(unchanged) == ["a.jpg"] and changed == []
+
+def test_cluster_instances_two_cups():
+	#two identical cups 10cm apart seen in two frames: each cup is one instance and the cups are never merged
+	centroids = np.array([[0, 0, 0], [0.1, 0, 0], [0.01, 0, 0], [0.11, 0, 0]])
+	clip_feat = np.array([[1, 0], [1, 0.05], [1, 0.01], [1, 0.06]], dtype=np.float32)
+	clip_feat /= np.linalg.norm(clip_feat, axis=1, keepdims=True)
+	instance = cluster_instances(centroids, clip_feat, np.ones(4, bool), np.array([0, 0, 1, 1]), radius=0.3, min_similarity=0.9)
+	assert list(instance) == [0, 1, 0, 1]
+
+def test_cluster_instances_properties():
+	rng = np.random.default_rng(1)
+	n = 300
+	centroids = rng.random((n, 3))
+	clip_feat = rng.normal(size=(n, 4)).astype(np.float32)
+	clip_feat /= np.linalg.norm(clip_feat, axis=1, keepdims=True)
+	located = rng.random(n) > 0.1
+	frame_idx = rng.integers(0, 20, n)
+	instance = cluster_instances(centroids, clip_feat, located, frame_idx, radius=0.2, min_similarity=0.5)
+
+	assert instance.dtype == np.int32
+	#numbered 0..num_instances-1 in order of first row
+	_, first_rows = np.unique(instance, return_index=True)
+	assert list(instance[np.sort(first_rows)]) == list(range(len(first_rows)))
+	assert len(first_rows) < n
+	for i in np.unique(instance):
+		rows = np.nonzero(instance == i)[0]
+		assert len(set(frame_idx[rows])) == len(rows)
+		assert len(rows) == 1 or located[rows].all()
@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+from vild import vild_utils
+
+def random_boxes(rng, n):
+	corners = rng.random((n, 2))*500
+	sizes = rng.random((n, 2))*100 + 1
+	return np.concatenate([corners, corners + sizes], axis=1), rng.random(n)
+
+@pytest.mark.parametrize("n", [0, 1, 50, vild_utils.MATRIX_NMS_MAX_BOXES, vild_utils.MATRIX_NMS_MAX_BOXES + 50])
+@pytest.mark.parametrize("thresh", [0.3, 0.5])
+def test_nms_mask_matches_nms(n, thresh):
+	rng = np.random.default_rng(n)
+	boxes, scores = random_boxes(rng, n)
+	keep = np.zeros(n, dtype=bool)
+	keep[vild_utils.nms(boxes, scores, thresh)] = True
+	np.testing.assert_array_equal(vild_utils.nms_mask(boxes, scores, thresh), keep)
+
+def test_nms_mask_max_dets():
+	rng = np.random.default_rng(0)
+	boxes, scores = random_boxes(rng, 200)
+	keep = vild_utils.nms_mask(boxes, scores, 0.5, max_dets=10)
+	assert keep.sum() == 10
+	assert sorted(np.nonzero(keep)[0]) == sorted(vild_utils.nms(boxes, scores, 0.5, max_dets=10))
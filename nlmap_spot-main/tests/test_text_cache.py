@@ -0,0 +1,30 @@
+import numpy as np
+from text_cache import TextEmbeddingCache
+
+def test_keys_depend_on_everything_the_embedding_depends_on(tmp_path):
+	cache = TextEmbeddingCache(str(tmp_path / "text.sqlite"), "ViT-B/32")
+	key = cache.key("cup", "a", ["a photo of {}."], True)
+	assert key == cache.key("cup", "a", ["a photo of {}."], True)
+	assert key != cache.key("cup", "a", ["a photo of {}.", "itap of {}."], True)
+	assert key != cache.key("cup", "a", ["a photo of {}."], False)
+	assert key != cache.key("mug", "a", ["a photo of {}."], True)
+	assert key != TextEmbeddingCache(str(tmp_path / "other.sqlite"), "ViT-L/14").key("cup", "a", ["a photo of {}."], True)
+
+def test_put_get(tmp_path):
+	path = str(tmp_path / "text.sqlite")
+	cache = TextEmbeddingCache(path, "ViT-B/32")
+	templates = ["a photo of {}."]
+	keys = [cache.key("cup", "a", templates, True), cache.key("apple", "an", templates, True)]
+	embeddings = np.random.default_rng(0).random((2, 8)).astype(np.float32)
+	cache.put(keys, embeddings)
+	cache.close()
+
+	#another CLIP model sharing the database doesn't see them
+	cache = TextEmbeddingCache(path, "ViT-L/14")
+	assert cache.get([cache.key("cup", "a", templates, True)]) == [None]
+	cache = TextEmbeddingCache(path, "ViT-B/32")
+	assert len(cache) == 2
+	cached = cache.get(keys + [cache.key("cup", "a", templates, False)])
+	np.testing.assert_array_equal(cached[0], embeddings[0])
+	np.testing.assert_array_equal(cached[1], embeddings[1])
+	assert cached[2] is None
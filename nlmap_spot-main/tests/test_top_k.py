@@ -0,0 +1,27 @@
+import pytest
+
+pytest.importorskip("torch")
+from nlmap_utils import TopKAccumulator
+
+def test_keeps_best_k_in_order():
+	accumulator = TopKAccumulator(3)
+	for i, score in enumerate([0.1, 0.9, 0.5, 0.7, 0.3]):
+		accumulator.put((-score, (f"color_{i}.jpg", 0)))
+	assert accumulator.qsize() == 3
+	assert [item[0] for item in accumulator.items()] == [-0.9, -0.7, -0.5]
+	assert [accumulator.get()[1][0] for _ in range(3)] == ["color_1.jpg", "color_3.jpg", "color_2.jpg"]
+	assert accumulator.empty()
+
+def test_duplicate_keys_raise():
+	accumulator = TopKAccumulator(1)
+	accumulator.put((-0.9, ("color_0.jpg", 0)))
+	accumulator.put((-0.1, ("color_0.jpg", 1)))
+	with pytest.raises(Exception):
+		accumulator.put((-0.5, ("color_0.jpg", 0)))
+	#evicted keys are remembered too
+	with pytest.raises(Exception):
+		accumulator.put((-0.5, ("color_0.jpg", 1)))
+
+def test_get_on_empty_raises():
+	with pytest.raises(Exception):
+		TopKAccumulator(2).get()
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("open3d")
+pytest.importorskip("cv2")
+from spot_utils.generate_pointcloud import VoxelFusion
+
+def test_matches_per_voxel_mean():
+	rng = np.random.default_rng(0)
+	voxel_size = 0.1
+	#small merge_size so frames are merged several times
+	fusion = VoxelFusion(voxel_size, merge_size=64)
+	all_points, all_colors = [], []
+	for _ in range(10):
+		points = rng.random((200, 3)) - 0.5
+		colors = rng.random((200, 3))
+		fusion.integrate(points, colors)
+		all_points.append(points)
+		all_colors.append(colors)
+	fusion.integrate(np.zeros((0, 3)), np.zeros((0, 3)))
+	points, colors = fusion.extract()
+
+	all_points = np.concatenate(all_points)
+	all_colors = np.concatenate(all_colors)
+	voxels = {}
+	for point, color in zip(all_points, all_colors):
+		voxels.setdefault(tuple(np.floor(point / voxel_size).astype(int)), []).append(np.concatenate([point, color]))
+	expected = {voxel: np.mean(rows, axis=0) for voxel, rows in voxels.items()}
+
+	assert fusion.points_in == 2000
+	assert len(points) == len(expected)
+	for point, color in zip(points, colors):
+		np.testing.assert_allclose(np.concatenate([point, color]), expected[tuple(np.floor(point / voxel_size).astype(int))], atol=1e-9)
@@ -0,0 +1,50 @@
+import hashlib
+import json
+import sqlite3
+import numpy as np
+
+class TextEmbeddingCache():
+	'''
+	On-disk cache of CLIP text embeddings of single phrases, in a small sqlite database. An embedding is stored under
+	(CLIP model, hash of the prompt template set, this_is, normalized phrase, article), everything its value depends
+	on, so changing the categories of a config never loads stale embeddings and only phrases never seen before are
+	encoded. The cache is not tied to a data directory: all maps built with the same CLIP model share it.
+
+	Several processes (e.g. the workers of a sharded build) may use the same database.
+	'''
+	def __init__(self, path, model_name):
+		self.path = path
+		self.model_name = model_name
+		self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+		self.connection.execute("""CREATE TABLE IF NOT EXISTS text_embeddings (
+			model TEXT, templates TEXT, this_is INTEGER, phrase TEXT, article TEXT, embedding BLOB,
+			PRIMARY KEY (model, templates, this_is, phrase, article))""")
+		self.connection.commit()
+
+	@staticmethod
+	def templates_hash(templates):
+		return hashlib.sha1(json.dumps(list(templates)).encode("utf-8")).hexdigest()
+
+	def key(self, phrase, article, templates, this_is):
+		return (self.model_name, self.templates_hash(templates), int(this_is), phrase, article)
+
+	def get(self, keys):
+		'''
+		Returns the cached embedding (float32 array) of every key, None where there is none
+		'''
+		embeddings = []
+		for key in keys:
+			row = self.connection.execute("SELECT embedding FROM text_embeddings WHERE model=? AND templates=? AND this_is=? AND phrase=? AND article=?", key).fetchone()
+			embeddings.append(None if row is None else np.frombuffer(row[0], dtype=np.float32))
+		return embeddings
+
+	def put(self, keys, embeddings):
+		with self.connection:
+			self.connection.executemany("INSERT OR REPLACE INTO text_embeddings VALUES (?, ?, ?, ?, ?, ?)",
+			                            [key + (np.asarray(embedding, dtype=np.float32).tobytes(),) for key, embedding in zip(keys, embeddings)])
+
+	def __len__(self):
+		return self.connection.execute("SELECT COUNT(*) FROM text_embeddings").fetchone()[0]
+
+	def close(self):
+		self.connection.close()
@@ -0,0 +1,102 @@
+"""Benchmark of the NMS used by extract_roi_vild.
+
+Compares per-frame time of the original while-loop `nms` (+ np.isin to turn its
+indices into a mask, as extract_roi_vild did) with the matrix-IoU path of
+`nms_mask` at ViLD proposal counts. Proposals are clustered around a few objects
+like RPN outputs, so many of them overlap. Every run also checks that all paths
+keep the same boxes. The crossover of the first two columns is where
+MATRIX_NMS_MAX_BOXES should be: `nms_mask` uses the loop above it.
+
+The last column times NMS as extract_roi_vild runs it: only proposals with a
+score of at least --min_score ([vild] min_rpn_score_thresh) go through
+nms_mask, against the old loop over every proposal. Both give the same boxes
+above --min_score, which is all extract_roi_vild keeps.
+
+Run from the nlmap_spot-main directory:
+  python -m vild.benchmark_nms --num_proposals 100 200 300 1000
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from vild import vild_utils
+from vild.vild_utils import nms, nms_mask
+
+
+def make_proposals(rng, num_proposals, num_objects=20, image_height=480, image_width=640):
+  centers = rng.uniform([0, 0], [image_height, image_width], size=(num_objects, 2))
+  sizes = rng.uniform(20, 200, size=(num_objects, 2))
+  which = rng.integers(num_objects, size=num_proposals)
+  jitter = rng.normal(scale=0.15, size=(num_proposals, 4))
+  center = centers[which] + jitter[:, :2] * sizes[which]
+  size = sizes[which] * np.exp(jitter[:, 2:])
+  boxes = np.concatenate([center - size / 2, center + size / 2], axis=1)
+  boxes = np.clip(boxes, 0, [image_height, image_width, image_height, image_width])
+  scores = rng.uniform(size=num_proposals)
+  return boxes, scores
+
+
+def time_per_frame(fn, frames, repeats):
+  best = np.inf
+  for _ in range(repeats):
+    start = time.perf_counter()
+    fn(frames)
+    best = min(best, (time.perf_counter() - start) / len(frames))
+  return best
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark NMS implementations at ViLD proposal counts")
+  parser.add_argument("--num_proposals", type=int, nargs="+", default=[50, 100, 200, 300, 1000])
+  parser.add_argument("--num_frames", type=int, default=16)
+  parser.add_argument("--thresh", type=float, default=0.6)
+  parser.add_argument("--min_score", type=float, default=0.9)
+  parser.add_argument("--repeats", type=int, default=5)
+  args = parser.parse_args()
+
+  rng = np.random.default_rng(0)
+  print(f"{'proposals':>10} {'loop nms+isin (ms)':>20} {'matrix (ms)':>12} {'nms_mask (ms)':>14} {'prefiltered (ms)':>17} {'speedup':>8}")
+  for num_proposals in args.num_proposals:
+    frames = [make_proposals(rng, num_proposals) for _ in range(args.num_frames)]
+    scores = np.stack([frame_scores for _, frame_scores in frames])
+
+    def run_loop(frames):
+      return [np.isin(np.arange(len(frame_scores)), nms(boxes, frame_scores, thresh=args.thresh)) for boxes, frame_scores in frames]
+
+    def run_mask(frames):
+      return [nms_mask(boxes, frame_scores, thresh=args.thresh) for boxes, frame_scores in frames]
+
+    def run_matrix(frames):
+      cutoff = vild_utils.MATRIX_NMS_MAX_BOXES
+      vild_utils.MATRIX_NMS_MAX_BOXES = num_proposals
+      try:
+        return run_mask(frames)
+      finally:
+        vild_utils.MATRIX_NMS_MAX_BOXES = cutoff
+
+    def run_prefiltered(frames):
+      keeps = []
+      for boxes, frame_scores in frames:
+        candidates = np.nonzero(frame_scores >= args.min_score)[0]
+        keep = np.zeros(len(frame_scores), dtype=bool)
+        keep[candidates] = nms_mask(boxes[candidates], frame_scores[candidates], thresh=args.thresh)
+        keeps.append(keep)
+      return keeps
+
+    expected = np.stack(run_loop(frames))
+    assert np.array_equal(expected, np.stack(run_mask(frames))), "nms_mask differs from nms"
+    assert np.array_equal(expected, np.stack(run_matrix(frames))), "matrix nms differs from nms"
+    above = scores >= args.min_score
+    assert np.array_equal(expected & above, np.stack(run_prefiltered(frames))), "prefiltered nms_mask differs from nms"
+
+    loop_time = time_per_frame(run_loop, frames, args.repeats)
+    mask_time = time_per_frame(run_mask, frames, args.repeats)
+    matrix_time = time_per_frame(run_matrix, frames, args.repeats)
+    prefiltered_time = time_per_frame(run_prefiltered, frames, args.repeats)
+    print(f"{num_proposals:>10} {loop_time*1000:>20.3f} {matrix_time*1000:>12.3f} {mask_time*1000:>14.3f} {prefiltered_time*1000:>17.3f} {loop_time/prefiltered_time:>7.1f}x")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,101 @@
+"""Benchmark of prompt-ensemble text encoding in build_text_embedding.
+
+Compares categories per second of encoding the prompts of one category per
+encode_text call (how build_text_embedding used to work) with encoding the
+prompts of all categories in fixed-size batches, and checks that both give the
+same embeddings. Categories come from --config_path and are padded with
+"{color} {object}" and "{size} {color} {object}" phrases up to
+--num_categories (at most 800 of them), like the large scene vocabularies of
+the demos. Both paths are warmed up first and every timing is
+the best of --repeats runs, so model loading and first-call setup (CUDA
+context, kernel selection) are not counted.
+
+Run from the nlmap_spot-main directory:
+  python -m vild.benchmark_text_embedding --num_categories 50 300
+"""
+
+import argparse
+import configparser
+import itertools
+import time
+
+import numpy as np
+import torch
+import clip
+
+from vild.vild_utils import build_text_embedding, category_texts, text_templates
+
+COLORS = ['red', 'green', 'blue', 'yellow', 'black', 'white', 'wooden', 'metal', 'plastic', 'glass']
+OBJECTS = ['cup', 'bottle', 'chair', 'table', 'book', 'bowl', 'plate', 'box', 'bag', 'lamp',
+           'shoe', 'phone', 'laptop', 'keyboard', 'pillow', 'towel', 'spoon', 'knife', 'door', 'plant']
+SIZES = ['small', 'large', 'tall']
+
+
+def make_categories(config_path, num_categories):
+  names = []
+  if config_path is not None:
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    names = [x.strip() for x in config['text']['category_name_string'].split(';')]
+  names += [f'{color} {obj}' for color, obj in itertools.product(COLORS, OBJECTS)]
+  names += [f'{size} {color} {obj}' for size, color, obj in itertools.product(SIZES, COLORS, OBJECTS)]
+  names = list(dict.fromkeys(names))
+  if len(names) < num_categories:
+    raise ValueError(f'asked for {num_categories} categories, only {len(names)} distinct phrases are available')
+  names = names[:num_categories]
+  return [{'name': name, 'id': idx + 1} for idx, name in enumerate(names)]
+
+
+def per_category_embedding(categories, model, templates):
+  """Reference: one encode_text call per category."""
+  embeddings = []
+  with torch.no_grad():
+    for category in categories:
+      texts = clip.tokenize(category_texts(category['name'], templates))
+      if torch.cuda.is_available():
+        texts = texts.cuda()
+      text_embeddings = model.encode_text(texts)
+      text_embeddings /= text_embeddings.norm(dim=-1, keepdim=True)
+      text_embedding = text_embeddings.mean(dim=0)
+      text_embedding /= text_embedding.norm()
+      embeddings.append(text_embedding.float().cpu().numpy())
+  return np.stack(embeddings, axis=0)
+
+
+def best_time(fn, repeats):
+  best = float('inf')
+  for _ in range(repeats):
+    start = time.perf_counter()
+    result = fn()
+    best = min(best, time.perf_counter() - start)
+  return best, result
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark per-category vs batched CLIP text encoding")
+  parser.add_argument("--model", type=str, default="ViT-B/32")
+  parser.add_argument("--config_path", type=str, default="./configs/example.ini")
+  parser.add_argument("--num_categories", type=int, nargs="+", default=[50, 200])
+  parser.add_argument("--batch_size", type=int, default=256)
+  parser.add_argument("--repeats", type=int, default=3)
+  args = parser.parse_args()
+
+  model, preprocess = clip.load(args.model)
+  templates = text_templates(prompt_engineering=True)
+  print(f"{len(templates)} templates per category, device {'cuda' if torch.cuda.is_available() else 'cpu'}")
+  warmup = make_categories(None, 4)
+  per_category_embedding(warmup, model, templates)
+  build_text_embedding(warmup, model, preprocess, batch_size=args.batch_size)
+  print(f"{'categories':>10} {'per category (cat/s)':>21} {'batched (cat/s)':>16} {'speedup':>8} {'max abs diff':>13}")
+  for num_categories in args.num_categories:
+    categories = make_categories(args.config_path, num_categories)
+
+    per_category_time, expected = best_time(lambda: per_category_embedding(categories, model, templates), args.repeats)
+    batched_time, batched = best_time(lambda: build_text_embedding(categories, model, preprocess, batch_size=args.batch_size), args.repeats)
+
+    print(f"{len(categories):>10} {len(categories)/per_category_time:>21.1f} {len(categories)/batched_time:>16.1f} "
+          f"{per_category_time/batched_time:>7.1f}x {np.abs(expected - batched).max():>13.2e}")
+
+
+if __name__ == "__main__":
+  main()
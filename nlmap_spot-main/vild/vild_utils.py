@@ -1,30 +1,18 @@
-from easydict import EasyDict
-
+# tensorflow, torch, clip, matplotlib and cv2 are imported by the functions that use them, so importing this module
+# for the text/mask/box helpers stays cheap.
 import numpy as np
-import torch
-import clip
 
 from tqdm import tqdm
 
-from matplotlib import pyplot as plt
-from matplotlib import patches
-
 import collections
 import json
-import numpy as np
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import os
 import os.path as osp
 
 from PIL import Image
-from pprint import pprint
-from scipy.special import softmax
-import yaml
-
-
-import tensorflow.compat.v1 as tf
-
-import cv2
 
 
 def article(name):
@@ -39,118 +27,157 @@ def processed_name(name, rm_dot=False):
   return res
 
 
-def build_text_embedding(categories,model,preprocess,prompt_engineering=True,this_is=True):
-  if prompt_engineering:
-    templates = [
-      'There is {article} {} in the scene.',
-      'There is the {} in the scene.',
-      'a photo of {article} {} in the scene.',
-      'a photo of the {} in the scene.',
-      'a photo of one {} in the scene.',
-
-
-      'itap of {article} {}.',
-      'itap of my {}.',  # itap: I took a picture of
-      'itap of the {}.',
-      'a photo of {article} {}.',
-      'a photo of my {}.',
-      'a photo of the {}.',
-      'a photo of one {}.',
-      'a photo of many {}.',
-
-      'a good photo of {article} {}.',
-      'a good photo of the {}.',
-      'a bad photo of {article} {}.',
-      'a bad photo of the {}.',
-      'a photo of a nice {}.',
-      'a photo of the nice {}.',
-      'a photo of a cool {}.',
-      'a photo of the cool {}.',
-      'a photo of a weird {}.',
-      'a photo of the weird {}.',
-
-      'a photo of a small {}.',
-      'a photo of the small {}.',
-      'a photo of a large {}.',
-      'a photo of the large {}.',
-
-      'a photo of a clean {}.',
-      'a photo of the clean {}.',
-      'a photo of a dirty {}.',
-      'a photo of the dirty {}.',
-
-      'a bright photo of {article} {}.',
-      'a bright photo of the {}.',
-      'a dark photo of {article} {}.',
-      'a dark photo of the {}.',
-
-      'a photo of a hard to see {}.',
-      'a photo of the hard to see {}.',
-      'a low resolution photo of {article} {}.',
-      'a low resolution photo of the {}.',
-      'a cropped photo of {article} {}.',
-      'a cropped photo of the {}.',
-      'a close-up photo of {article} {}.',
-      'a close-up photo of the {}.',
-      'a jpeg corrupted photo of {article} {}.',
-      'a jpeg corrupted photo of the {}.',
-      'a blurry photo of {article} {}.',
-      'a blurry photo of the {}.',
-      'a pixelated photo of {article} {}.',
-      'a pixelated photo of the {}.',
-
-      'a black and white photo of the {}.',
-      'a black and white photo of {article} {}.',
-
-      'a plastic {}.',
-      'the plastic {}.',
-
-      'a toy {}.',
-      'the toy {}.',
-      'a plushie {}.',
-      'the plushie {}.',
-      'a cartoon {}.',
-      'the cartoon {}.',
-
-      'an embroidered {}.',
-      'the embroidered {}.',
-
-      'a painting of the {}.',
-      'a painting of a {}.',
-    ]
+PROMPT_TEMPLATES = [
+  'There is {article} {} in the scene.',
+  'There is the {} in the scene.',
+  'a photo of {article} {} in the scene.',
+  'a photo of the {} in the scene.',
+  'a photo of one {} in the scene.',
+
+
+  'itap of {article} {}.',
+  'itap of my {}.',  # itap: I took a picture of
+  'itap of the {}.',
+  'a photo of {article} {}.',
+  'a photo of my {}.',
+  'a photo of the {}.',
+  'a photo of one {}.',
+  'a photo of many {}.',
+
+  'a good photo of {article} {}.',
+  'a good photo of the {}.',
+  'a bad photo of {article} {}.',
+  'a bad photo of the {}.',
+  'a photo of a nice {}.',
+  'a photo of the nice {}.',
+  'a photo of a cool {}.',
+  'a photo of the cool {}.',
+  'a photo of a weird {}.',
+  'a photo of the weird {}.',
+
+  'a photo of a small {}.',
+  'a photo of the small {}.',
+  'a photo of a large {}.',
+  'a photo of the large {}.',
+
+  'a photo of a clean {}.',
+  'a photo of the clean {}.',
+  'a photo of a dirty {}.',
+  'a photo of the dirty {}.',
+
+  'a bright photo of {article} {}.',
+  'a bright photo of the {}.',
+  'a dark photo of {article} {}.',
+  'a dark photo of the {}.',
+
+  'a photo of a hard to see {}.',
+  'a photo of the hard to see {}.',
+  'a low resolution photo of {article} {}.',
+  'a low resolution photo of the {}.',
+  'a cropped photo of {article} {}.',
+  'a cropped photo of the {}.',
+  'a close-up photo of {article} {}.',
+  'a close-up photo of the {}.',
+  'a jpeg corrupted photo of {article} {}.',
+  'a jpeg corrupted photo of the {}.',
+  'a blurry photo of {article} {}.',
+  'a blurry photo of the {}.',
+  'a pixelated photo of {article} {}.',
+  'a pixelated photo of the {}.',
+
+  'a black and white photo of the {}.',
+  'a black and white photo of {article} {}.',
+
+  'a plastic {}.',
+  'the plastic {}.',
+
+  'a toy {}.',
+  'the toy {}.',
+  'a plushie {}.',
+  'the plushie {}.',
+  'a cartoon {}.',
+  'the cartoon {}.',
+
+  'an embroidered {}.',
+  'the embroidered {}.',
+
+  'a painting of the {}.',
+  'a painting of a {}.',
+]
 
-  else:
-    templates =[
-      'a photo of {article} {}.'
-    ]
+SINGLE_TEMPLATE = [
+  'a photo of {article} {}.'
+]
+
+def text_templates(prompt_engineering=True):
+  return PROMPT_TEMPLATES if prompt_engineering else SINGLE_TEMPLATE
+
+def category_texts(name, templates, this_is=True):
+  texts = [
+    template.format(processed_name(name, rm_dot=True),
+                    article=article(name))
+    for template in templates]
+  if this_is:
+    texts = [
+             'This is ' + text if text.startswith('a') or text.startswith('the') else text 
+             for text in texts
+             ]
+  return texts
+
+def build_text_embedding(categories,model,preprocess,prompt_engineering=True,this_is=True,cache=None,batch_size=256):
+  """Prompt-ensembled CLIP text embedding of every category.
+
+  The category x template prompts of all categories are tokenized at once and
+  encoded in batches of batch_size, independent of how many templates a
+  category has. Every category has the same number of templates, so the
+  per-category means are one reshape and mean over the normalized prompt
+  embeddings.
+
+  Args:
+    categories: list of {'name': ...} dicts
+    model, preprocess: CLIP model. Not used (and may be None) if every category is in cache
+    cache: optional TextEmbeddingCache. Only categories missing from it are encoded, and then added to it
+    batch_size: prompts encoded per forward pass
+  Returns:
+    [num_categories, D] L2-normalized embeddings
+  """
+  templates = text_templates(prompt_engineering)
+
+  embeddings = [None] * len(categories)
+  if cache is not None:
+    keys = [cache.key(processed_name(category['name'], rm_dot=True), article(category['name']), templates, this_is) for category in categories]
+    embeddings = cache.get(keys)
+  missing = [idx for idx, embedding in enumerate(embeddings) if embedding is None]
+  if len(missing) == 0:
+    return np.stack(embeddings, axis=0)
+
+  import torch
+  import clip
 
   run_on_gpu = torch.cuda.is_available()
 
   with torch.no_grad():
-    all_text_embeddings = []
-    print('Building text embeddings...')
-    for category in tqdm(categories):
-      texts = [
-        template.format(processed_name(category['name'], rm_dot=True),
-                        article=article(category['name']))
-        for template in templates]
-      if this_is:
-        texts = [
-                 'This is ' + text if text.startswith('a') or text.startswith('the') else text 
-                 for text in texts
-                 ]
-      texts = clip.tokenize(texts) #tokenize
+    print(f'Building text embeddings of {len(missing)} categories...')
+    texts = [text for idx in missing for text in category_texts(categories[idx]['name'], templates, this_is)]
+    tokens = clip.tokenize(texts) #tokenize
+    text_embeddings = []
+    for start in tqdm(range(0, len(texts), batch_size)):
+      batch = tokens[start:start + batch_size]
       if run_on_gpu:
-        texts = texts.cuda()
-      text_embeddings = model.encode_text(texts) #embed with text encoder
-      text_embeddings /= text_embeddings.norm(dim=-1, keepdim=True)
-      text_embedding = text_embeddings.mean(dim=0)
-      text_embedding /= text_embedding.norm()
-      all_text_embeddings.append(text_embedding)
-    all_text_embeddings = torch.stack(all_text_embeddings, dim=1)
-    if run_on_gpu:
-      all_text_embeddings = all_text_embeddings.cuda()
-  return all_text_embeddings.cpu().numpy().T
+        batch = batch.cuda()
+      batch_embeddings = model.encode_text(batch) #embed with text encoder
+      text_embeddings.append(batch_embeddings / batch_embeddings.norm(dim=-1, keepdim=True))
+    text_embeddings = torch.cat(text_embeddings, dim=0)
+
+    category_embeddings = text_embeddings.reshape(len(missing), len(templates), -1).mean(dim=1)
+    category_embeddings /= category_embeddings.norm(dim=-1, keepdim=True)
+    category_embeddings = category_embeddings.float().cpu().numpy()
+  for row, idx in enumerate(missing):
+    embeddings[idx] = category_embeddings[row]
+
+  if cache is not None:
+    cache.put([keys[idx] for idx in missing], [embeddings[idx] for idx in missing])
+  return np.stack(embeddings, axis=0)
 
 #@title NMS
 def nms(dets, scores, thresh, max_dets=1000):
@@ -188,6 +215,85 @@ def nms(dets, scores, thresh, max_dets=1000):
     order = order[inds + 1]
   return keep
 
+# Above this many boxes the loop in `nms` is faster than the IoU matrix of
+# `nms_mask`. Measured with vild/benchmark_nms.py (per frame, loop vs matrix):
+# 400 boxes 3.0-3.4 vs 2.2-2.5 ms, 450 boxes 2.8-3.4 vs 2.2-2.5 ms,
+# 500 boxes 2.7-2.9 vs 2.9-3.2 ms, 1000 boxes 3.8 vs 11.2 ms.
+MATRIX_NMS_MAX_BOXES = 450
+
+
+def suppression_matrix(sorted_dets, thresh, block_size=128):
+  """Which boxes suppress which, for boxes sorted by decreasing score.
+  Args:
+    sorted_dets: [N, 4] boxes (y1, x1, y2, x2), highest score first
+    thresh: iou threshold. Float
+    block_size: rows computed at once. Only the upper triangle is needed, so
+      rows are done in blocks against the columns after them.
+  Returns:
+    [N, N] bools, [j, i] is True iff j < i and IoU(j, i) > thresh.
+  """
+  num_boxes = sorted_dets.shape[0]
+  y1, x1, y2, x2 = [sorted_dets[:, i] for i in range(4)]
+  areas = (x2 - x1) * (y2 - y1)
+
+  suppresses = np.zeros((num_boxes, num_boxes), dtype=bool)
+  for start in range(0, num_boxes, block_size):
+    rows = slice(start, min(start + block_size, num_boxes))
+    cols = slice(start, num_boxes)
+    # IoU > thresh  <=>  intersection * (1 + thresh) > thresh * (area_a + area_b)
+    w = np.minimum(x2[rows, None], x2[None, cols])
+    w -= np.maximum(x1[rows, None], x1[None, cols])
+    np.maximum(w, 0.0, out=w)
+    h = np.minimum(y2[rows, None], y2[None, cols])
+    h -= np.maximum(y1[rows, None], y1[None, cols])
+    np.maximum(h, 0.0, out=h)
+    w *= h
+    w *= (1.0 + thresh)
+    area_sums = areas[rows, None] + areas[None, cols]
+    area_sums += 1e-12
+    area_sums *= thresh
+    suppresses[rows, cols] = w > area_sums
+  return np.triu(suppresses, k=1)
+
+
+def nms_mask(dets, scores, thresh, max_dets=1000):
+  """Non-maximum suppression returning a mask instead of indices.
+
+  Keeps the same boxes as `nms`: a box is kept iff no kept box with a higher
+  score overlaps it by more than thresh. Up to MATRIX_NMS_MAX_BOXES boxes,
+  that rule is applied to all boxes at once (one matrix product) until nothing
+  changes; the number of steps is the length of the longest chain of
+  suppressions, which is small for RPN proposals. Larger inputs use `nms`.
+
+  Args:
+    dets: [N, 4] boxes (y1, x1, y2, x2)
+    scores: [N,]
+    thresh: iou threshold. Float
+    max_dets: int.
+  Returns:
+    keep: [N,] bools, True for the boxes that survive NMS.
+  """
+  dets = np.asarray(dets, dtype=np.float64)
+  scores = np.asarray(scores, dtype=np.float64)
+  keep = np.zeros(len(scores), dtype=bool)
+  if len(scores) > MATRIX_NMS_MAX_BOXES:
+    keep[nms(dets, scores, thresh, max_dets=max_dets)] = True
+    return keep
+
+  order = np.argsort(-scores, kind='stable')
+  suppresses = suppression_matrix(dets[order], thresh).astype(np.float32)
+
+  keep_sorted = np.ones(len(scores), dtype=bool)
+  while True:
+    new_keep = ~(keep_sorted.astype(np.float32).dot(suppresses) > 0)
+    if np.array_equal(new_keep, keep_sorted):
+      break
+    keep_sorted = new_keep
+
+  keep_sorted &= np.cumsum(keep_sorted) <= max_dets
+  keep[order] = keep_sorted
+  return keep
+
 #@title Visualization
 import PIL.ImageColor as ImageColor
 import PIL.ImageDraw as ImageDraw
@@ -500,11 +606,63 @@ def visualize_boxes_and_labels_on_image_array(
   return image
 
 
-def paste_instance_masks(masks,
-                         detected_boxes,
-                         image_height,
-                         image_width):
-  """Paste instance masks to generate the image segmentation results.
+class CropMasks(object):
+  """Instance masks kept crop-locally: the part of every resized mask that lies
+  inside the image, plus where that part goes on the image. Memory is the total
+  box area instead of N x image_height x image_width.
+
+  Indexing works like the [N, image_height, image_width] array returned by
+  `paste_instance_masks`: an integer gives one full-image mask, anything else
+  (slice, index array) gives a stacked array. Full-image masks are only made
+  when indexed.
+
+  Attributes:
+    regions: a numpy int32 array of shape [N, 4] with the (y_0, x_0, y_1, x_1)
+      image region of every crop.
+    crops: a list of N uint8 arrays, crop i has shape
+      [y_1 - y_0, x_1 - x_0] of regions[i].
+  """
+
+  def __init__(self, regions, crops, image_height, image_width):
+    self.regions = regions
+    self.crops = crops
+    self.image_height = image_height
+    self.image_width = image_width
+
+  def __len__(self):
+    return len(self.crops)
+
+  @property
+  def nbytes(self):
+    return sum(crop.nbytes for crop in self.crops)
+
+  def full(self, index):
+    """Returns mask `index` pasted on an image_height x image_width canvas."""
+    y_0, x_0, y_1, x_1 = self.regions[index]
+    im_mask = np.zeros((self.image_height, self.image_width), dtype=np.uint8)
+    im_mask[y_0:y_1, x_0:x_1] = self.crops[index]
+    return im_mask
+
+  def __getitem__(self, index):
+    if np.isscalar(index) or (isinstance(index, np.ndarray) and index.ndim == 0):
+      return self.full(int(index))
+    indices = np.arange(len(self))[index]
+    segms = np.zeros((len(indices), self.image_height, self.image_width), dtype=np.uint8)
+    for out_ind, mask_ind in enumerate(indices):
+      y_0, x_0, y_1, x_1 = self.regions[mask_ind]
+      segms[out_ind, y_0:y_1, x_0:x_1] = self.crops[mask_ind]
+    return segms
+
+  def __array__(self, dtype=None):
+    segms = self[:]
+    return segms if dtype is None else segms.astype(dtype)
+
+
+def crop_instance_masks(masks,
+                        detected_boxes,
+                        image_height,
+                        image_width):
+  """Resize instance masks into their boxes without pasting them on the image.
 
   Args:
     masks: a numpy array of shape [N, mask_height, mask_width] representing the
@@ -515,30 +673,12 @@ def paste_instance_masks(masks,
     image_width: an integer representing the width of the image.
 
   Returns:
-    segms: a numpy array of shape [N, image_height, image_width] representing
-      the instance masks *pasted* on the image canvas.
+    a CropMasks holding the binarized masks clipped to the image.
   """
+  import cv2
 
-  def expand_boxes(boxes, scale):
-    """Expands an array of boxes by a given scale."""
-    # Reference: https://github.com/facebookresearch/Detectron/blob/master/detectron/utils/boxes.py#L227  # pylint: disable=line-too-long
-    # The `boxes` in the reference implementation is in [x1, y1, x2, y2] form,
-    # whereas `boxes` here is in [x1, y1, w, h] form
-    w_half = boxes[:, 2] * .5
-    h_half = boxes[:, 3] * .5
-    x_c = boxes[:, 0] + w_half
-    y_c = boxes[:, 1] + h_half
-
-    w_half *= scale
-    h_half *= scale
-
-    boxes_exp = np.zeros(boxes.shape)
-    boxes_exp[:, 0] = x_c - w_half
-    boxes_exp[:, 2] = x_c + w_half
-    boxes_exp[:, 1] = y_c - h_half
-    boxes_exp[:, 3] = y_c + h_half
-
-    return boxes_exp
+  _, mask_height, mask_width = masks.shape
+  detected_boxes = np.asarray(detected_boxes, dtype=np.float64).reshape(-1, 4)
 
   # Reference: https://github.com/facebookresearch/Detectron/blob/master/detectron/core/test.py#L812  # pylint: disable=line-too-long
   # To work around an issue with cv2.resize (it seems to automatically pad
@@ -546,42 +686,61 @@ def paste_instance_masks(masks,
   # prior to resizing back to the original image resolution. This prevents
   # "top hat" artifacts. We therefore need to expand the reference boxes by an
   # appropriate factor.
-  _, mask_height, mask_width = masks.shape
   scale = max((mask_width + 2.0) / mask_width,
               (mask_height + 2.0) / mask_height)
 
-  ref_boxes = expand_boxes(detected_boxes, scale)
-  ref_boxes = ref_boxes.astype(np.int32)
-  padded_mask = np.zeros((mask_height + 2, mask_width + 2), dtype=np.float32)
-  segms = []
-  for mask_ind, mask in enumerate(masks):
-    im_mask = np.zeros((image_height, image_width), dtype=np.uint8)
-    # Process mask inside bounding boxes.
-    padded_mask[1:-1, 1:-1] = mask[:, :]
-
-    ref_box = ref_boxes[mask_ind, :]
-    w = ref_box[2] - ref_box[0] + 1
-    h = ref_box[3] - ref_box[1] + 1
-    w = np.maximum(w, 1)
-    h = np.maximum(h, 1)
-
-    mask = cv2.resize(padded_mask, (w, h))
-    mask = np.array(mask > 0.5, dtype=np.uint8)
-
-    x_0 = min(max(ref_box[0], 0), image_width)
-    x_1 = min(max(ref_box[2] + 1, 0), image_width)
-    y_0 = min(max(ref_box[1], 0), image_height)
-    y_1 = min(max(ref_box[3] + 1, 0), image_height)
-
-    im_mask[y_0:y_1, x_0:x_1] = mask[
-        (y_0 - ref_box[1]):(y_1 - ref_box[1]),
-        (x_0 - ref_box[0]):(x_1 - ref_box[0])
-    ]
-    segms.append(im_mask)
-
-  segms = np.array(segms)
+  # Expand all boxes ([x1, y1, w, h] form) around their centers at once.
+  # Reference: https://github.com/facebookresearch/Detectron/blob/master/detectron/utils/boxes.py#L227  # pylint: disable=line-too-long
+  w_half = detected_boxes[:, 2] * .5 * scale
+  h_half = detected_boxes[:, 3] * .5 * scale
+  x_c = detected_boxes[:, 0] + detected_boxes[:, 2] * .5
+  y_c = detected_boxes[:, 1] + detected_boxes[:, 3] * .5
+  ref_boxes = np.stack([x_c - w_half, y_c - h_half, x_c + w_half, y_c + h_half], axis=1).astype(np.int32)
+
+  w = np.maximum(ref_boxes[:, 2] - ref_boxes[:, 0] + 1, 1)
+  h = np.maximum(ref_boxes[:, 3] - ref_boxes[:, 1] + 1, 1)
+  x_0 = np.clip(ref_boxes[:, 0], 0, image_width)
+  x_1 = np.clip(ref_boxes[:, 2] + 1, 0, image_width)
+  y_0 = np.clip(ref_boxes[:, 1], 0, image_height)
+  y_1 = np.clip(ref_boxes[:, 3] + 1, 0, image_height)
+  regions = np.stack([y_0, x_0, np.maximum(y_1, y_0), np.maximum(x_1, x_0)], axis=1).astype(np.int32)
+
+  # Every mask has its own output size, so they are resized one at a time;
+  # only the part inside the image is kept.
+  padded_masks = np.zeros((len(masks), mask_height + 2, mask_width + 2), dtype=np.float32)
+  padded_masks[:, 1:-1, 1:-1] = masks
+  crops = []
+  for mask_ind in range(len(masks)):
+    mask = cv2.resize(padded_masks[mask_ind], (int(w[mask_ind]), int(h[mask_ind])))
+    r_y_0, r_x_0, r_y_1, r_x_1 = regions[mask_ind]
+    crop = mask[(r_y_0 - ref_boxes[mask_ind, 1]):(r_y_1 - ref_boxes[mask_ind, 1]),
+                (r_x_0 - ref_boxes[mask_ind, 0]):(r_x_1 - ref_boxes[mask_ind, 0])]
+    crops.append(np.array(crop > 0.5, dtype=np.uint8))
+
+  return CropMasks(regions, crops, image_height, image_width)
+
+
+def paste_instance_masks(masks,
+                         detected_boxes,
+                         image_height,
+                         image_width):
+  """Paste instance masks to generate the image segmentation results.
+
+  Args:
+    masks: a numpy array of shape [N, mask_height, mask_width] representing the
+      instance masks w.r.t. the `detected_boxes`.
+    detected_boxes: a numpy array of shape [N, 4] representing the reference
+      bounding boxes.
+    image_height: an integer representing the height of the image.
+    image_width: an integer representing the width of the image.
+
+  Returns:
+    segms: a numpy array of shape [N, image_height, image_width] representing
+      the instance masks *pasted* on the image canvas.
+  """
+  segms = crop_instance_masks(masks, detected_boxes, image_height, image_width)[:]
   assert masks.shape[0] == segms.shape[0]
-  return segms  
+  return segms
 
 
 #@title Plot instance masks
@@ -599,6 +758,7 @@ def plot_mask(color, alpha, original_image, mask):
      
 
 def display_image(path_or_array, size=(10, 10)):
+  from matplotlib import pyplot as plt
   if isinstance(path_or_array, str):
     image = np.asarray(Image.open(open(path_or_array, 'rb')).convert("RGB"))
   else:
@@ -610,6 +770,7 @@ def display_image(path_or_array, size=(10, 10)):
   plt.show()
 
 def configire_matplotlib_settings():  
+  from matplotlib import pyplot as plt
   # Global matplotlib settings
   SMALL_SIZE = 16#10
   MEDIUM_SIZE = 18#12
@@ -623,28 +784,33 @@ def configire_matplotlib_settings():
   plt.rc('legend', fontsize=MEDIUM_SIZE)    # legend fontsize
   plt.rc('figure', titlesize=BIGGER_SIZE)  # fontsize of the figure title
 
+VILD_OUTPUT_TENSORS = ['RoiBoxes:0', 'RoiScores:0', '2ndStageBoxes:0', '2ndStageScoresUnused:0', 'BoxOutputs:0', 'MaskOutputs:0', 'VisualFeatOutputs:0', 'ImageInfo:0']
+
 def extract_roi_vild(image_path,session,params):
+  #################################################################
+  # Obtain results and read image
+  outputs = session.run(VILD_OUTPUT_TENSORS, feed_dict={'Placeholder:0': [image_path,]})
+  return filter_roi_vild(image_path, [output[0] for output in outputs], params)
+
+def filter_roi_vild(image_path,outputs,params,image=None,read_image=True):
+  """Filters the ViLD outputs of one image, see `extract_roi_vild`.
+  Args:
+    image_path: path of the image, only read if image is None
+    outputs: session outputs for VILD_OUTPUT_TENSORS, without the batch dimension
+    params: (max_boxes_to_draw, nms_threshold, min_rpn_score_thresh, min_box_area)
+    image: optional HxWx3 uint8 image already decoded by the graph
+    read_image: if False and image is None, the image is not read and None is returned in its place
+  """
   #################################################################
   # Unpack parameters
   max_boxes_to_draw, nms_threshold, min_rpn_score_thresh, min_box_area = params
   # fig_size_h = min(max(5, int(len(category_names) / 2.5) ), 10)
   #################################################################
-  # Obtain results and read image
-  roi_boxes, roi_scores, detection_boxes, scores_unused, box_outputs, detection_masks, visual_features, image_info = session.run(
-        ['RoiBoxes:0', 'RoiScores:0', '2ndStageBoxes:0', '2ndStageScoresUnused:0', 'BoxOutputs:0', 'MaskOutputs:0', 'VisualFeatOutputs:0', 'ImageInfo:0'],
-        feed_dict={'Placeholder:0': [image_path,]})
-  
-  roi_boxes = np.squeeze(roi_boxes, axis=0)  # squeeze
+  roi_boxes, roi_scores, detection_boxes, scores_unused, box_outputs, detection_masks, visual_features, image_info = outputs
   # no need to clip the boxes, already done
-  roi_scores = np.squeeze(roi_scores, axis=0)
 
-  detection_boxes = np.squeeze(detection_boxes, axis=(0, 2))
-  scores_unused = np.squeeze(scores_unused, axis=0)
-  box_outputs = np.squeeze(box_outputs, axis=0)
-  detection_masks = np.squeeze(detection_masks, axis=0)
-  visual_features = np.squeeze(visual_features, axis=0)
+  detection_boxes = np.squeeze(detection_boxes, axis=1)
 
-  image_info = np.squeeze(image_info, axis=0)  # obtain image info
   image_scale = np.tile(image_info[2:3, :], (1, 2))
   image_height = int(image_info[0, 0])
   image_width = int(image_info[0, 1])
@@ -652,18 +818,24 @@ def extract_roi_vild(image_path,session,params):
   rescaled_detection_boxes = detection_boxes / image_scale # rescale
 
   # Read image
-  image = np.asarray(Image.open(open(image_path, 'rb')).convert("RGB"))
-  assert image_height == image.shape[0]
-  assert image_width == image.shape[1]
+  if image is None and read_image:
+    image = np.asarray(Image.open(open(image_path, 'rb')).convert("RGB"))
+  if image is not None:
+    assert image_height == image.shape[0]
+    assert image_width == image.shape[1]
 
 
   #################################################################
   # Filter boxes
 
   # Apply non-maximum suppression to detected boxes with nms threshold.
-  nmsed_indices = nms(
-      detection_boxes,
-      roi_scores,
+  # Boxes under min_rpn_score_thresh are dropped below anyway and can only
+  # suppress boxes with even lower scores, so NMS only needs the boxes above it.
+  candidates = np.nonzero(roi_scores >= min_rpn_score_thresh)[0]
+  nms_keep = np.zeros(len(roi_scores), dtype=bool)
+  nms_keep[candidates] = nms_mask(
+      detection_boxes[candidates],
+      roi_scores[candidates],
       thresh=nms_threshold
       )
 
@@ -673,7 +845,7 @@ def extract_roi_vild(image_path,session,params):
   # Filter out invalid rois (nmsed rois)
   valid_indices = np.where(
       np.logical_and(
-        np.isin(np.arange(len(roi_scores), dtype=np.int), nmsed_indices),
+        nms_keep,
         np.logical_and(
             np.logical_not(np.all(roi_boxes == 0., axis=-1)),
             np.logical_and(
@@ -693,7 +865,126 @@ def extract_roi_vild(image_path,session,params):
 
   return(image,image_height,image_width,valid_indices,detection_roi_scores,detection_boxes,detection_masks,detection_visual_feat,rescaled_detection_boxes)
 
+DECODE_OP_TYPES = ('DecodeJpeg', 'DecodeImage', 'DecodeAndCropJpeg', 'DecodePng')
+
+def find_decoded_image_tensor(graph):
+  """Returns the output of the graph's image decode op, or None.
+
+  The saved model reads and decodes the image file itself, so the decoded pixels
+  can be fetched along with the detections instead of reading the file again.
+  Only a single decode op outside of loops and conds can be fetched directly.
+  """
+  decode_ops = [op for op in graph.get_operations() if op.type in DECODE_OP_TYPES]
+  if len(decode_ops) != 1 or decode_ops[0]._control_flow_context is not None:
+    return None
+  return decode_ops[0].outputs[0]
+
+
+class ViLDRunner():
+  """Runs ViLD over many images.
+
+  Several image paths are fed per session.run if the saved model takes a batch
+  of paths. Otherwise up to batch_size single-image runs are kept in flight on a
+  thread pool, so file reads and decoding overlap with inference (session.run
+  releases the GIL). Which of the two works is found out on the first batch.
+
+  The decoded image is fetched from the graph when possible (see
+  `find_decoded_image_tensor`), images are only read with PIL otherwise. With
+  read_images=False they are not read at all and None is returned instead, for
+  callers that decode images on their own threads.
+  """
+
+  def __init__(self, session, params, batch_size=4, read_images=True):
+    self.session = session
+    self.params = params
+    self.batch_size = max(1, batch_size)
+    self.read_images = read_images
+    self.batched = None  # unknown until the first batch
+    self.image_tensor = find_decoded_image_tensor(session.graph)
+    self.pool = None
+    self.frames = 0
+    self.run_time = 0.0
+
+  def fetches(self):
+    if self.image_tensor is None:
+      return VILD_OUTPUT_TENSORS
+    return VILD_OUTPUT_TENSORS + [self.image_tensor]
+
+  def run_images(self, image_paths):
+    """Returns per-image outputs (VILD_OUTPUT_TENSORS order) and decoded images (None if not fetched)."""
+    import tensorflow.compat.v1 as tf
+    feed_dict = {'Placeholder:0': list(image_paths)}
+    try:
+      outputs = self.session.run(self.fetches(), feed_dict=feed_dict)
+    except (tf.errors.InvalidArgumentError, ValueError):
+      if self.image_tensor is None:
+        raise
+      # decoded image not fetchable in this graph, fall back to reading files
+      self.image_tensor = None
+      outputs = self.session.run(self.fetches(), feed_dict=feed_dict)
+
+    images = [None] * len(image_paths)
+    if self.image_tensor is not None:
+      image = np.asarray(outputs.pop())
+      if image.ndim == 3 and len(image_paths) == 1:
+        images = [image]
+      elif image.ndim == 4 and image.shape[0] == len(image_paths):
+        images = list(image)
+    images = [image[:, :, :3] if image is not None and image.shape[-1] >= 3 else None for image in images]
+
+    if any(len(output) != len(image_paths) for output in outputs):
+      raise ValueError(f'ViLD returned outputs for {len(outputs[0])} of {len(image_paths)} images')
+    return [[output[i] for output in outputs] for i in range(len(image_paths))], images
+
+  def run_batch(self, image_paths):
+    import tensorflow.compat.v1 as tf
+    if self.batched is None and len(image_paths) > 1:
+      try:
+        results = self.run_images(image_paths)
+        self.batched = True
+        return results
+      except (tf.errors.InvalidArgumentError, ValueError):
+        self.batched = False
+        print('ViLD saved model takes one image per run, pipelining single image runs instead')
+
+    if self.batched:
+      return self.run_images(image_paths)
+
+    if self.pool is None:
+      self.pool = ThreadPoolExecutor(max_workers=self.batch_size)
+    results = list(self.pool.map(lambda image_path: self.run_images([image_path]), image_paths))
+    return [outputs[0] for outputs, _ in results], [images[0] for _, images in results]
+
+  def run(self, image_paths):
+    """Yields (image_path, extract_roi_vild results) for every path, in order."""
+    for start in range(0, len(image_paths), self.batch_size):
+      batch_paths = image_paths[start:start + self.batch_size]
+      batch_start = time.perf_counter()
+      outputs, images = self.run_batch(batch_paths)
+      results = [filter_roi_vild(image_path, image_outputs, self.params, image=image, read_image=self.read_images)
+                 for image_path, image_outputs, image in zip(batch_paths, outputs, images)]
+      self.run_time += time.perf_counter() - batch_start
+      self.frames += len(batch_paths)
+      for image_path, result in zip(batch_paths, results):
+        yield image_path, result
+
+  @property
+  def fps(self):
+    return self.frames / self.run_time if self.run_time > 0 else 0.0
+
+  def report(self):
+    mode = 'batched' if self.batched else 'pipelined'
+    return f'ViLD: {self.frames} frames in {self.run_time:.1f}s, {self.fps:.2f} frames/s ({mode}, batch size {self.batch_size})'
+
+  def close(self):
+    if self.pool is not None:
+      self.pool.shutdown()
+      self.pool = None
+
 def vild_main(image_path, category_name_string, params, temperature=100.0, use_softmax=False):
+  from matplotlib import pyplot as plt
+  from matplotlib import patches
+  from scipy.special import softmax
   #################################################################
   # Hyperparameters for drawing
   configire_matplotlib_settings()
@@ -733,7 +1024,7 @@ def vild_main(image_path, category_name_string, params, temperature=100.0, use_s
   # Plot detected boxes on the input image.
   ymin, xmin, ymax, xmax = np.split(rescaled_detection_boxes, 4, axis=-1)
   processed_boxes = np.concatenate([xmin, ymin, xmax - xmin, ymax - ymin], axis=-1)
-  segmentations = paste_instance_masks(detection_masks, processed_boxes, image_height, image_width)
+  segmentations = crop_instance_masks(detection_masks, processed_boxes, image_height, image_width)
 
   if len(indices_fg) == 0:
     display_image(np.array(image), size=overall_fig_size)
@@ -824,6 +1115,8 @@ def vild_main(image_path, category_name_string, params, temperature=100.0, use_s
   plt.show()
 
 if __name__ == "__main__":
+  import tensorflow.compat.v1 as tf
+  from matplotlib import pyplot as plt
   #image_path = './examples/five_women_and_umbrellas.jpg'  #@param {type:"string"}
   image_path= "/home/eric/Github/robot-vision/spot-images/hand_color_image18.jpg"
   display_input_size=(10,10)